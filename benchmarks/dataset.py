@@ -0,0 +1,187 @@
+# benchmarks/dataset.py
+"""
+Synthetic data in realistic volumes, see `python manage.py seed-data --help`.
+
+Rows are generated in chunks and written with one bulk statement per chunk:
+COPY on PostgreSQL, executemany everywhere else. Everything is derived from
+the seed, so the same options always produce the same data.
+"""
+
+
+import csv
+import datetime
+import io
+import itertools
+import random
+import time
+
+from flask import current_app
+
+from project.server import db, bcrypt
+from project.server.catalog import ProductRecord, bump_version
+from project.server.main.utils import line_price, cart_total
+from project.server.models import User, Product, Cart, CartItem
+
+TABLES = (Product.__table__, Cart.__table__, User.__table__,
+          CartItem.__table__)
+# Product titles combine one word of each list, e.g. "Acme Red Chair 500"
+BRANDS = ('Acme', 'Northwind', 'Contoso', 'Globex', 'Initech', 'Umbrella',
+          'Stark', 'Wayne', 'Hooli', 'Vandelay', 'Soylent', 'Tyrell',
+          'Cyberdyne', 'Gringotts', 'Oscorp', 'Wonka', 'Duff', 'Krusty',
+          'Pawnee', 'Dunder')
+ADJECTIVES = ('Red', 'Blue', 'Green', 'Black', 'White', 'Large', 'Small',
+              'Organic', 'Fresh', 'Classic', 'Premium', 'Light', 'Heavy',
+              'Smart', 'Wooden', 'Steel', 'Cotton', 'Vintage', 'Compact',
+              'Deluxe', 'Spicy', 'Sweet', 'Crunchy', 'Soft', 'Portable')
+NOUNS = ('Apple', 'Butter', 'Chair', 'Table', 'Lamp', 'Kettle', 'Toaster',
+         'Blender', 'Pillow', 'Blanket', 'Mug', 'Plate', 'Knife', 'Spoon',
+         'Bottle', 'Jacket', 'Shirt', 'Socks', 'Shoes', 'Backpack', 'Notebook',
+         'Pencil', 'Camera', 'Speaker', 'Headphones', 'Charger', 'Cable',
+         'Keyboard', 'Mouse', 'Monitor', 'Coffee', 'Tea', 'Cheese', 'Bread',
+         'Honey', 'Jam', 'Cereal', 'Pasta', 'Rice', 'Sauce')
+
+
+def product_title(product_id):
+    """Deterministic title, the trailing size makes most titles unique."""
+    return '%s %s %s %s' % (BRANDS[product_id % len(BRANDS)],
+                            ADJECTIVES[product_id * 7 % len(ADJECTIVES)],
+                            NOUNS[product_id * 13 % len(NOUNS)],
+                            product_id // 100)
+
+
+class Writer(object):
+    """
+    Bulk writes chunks of rows and counts them per table.
+    """
+
+    def __init__(self, connection, chunk_size):
+        self.connection = connection
+        self.chunk_size = chunk_size
+        self.copy = connection.dialect.name == 'postgresql'
+        self.rows = {}
+        self.seconds = {}
+
+    def write(self, table, rows):
+        for chunk in iter(
+                lambda: list(itertools.islice(rows, self.chunk_size)), []):
+            started = time.perf_counter()
+            if self.copy:
+                self._copy(table, chunk)
+            else:
+                self.connection.execute(table.insert(), chunk)
+            self.seconds[table.name] = (self.seconds.get(table.name, 0) +
+                                        time.perf_counter() - started)
+            self.rows[table.name] = self.rows.get(table.name, 0) + len(chunk)
+
+    def _copy(self, table, chunk):
+        columns = list(chunk[0])
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in chunk:
+            writer.writerow(['' if row[column] is None else row[column]
+                             for column in columns])
+        buffer.seek(0)
+        cursor = self.connection.connection.cursor()
+        cursor.copy_expert('COPY %s (%s) FROM STDIN WITH (FORMAT csv)' % (
+            table.name, ', '.join(columns)), buffer)
+
+    def reset_sequences(self):
+        """Explicit ids don't advance PostgreSQL sequences."""
+        if self.copy:
+            for table in TABLES:
+                self.connection.execute(
+                    "SELECT setval(pg_get_serial_sequence('{0}', 'id'), "
+                    "coalesce(max(id), 1)) FROM {0}".format(table.name))
+
+
+def next_id(connection, table):
+    last = connection.execute(db.select([db.func.max(table.c.id)])).scalar()
+    return (last or 0) + 1
+
+
+def generate(products=1000, users=1000, cart_ratio=0.5, max_items=20,
+             skew=1.1, chunk_size=10000, password='password', seed_value=0):
+    """
+    Append products, users and carts with items to the database. Product
+    popularity follows a Zipf distribution with exponent `skew`, cart sizes are
+    uniform up to `max_items`. Users share one precomputed password hash.
+
+    :return: {table name: (rows, rows per second)}
+    """
+    rng = random.Random(seed_value)
+    connection = db.session.connection()
+    writer = Writer(connection, chunk_size)
+    first_product, first_cart, first_user, first_item = [
+        next_id(connection, table) for table in TABLES]
+
+    # Cents and bogof of every new product, carts only reference new products
+    cents = [rng.randint(50, 5000) for _ in range(products)]
+    bogof = [rng.random() < 0.1 for _ in range(products)]
+    writer.write(Product.__table__, ({
+        'id': first_product + i,
+        'title': product_title(first_product + i),
+        'price': cents[i],
+        'bogof': bogof[i],
+    } for i in range(products)))
+    if products:
+        bump_version(connection)
+
+    cart_count = int(users * cart_ratio) if products else 0
+    loyalty = [rng.random() < 0.3 for _ in range(users)]
+    cum_weights = list(itertools.accumulate(
+        1.0 / rank ** skew for rank in range(1, products + 1)))
+    indexes = range(products)
+    items = []
+
+    def cart_rows():
+        """
+        Carts of the first cart_count users, their items are collected in
+        `items`.
+        """
+        item_id = first_item
+        for i in range(cart_count):
+            lines = {}
+            for index in rng.choices(indexes, cum_weights=cum_weights,
+                                     k=rng.randint(1, max_items)):
+                lines[index] = lines.get(index, 0) + 1
+            subtotal = 0
+            for index, quantity in sorted(lines.items()):
+                product = ProductRecord(None, None, cents[index],
+                                        bogof[index])
+                price = line_price(product, quantity)
+                subtotal += price
+                items.append({'id': item_id, 'cart_id': first_cart + i,
+                              'product_id': first_product + index,
+                              'quantity': quantity, 'price': price})
+                item_id += 1
+            yield {'id': first_cart + i, 'subtotal': subtotal,
+                   'total': cart_total(subtotal, loyalty[i]), 'version': 0}
+
+    # Items of every chunk of carts are written right after it
+    carts = cart_rows()
+    while True:
+        chunk = list(itertools.islice(carts, max(1, chunk_size // max_items)))
+        if not chunk:
+            break
+        writer.write(Cart.__table__, iter(chunk))
+        writer.write(CartItem.__table__, iter(items))
+        del items[:]
+
+    password_hash = bcrypt.generate_password_hash(
+        password, current_app.config.get('BCRYPT_LOG_ROUNDS')).decode('utf-8')
+    registered = datetime.datetime(2018, 1, 1)
+    writer.write(User.__table__, ({
+        'id': first_user + i,
+        'email': 'user%s@example.com' % (first_user + i),
+        'password': password_hash,
+        'registered_on': registered + datetime.timedelta(
+            minutes=rng.randint(0, 525600)),
+        'admin': False,
+        'loyalty_card': loyalty[i],
+        'cart_id': first_cart + i if i < cart_count else None,
+    } for i in range(users)))
+    writer.reset_sequences()
+    db.session.commit()
+    return {name: (rows, int(rows / writer.seconds[name])
+                   if writer.seconds[name] else None)
+            for name, rows in writer.rows.items()}
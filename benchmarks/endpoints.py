@@ -0,0 +1,248 @@
+# benchmarks/endpoints.py
+"""
+Drive every API endpoint and the storefront through the Flask test client
+against a seeded database, see `python manage.py bench --help`.
+"""
+
+
+import datetime
+import json
+import platform
+import random
+import time
+import tracemalloc
+
+from flask import url_for
+
+from project.server import db, sqlstats
+from project.server.catalog import catalog
+from project.server.main.utils import line_price, cart_total
+from project.server.models import User, Product, Cart, CartItem
+from project.server.user.tokens import token_cache
+
+PASSWORD = 'bench-password'
+# Requests of the memory pass, tracemalloc slows everything down
+MEMORY_REQUESTS = 50
+# Compared with the baseline, lower is better for all of them
+COMPARED = ('p50_ms', 'p95_ms', 'queries_per_request')
+
+
+def seed(users, products, items, rng):
+    """
+    Create products and users with a token and a cart of `items` lines each.
+
+    :return: list of (user id, token)
+    """
+    records = [Product(title='Product %s' % i, price=rng.randint(100, 5000),
+                       bogof=rng.random() < 0.2) for i in range(products)]
+    db.session.add_all(records)
+    seeded = []
+    for i in range(users):
+        user = User(email='bench%s@example.com' % i, password=PASSWORD)
+        cart = user.cart = Cart(subtotal=0, version=0)
+        for product in rng.sample(records, min(items, products)):
+            quantity = rng.randint(1, 5)
+            price = line_price(product, quantity)
+            CartItem(cart=cart, product=product, quantity=quantity,
+                     price=price)
+            cart.subtotal += price
+        cart.total = cart_total(cart.subtotal, user.loyalty_card)
+        db.session.add(user)
+        seeded.append((user, user.get_token()))
+    db.session.commit()
+    return [(user.id, token) for user, token in seeded]
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = int(round(percent / 100.0 * (len(values) - 1)))
+    return values[min(len(values) - 1, index)]
+
+
+class Bench(object):
+
+    def __init__(self, app, users, rng, requests):
+        self.app = app
+        self.users = users
+        self.rng = rng
+        self.requests = requests
+        self.client = app.test_client()
+
+    def headers(self, token):
+        return {'Authorization': 'Token %s' % token,
+                'Content-Type': 'application/json'}
+
+    def calls(self):
+        """
+        :return: list of (name, [request callables]), every callable runs
+            one request
+        """
+        rng, client = self.rng, self.client
+        product_ids = [product.id for product in catalog.snapshot()]
+        items = db.session.query(CartItem.id, User.id).join(
+            Cart, CartItem.cart).join(Cart.user).all()
+        tokens = dict(self.users)
+        picks = [rng.choice(self.users) for _ in range(self.requests)]
+        item_picks = rng.sample(items, min(self.requests, len(items)))
+
+        def get(url, token, **kwargs):
+            return lambda: client.get(url, headers=self.headers(token),
+                                      **kwargs)
+
+        def send(method, url, token, data=None):
+            return lambda: client.open(url, method=method,
+                                       headers=self.headers(token),
+                                       data=json.dumps(data))
+
+        storefront = self.app.test_client()
+        storefront.post(url_for('user.login'), data={
+            'email': 'bench0@example.com', 'password': PASSWORD})
+        return [
+            ('GET /api/cart',
+             [get(url_for('api.get_cart'), token) for _, token in picks]),
+            ('POST /api/cart_item',
+             [send('POST', url_for('api.add_to_cart'), token,
+                   {'product': rng.choice(product_ids)})
+              for _, token in picks]),
+            ('PUT /api/cart_item/<pk>/',
+             [send('PUT', url_for('api.update_cart_item', pk=item_id),
+                   tokens[user_id], {'quantity': rng.randint(1, 9)})
+              for item_id, user_id in item_picks]),
+            ('PATCH /api/cart_item/<pk>/',
+             [send('PATCH', url_for('api.update_cart_item', pk=item_id),
+                   tokens[user_id], {'quantity': rng.randint(1, 9)})
+              for item_id, user_id in item_picks]),
+            ('PATCH /api/user/<pk>/',
+             [send('PATCH', url_for('api.toggle_loyalty_card', pk=user_id),
+                   token)
+              for user_id, token in picks]),
+            ('GET /api/products',
+             [get(url_for('api.list_products',
+                          after=rng.choice(product_ids)), token)
+              for _, token in picks]),
+            ('GET /', [lambda: storefront.get('/') for _ in picks]),
+            # Last, every request removes an item
+            ('DELETE /api/cart_item/<pk>/',
+             [send('DELETE', url_for('api.remove_cart_item', pk=item_id),
+                   tokens[user_id])
+              for item_id, user_id in item_picks]),
+        ]
+
+    def run(self, name, calls, memory):
+        """
+        Time each request, then repeat the first MEMORY_REQUESTS under
+        tracemalloc unless the requests change state irreversibly.
+        """
+        latencies, queries = [], []
+        started = time.perf_counter()
+        for call in calls:
+            with sqlstats.record() as log:
+                request_started = time.perf_counter()
+                response = call()
+                latencies.append(time.perf_counter() - request_started)
+            if response.status_code >= 400:
+                raise RuntimeError(
+                    '%s answered %s' % (name, response.status_code))
+            queries.append(len(log))
+        elapsed = time.perf_counter() - started
+        result = {
+            'requests': len(calls),
+            'throughput_rps': round(len(calls) / elapsed, 1),
+            'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+            'queries_per_request': round(sum(queries) / len(queries), 2),
+            'max_queries': max(queries),
+            'peak_memory_kb': None,
+        }
+        if memory:
+            tracemalloc.start()
+            try:
+                for call in calls[:MEMORY_REQUESTS]:
+                    call()
+                peak = tracemalloc.get_traced_memory()[1]
+                result['peak_memory_kb'] = round(peak / 1024.0, 1)
+            finally:
+                tracemalloc.stop()
+        return result
+
+
+def run(app, users=100, products=50, items=5, requests=200, seed_value=0,
+        out=None):
+    """
+    Seed the database bound to the app, which must not contain any user yet,
+    and benchmark every endpoint.
+
+    :return: result dict as written to `out`
+    """
+    rng = random.Random(seed_value)
+    db.create_all()
+    if User.query.first() is not None:
+        raise RuntimeError('Benchmarks need an empty database')
+    try:
+        started = time.perf_counter()
+        seeded = seed(users, products, items, rng)
+        seed_seconds = time.perf_counter() - started
+        token_cache.clear()
+        catalog.invalidate()
+        bench = Bench(app, seeded, rng, requests)
+        with app.test_request_context():
+            scenarios = bench.calls()
+        results = {}
+        for name, calls in scenarios:
+            results[name] = bench.run(name, calls,
+                                      memory=not name.startswith('DELETE'))
+        data = {
+            'meta': {
+                'created': datetime.datetime.now().isoformat(),
+                'database': db.engine.dialect.name,
+                'python': platform.python_version(),
+                'users': users,
+                'products': products,
+                'items': items,
+                'requests': requests,
+                'seed': seed_value,
+                'seed_seconds': round(seed_seconds, 3),
+            },
+            'results': results,
+        }
+    finally:
+        db.session.remove()
+        db.drop_all()
+    if out:
+        with open(out, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+    return data
+
+
+def regressions(data, baseline, threshold):
+    """
+    :param threshold: allowed relative increase, e.g. 0.2 for 20%
+    :return: list of messages for every compared value worse than the
+        baseline by more than the threshold
+    """
+    messages = []
+    for name, result in sorted(data['results'].items()):
+        previous = baseline['results'].get(name)
+        if previous is None:
+            continue
+        for key in COMPARED:
+            if previous[key] and result[key] > previous[key] * (1 + threshold):
+                messages.append('%s %s: %s, baseline %s (+%.0f%%)' % (
+                    name, key, result[key], previous[key],
+                    (result[key] / previous[key] - 1) * 100))
+    return messages
+
+
+def report(data):
+    row = '%-28s %9s %9s %9s %9s %8s %10s'
+    header = row % ('endpoint', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms',
+                    'queries', 'peak KiB')
+    lines = [header, '-' * len(header)]
+    for name, result in data['results'].items():
+        peak = result['peak_memory_kb']
+        lines.append(row % (
+            name, result['throughput_rps'], result['p50_ms'],
+            result['p95_ms'], result['p99_ms'], result['queries_per_request'],
+            peak if peak is not None else '-'))
+    return '\n'.join(lines)
@@ -0,0 +1,83 @@
+# benchmarks/pricing.py
+"""
+Compare the pricing loop of update_cart() on Decimal pounds, as amounts were
+stored before, with the integer pence of project/server/money.py.
+
+    $ python -m benchmarks.pricing
+"""
+
+
+import random
+import timeit
+from collections import namedtuple
+from decimal import Decimal, ROUND_HALF_UP
+
+from project.server.main.utils import line_price, cart_total
+from project.server.money import format_cents
+
+SIZES = (1, 50, 500)
+
+Product = namedtuple('Product', 'price bogof')
+
+CENT = Decimal('0.01')
+
+
+def decimal_cart_total(subtotal, loyalty_card):
+    # cart_total() as it was with Numeric columns, the quantize is the
+    # rounding the column applied when the total was stored
+    total = subtotal
+    if total > Decimal('20'):
+        total *= Decimal('0.9')
+    if loyalty_card:
+        total *= Decimal('0.98')
+    return total.quantize(CENT, ROUND_HALF_UP)
+
+
+def price_decimal(lines, loyalty_card):
+    subtotal = 0
+    for product, quantity in lines:
+        subtotal += line_price(product, quantity)
+    total = decimal_cart_total(subtotal, loyalty_card)
+    return str(subtotal), str(total)
+
+
+def price_cents(lines, loyalty_card):
+    subtotal = 0
+    for product, quantity in lines:
+        subtotal += line_price(product, quantity)
+    total = cart_total(subtotal, loyalty_card)
+    return format_cents(subtotal), format_cents(total)
+
+
+def create_baskets(size, rng):
+    cents, pounds = [], []
+    for i in range(size):
+        price, bogof = rng.randint(1, 5000), i % 2 == 0
+        quantity = rng.randint(1, 5)
+        cents.append((Product(price, bogof), quantity))
+        pounds.append((Product(Decimal(price).scaleb(-2), bogof), quantity))
+    return cents, pounds
+
+
+def bench(label, func, number):
+    best = min(timeit.repeat(func, number=number, repeat=5)) / number
+    print('  %-12s %10.1f us' % (label, best * 1e6))
+    return best
+
+
+def main():
+    rng = random.Random(0)
+    for size in SIZES:
+        cents, pounds = create_baskets(size, rng)
+        for loyalty_card in (False, True):
+            assert (price_decimal(pounds, loyalty_card) ==
+                    price_cents(cents, loyalty_card))
+        number = max(5, 20000 // size)
+        print('%s item(s)' % size)
+        before = bench('Decimal', lambda: price_decimal(pounds, True), number)
+        after = bench('pence', lambda: price_cents(cents, True), number)
+        print('  speedup      %10.1fx' % (before / after))
+
+
+if __name__ == '__main__':
+    main()
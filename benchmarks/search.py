@@ -0,0 +1,108 @@
+# benchmarks/search.py
+"""
+Product search latency of every backend available on SQLite, by catalog size.
+Products are generated by benchmarks.dataset into a temporary database file.
+
+    $ python -m benchmarks.search [SIZE ...]
+"""
+
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('APP_SETTINGS', 'project.server.config.TestingConfig')
+
+from project.server import create_app, db, search  # noqa: E402
+from project.server.catalog import catalog  # noqa: E402
+from project.server.models import Product  # noqa: E402
+from benchmarks import dataset  # noqa: E402
+from benchmarks.endpoints import percentile  # noqa: E402
+
+SIZES = (10000, 100000, 1000000)
+QUERIES = 200
+LIMIT = 20
+
+
+def queries(rng):
+    """Mix of word prefixes, whole words and two word queries."""
+    words = [word.lower() for word in
+             dataset.BRANDS + dataset.ADJECTIVES + dataset.NOUNS]
+    result = []
+    for _ in range(QUERIES):
+        word = rng.choice(words)
+        kind = rng.random()
+        if kind < 0.4:
+            result.append(word[:rng.randint(2, max(2, len(word) - 1))])
+        elif kind < 0.7:
+            result.append(word)
+        else:
+            result.append('%s %s' % (rng.choice(words), word[:3]))
+    return result
+
+
+def measure(terms):
+    latencies = []
+    for term in terms:
+        started = time.perf_counter()
+        search.search(term, LIMIT)
+        latencies.append((time.perf_counter() - started) * 1000)
+    return percentile(latencies, 50), percentile(latencies, 95)
+
+
+def rename(product_id, title):
+    """Change one title and return seconds until the next search sees it."""
+    started = time.perf_counter()
+    Product.query.filter(Product.id == product_id).update(
+        {Product.title: title}, synchronize_session=False)
+    db.session.commit()
+    search.search(title, LIMIT)
+    return time.perf_counter() - started
+
+
+def run(size, app, rng):
+    db.create_all()
+    started = time.perf_counter()
+    dataset.generate(products=size, users=0)
+    print('%s products, generated and indexed in %.1f s' % (
+        size, time.perf_counter() - started))
+    terms = queries(rng)
+    for backend in (search.FTS5, search.MEMORY):
+        if backend == search.FTS5 and search.backend() != search.FTS5:
+            print('  fts5      not available')
+            continue
+        app.config['PRODUCT_SEARCH_BACKEND'] = backend
+        started = time.perf_counter()
+        search.search('warmup', LIMIT)
+        build = time.perf_counter() - started
+        p50, p95 = measure(terms)
+        update = rename(rng.randint(1, size), 'Renamed %s product' % backend)
+        print('  %-8s build %8.1f ms  p50 %7.2f ms  p95 %7.2f ms  '
+              'update %7.1f ms' % (backend, build * 1000, p50, p95,
+                                   update * 1000))
+    app.config['PRODUCT_SEARCH_BACKEND'] = 'auto'
+    db.session.remove()
+    db.drop_all()
+    catalog.invalidate()
+
+
+def main():
+    sizes = [int(size) for size in sys.argv[1:]] or SIZES
+    directory = tempfile.mkdtemp()
+    app = create_app()
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///%s' % os.path.join(
+        directory, 'search.db')
+    catalog.check_interval = 0
+    try:
+        with app.test_request_context():
+            for size in sizes:
+                run(size, app, random.Random(size))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
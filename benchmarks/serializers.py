@@ -0,0 +1,61 @@
+# benchmarks/serializers.py
+"""
+Compare marshmallow ModelSchema dumping with the precompiled serializers.
+
+    $ python -m benchmarks.serializers
+"""
+
+
+import json
+import os
+import timeit
+
+os.environ.setdefault('APP_SETTINGS', 'project.server.config.TestingConfig')
+
+from project.server import create_app, db  # noqa: E402
+from project.server.main.serializers import CartSchema, dump_cart  # noqa: E402
+from project.server.models import User, Product, Cart, CartItem  # noqa: E402
+
+SIZES = (1, 50, 500)
+
+
+def create_cart(size):
+    user = User(email='bench%s@example.com' % size, password='bench')
+    cart = Cart(user=user, subtotal=0, total=0)
+    for i in range(size):
+        product = Product(title='Product %s' % i, price=i * 100 + 99,
+                          bogof=i % 2 == 0)
+        CartItem(cart=cart, product=product, quantity=i % 5 + 1,
+                 price=product.price)
+    db.session.add(cart)
+    db.session.commit()
+    return cart.id
+
+
+def bench(label, func, number):
+    best = min(timeit.repeat(func, number=number, repeat=5)) / number
+    print('  %-12s %10.1f us' % (label, best * 1e6))
+    return best
+
+
+def main():
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        for size in SIZES:
+            cart = Cart.query.get(create_cart(size))
+            assert json.dumps(dump_cart(cart)) == json.dumps(
+                CartSchema().dump(cart).data)
+            number = max(5, 5000 // size)
+            print('%s item(s)' % size)
+            schema = bench('ModelSchema',
+                           lambda: json.dumps(CartSchema().dump(cart).data),
+                           number)
+            fast = bench('precompiled', lambda: json.dumps(dump_cart(cart)),
+                         number)
+            print('  speedup      %10.1fx' % (schema / fast))
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    main()
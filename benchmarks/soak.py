@@ -0,0 +1,335 @@
+# benchmarks/soak.py
+"""
+Load and soak test against the app served by a separate server process,
+see `python manage.py soak --help`.
+
+Every simulated shopper owns a user and token and keeps adding, changing and
+removing cart items and toggling the loyalty card until the time is up.
+Afterwards the database is checked for broken cart invariants and every
+cart is compared with what its shopper expects.
+
+    $ python -m benchmarks.soak PORT
+
+serves the app configured by APP_SETTINGS and DATABASE_URL on PORT.
+"""
+
+
+import bisect
+import http.client
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from sqlalchemy import func, inspect
+
+from project.server import db
+from project.server.catalog import catalog
+from project.server.loading import FULL_CART
+from project.server.main.utils import check_cart
+from project.server.models import Cart, CartItem, User
+
+# Upper bounds of the latency histogram buckets in ms, the last one is open
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+# Relative weights of shopper actions
+ACTIONS = (('add', 40), ('update', 25), ('remove', 10), ('get', 20),
+           ('loyalty', 5))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(database_url, port, timeout=30):
+    """
+    Start the app in its own process and wait until it accepts connections.
+    """
+    env = dict(os.environ, DATABASE_URL=database_url,
+               APP_SETTINGS='project.server.config.DevelopmentConfig')
+    process = subprocess.Popen([sys.executable, '-W', 'ignore',
+                                '-m', 'benchmarks.soak', str(port)], env=env)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('Server exited with %s' % process.returncode)
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError('Server did not start within %s seconds' % timeout)
+
+
+def serve(port):
+    import logging
+    from werkzeug.serving import run_simple
+    from project.server import create_app
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    run_simple('127.0.0.1', port, create_app(), threaded=True)
+
+
+class Recorder(object):
+    """
+    Thread safe latency histograms per action and per time interval.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+        self.actions = {}
+        self.intervals = {}
+
+    def _entry(self, entries, key):
+        entry = entries.get(key)
+        if entry is None:
+            entry = entries[key] = {'requests': 0, 'errors': 0,
+                                    'histogram': [0] * (len(BUCKETS) + 1),
+                                    'max_ms': 0}
+        return entry
+
+    def add(self, action, milliseconds, error):
+        bucket = bisect.bisect_left(BUCKETS, milliseconds)
+        elapsed = time.monotonic() - self.started
+        second = int(elapsed // self.interval * self.interval)
+        with self._lock:
+            for entry in (self._entry(self.actions, action),
+                          self._entry(self.intervals, second)):
+                entry['requests'] += 1
+                entry['errors'] += error
+                entry['histogram'][bucket] += 1
+                entry['max_ms'] = max(entry['max_ms'], milliseconds)
+
+    @staticmethod
+    def summary(entry):
+        def percentile(percent):
+            rank = percent / 100.0 * entry['requests']
+            seen = 0
+            for bound, count in zip(BUCKETS + ('inf',), entry['histogram']):
+                seen += count
+                if seen >= rank:
+                    return bound
+        return {
+            'requests': entry['requests'],
+            'errors': entry['errors'],
+            'error_rate': round(entry['errors'] / entry['requests'], 4),
+            'p50_ms_le': percentile(50),
+            'p95_ms_le': percentile(95),
+            'p99_ms_le': percentile(99),
+            'max_ms': round(entry['max_ms'], 3),
+            'histogram': dict(zip(
+                ['<=%s' % b for b in BUCKETS] + ['>%s' % BUCKETS[-1]],
+                entry['histogram'])),
+        }
+
+    def report(self):
+        return {
+            'actions': {name: self.summary(entry)
+                        for name, entry in sorted(self.actions.items())},
+            'intervals': [dict(self.summary(entry), start_s=start)
+                          for start, entry in sorted(self.intervals.items())],
+        }
+
+
+class Shopper(threading.Thread):
+    """
+    Runs random cart actions for one user and tracks the cart it expects.
+    """
+
+    def __init__(self, port, user_id, token, product_ids, recorder, deadline,
+                 seed):
+        super(Shopper, self).__init__(daemon=True)
+        self.connection = http.client.HTTPConnection('127.0.0.1', port,
+                                                     timeout=30)
+        self.user_id = user_id
+        self.headers = {'Authorization': 'Token %s' % token,
+                        'Content-Type': 'application/json'}
+        self.product_ids = product_ids
+        self.recorder = recorder
+        self.deadline = deadline
+        self.rng = random.Random(seed)
+        # product id -> [item id, quantity]
+        self.items = {}
+        self.problems = []
+
+    def request(self, action, method, url, data=None):
+        started = time.perf_counter()
+        try:
+            body = json.dumps(data) if data is not None else None
+            self.connection.request(method, url, body=body,
+                                    headers=self.headers)
+            response = self.connection.getresponse()
+            status, body = response.status, response.read()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            status, body = None, b''
+        self.recorder.add(action, (time.perf_counter() - started) * 1000,
+                          status is None or status >= 400)
+        if status is None or status >= 400:
+            return None
+        return json.loads(body.decode('utf-8')) if body else {}
+
+    def run(self):
+        actions, weights = zip(*ACTIONS)
+        while time.monotonic() < self.deadline:
+            action = self.rng.choices(actions, weights)[0]
+            if action in ('update', 'remove') and not self.items:
+                action = 'add'
+            getattr(self, action)()
+        self.verify()
+
+    def add(self):
+        product_id = self.rng.choice(self.product_ids)
+        data = self.request('add', 'POST', '/api/cart_item',
+                            {'product': product_id})
+        if data is not None:
+            item = self.items.setdefault(product_id, [data['data']['id'], 0])
+            item[1] += 1
+            self.check_quantity(data['data'])
+
+    def update(self):
+        product_id = self.rng.choice(sorted(self.items))
+        quantity = self.rng.randint(0, 5)
+        data = self.request('update', 'PATCH',
+                            '/api/cart_item/%s/' % self.items[product_id][0],
+                            {'quantity': quantity})
+        if data is not None:
+            if quantity:
+                self.items[product_id][1] = quantity
+                self.check_quantity(data)
+            else:
+                del self.items[product_id]
+
+    def remove(self):
+        product_id = self.rng.choice(sorted(self.items))
+        url = '/api/cart_item/%s/' % self.items[product_id][0]
+        if self.request('remove', 'DELETE', url) is not None:
+            del self.items[product_id]
+
+    def get(self):
+        self.request('get', 'GET', '/api/cart')
+
+    def loyalty(self):
+        self.request('loyalty', 'PATCH', '/api/user/%s/' % self.user_id)
+
+    def check_quantity(self, item):
+        if item['quantity'] < 0:
+            self.problems.append('user %s: item %s with quantity %s' % (
+                self.user_id, item['id'], item['quantity']))
+
+    def verify(self):
+        """Compare the server side cart with the expected one."""
+        data = self.request('get', 'GET', '/api/cart')
+        expected = {product_id: quantity
+                    for product_id, (_, quantity) in self.items.items()}
+        actual = {item['product']['id']: item['quantity']
+                  for item in data['cart_items']} if data else {}
+        if data is not None and actual != expected:
+            self.problems.append('user %s: cart %s, expected %s' % (
+                self.user_id, actual, expected))
+
+
+def check_invariants():
+    """
+    :return: list of broken invariants of all carts in the database
+    """
+    problems = []
+    for cart in Cart.query.options(*FULL_CART).order_by(Cart.id):
+        for field, (stored, expected) in sorted(check_cart(cart).items()):
+            problems.append('cart %s %s: stored %s, recomputed %s' % (
+                cart.id, field, stored, expected))
+    duplicates = db.session.query(
+        CartItem.cart_id, CartItem.product_id
+    ).group_by(CartItem.cart_id, CartItem.product_id).having(func.count() > 1)
+    for cart_id, product_id in duplicates:
+        problems.append('cart %s: duplicate lines of product %s' % (
+            cart_id, product_id))
+    for item in CartItem.query.filter(CartItem.quantity < 0):
+        problems.append('cart %s: item %s with quantity %s' % (
+            item.cart_id, item.id, item.quantity))
+    return problems
+
+
+def prepare_database():
+    """
+    Create the missing tables of the database bound to the current app.
+
+    :return: the tables created, the only ones drop_tables() should drop
+    :raises RuntimeError: if the database already has users
+    """
+    existing = set(inspect(db.engine).get_table_names())
+    if User.__tablename__ in existing and User.query.first() is not None:
+        raise RuntimeError('Soak tests need an empty database')
+    created = [table for table in db.metadata.sorted_tables
+               if table.name not in existing]
+    db.metadata.create_all(bind=db.engine, tables=created)
+    return created
+
+
+def drop_tables(tables):
+    db.session.remove()
+    db.metadata.drop_all(bind=db.engine, tables=tables)
+
+
+def run(database_url, shoppers=16, duration=30, interval=5, products=50,
+        seed_value=0):
+    """
+    Seed one user per shopper into the database bound to the current app,
+    which must be the one at `database_url` and have been checked by
+    prepare_database(), and run the shoppers against a server process.
+
+    :return: report dict with 'actions', 'intervals' and 'problems'
+    """
+    from benchmarks.endpoints import seed
+    users = seed(shoppers, products, 0, random.Random(seed_value))
+    product_ids = [product.id for product in catalog.refresh()]
+    db.session.remove()
+
+    port = free_port()
+    server = start_server(database_url, port)
+    try:
+        recorder = Recorder(interval)
+        deadline = time.monotonic() + duration
+        threads = [Shopper(port, user_id, token, product_ids, recorder,
+                           deadline, seed_value + i)
+                   for i, (user_id, token) in enumerate(users)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        server.terminate()
+        server.wait()
+    report = recorder.report()
+    report['problems'] = [problem for thread in threads
+                          for problem in thread.problems] + check_invariants()
+    return report
+
+
+def format_report(report):
+    row = '%-10s %9s %7s %9s %9s %9s %9s'
+    lines = [row % ('action', 'requests', 'errors', 'p50 ms<=', 'p95 ms<=',
+                    'p99 ms<=', 'max ms')]
+    for name, entry in report['actions'].items():
+        lines.append(row % (name, entry['requests'], entry['errors'],
+                            entry['p50_ms_le'], entry['p95_ms_le'],
+                            entry['p99_ms_le'], entry['max_ms']))
+    lines.append('')
+    row = '%-10s %9s %7s %9s %9s'
+    lines.append(row % ('from s', 'requests', 'errors', 'p95 ms<=', 'max ms'))
+    for entry in report['intervals']:
+        lines.append(row % (entry['start_s'], entry['requests'],
+                            entry['errors'], entry['p95_ms_le'],
+                            entry['max_ms']))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    serve(int(sys.argv[1]))
@@ -0,0 +1,121 @@
+# benchmarks/startup.py
+"""
+Cold start of the app factory and of a CLI command, each in a fresh
+interpreter, see `python manage.py import-time --help`.
+
+Times of single imports need `-X importtime` of Python 3.7+, the modules
+loaded by a target are reported on every version.
+"""
+
+
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TARGETS = (
+    ('python', ['-c', 'pass']),
+    ('app', ['-c', 'from project.server import create_app; create_app()']),
+    # Creates the app too, but doesn't touch the database
+    ('cli', ['manage.py', 'routes']),
+)
+
+IMPORTTIME = sys.version_info >= (3, 7)
+
+_MODULES = 'loaded modules:'
+
+# Runs a target given as `-c <code>` or `<script> <args>` and prints the
+# modules it loaded to stderr on exit
+_WRAPPER = '''
+import atexit, runpy, sys
+atexit.register(lambda: sys.stderr.write(
+    '\\n%s %%s\\n' %% ' '.join(sorted(sys.modules))))
+sys.argv = sys.argv[1:]
+if sys.argv[0] == '-c':
+    exec(sys.argv.pop(1), {'__name__': '__main__'})
+else:
+    runpy.run_path(sys.argv[0], run_name='__main__')
+''' % _MODULES
+
+
+def parse(stderr):
+    """
+    :param stderr: output of `python -X importtime`
+    :return: [(module, cumulative ms, nesting level)] of all imports,
+        slowest first
+    """
+    imports = []
+    for line in stderr.splitlines():
+        if line.startswith(_MODULES):
+            continue
+        if (not line.startswith('import time:') or
+                line.endswith('imported package')):
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        level = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((name.strip(), int(cumulative) / 1000.0, level))
+    return sorted(imports, key=lambda entry: -entry[1])
+
+
+def loaded_modules(stderr):
+    """
+    :return: set of the modules the target had loaded when it exited
+    """
+    for line in reversed(stderr.splitlines()):
+        if line.startswith(_MODULES):
+            return set(line[len(_MODULES):].split())
+    raise RuntimeError('No module list in the output of the target')
+
+
+def measure(arguments, repeat=3):
+    """
+    Run a fresh interpreter with the arguments `repeat` times.
+
+    :return: (best wall time in ms, imports of that run, empty before
+        Python 3.7, set of the modules it loaded)
+    """
+    options = ['-X', 'importtime'] if IMPORTTIME else []
+    best = None
+    command = ([sys.executable] + options +
+               ['-W', 'ignore', '-c', _WRAPPER] + arguments)
+    for _ in range(repeat):
+        started = time.perf_counter()
+        process = subprocess.run(command, cwd=ROOT,
+                                 stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.PIPE,
+                                 universal_newlines=True)
+        elapsed = (time.perf_counter() - started) * 1000
+        if process.returncode:
+            raise RuntimeError('%s failed:\n%s' % (
+                ' '.join(arguments), process.stderr[-2000:]))
+        if best is None or elapsed < best[0]:
+            best = (elapsed, parse(process.stderr),
+                    loaded_modules(process.stderr))
+    return round(best[0], 1), best[1], best[2]
+
+
+def run(repeat=3):
+    """
+    :return: {target: {'ms': wall time, 'imports': [(module, ms, level)],
+        'modules': count}}
+    """
+    results = {}
+    for name, arguments in TARGETS:
+        ms, imports, modules = measure(arguments, repeat)
+        results[name] = {'ms': ms, 'imports': imports, 'modules': len(modules)}
+    return results
+
+
+def report(results, top=10):
+    lines = [] if IMPORTTIME else [
+        'Import times need Python 3.7+, only wall times are reported']
+    for name, result in results.items():
+        lines.append('%-8s %8.1f ms %6s modules' % (
+            name, result['ms'], result['modules']))
+        top_level = [(module, ms) for module, ms, level in result['imports']
+                     if level == 0]
+        for module, ms in top_level[:top]:
+            lines.append('    %-40s %8.1f ms' % (module, ms))
+    return '\n'.join(lines)
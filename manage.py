@@ -1,38 +1,90 @@
 # manage.py
 
 
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
 
 import click
-import coverage
 
-from flask.cli import FlaskGroup
+# Tests fail on implicit lazy loads (see project/tests/__init__.py), which has
+# to be configured before the models are imported
+if sys.argv[1:2] in (['test'], ['cov']):
+    os.environ.setdefault('SQLALCHEMY_RELATIONSHIP_LOADING', 'raise_on_sql')
 
-from project.server import create_app, db
-from project.server.models import *
-import subprocess
-import sys
+# code coverage, only traced for the cov command
+COV = None
+if sys.argv[1:2] == ['cov']:
+    import coverage
+    COV = coverage.coverage(
+        branch=True,
+        include='project/*',
+        omit=[
+            'project/tests/*',
+            'project/server/config.py',
+            'project/server/*/__init__.py'
+        ]
+    )
+    COV.start()
+
+from flask import current_app  # noqa: E402
+from flask.cli import FlaskGroup  # noqa: E402
+
+from project.server import create_app, init_migrate, db  # noqa: E402
+from project.server.catalog import catalog, bump_version  # noqa: E402
+from project.server.loading import FULL_CART  # noqa: E402
+from project.server.main.utils import check_cart, update_cart  # noqa: E402
+from project.server.models import *  # noqa: E402
+from project.server.money import format_cents  # noqa: E402
+from project.server.user.tokens import (  # noqa: E402
+    revoke_token as revoke_api_token)
+
+
+class ManageGroup(FlaskGroup):
+    """
+    FlaskGroup without the scan of setuptools entry points for plugin
+    commands, it imports pkg_resources and every plugin on each run. The only
+    plugin commands used, Flask-Migrate's `db`, are loaded on demand.
+    """
 
-app = create_app()
-cli = FlaskGroup(create_app=create_app)
-# code coverage
-COV = coverage.coverage(
-    branch=True,
-    include='project/*',
-    omit=[
-        'project/tests/*',
-        'project/server/config.py',
-        'project/server/*/__init__.py'
-    ]
-)
-COV.start()
+    def _load_plugin_commands(self):
+        self._loaded_plugin_commands = True
+
+    def get_command(self, ctx, name):
+        if name == 'db' and name not in self.commands:
+            from flask_migrate.cli import db as db_commands
+            self.add_command(db_commands)
+        return super(ManageGroup, self).get_command(ctx, name)
+
+    def list_commands(self, ctx):
+        commands = super(ManageGroup, self).list_commands(ctx)
+        return sorted(set(commands) | {'db'})
+
+
+def create_cli_app(script_info=None):
+    app = create_app(script_info)
+    if sys.argv[1:2] == ['db']:
+        init_migrate(app)
+    return app
+
+
+cli = ManageGroup(create_app=create_cli_app)
 
 
 @cli.command()
 def create_db():
+    """Creates the db tables, marked as migrated to the latest revision."""
+    from flask_migrate import stamp
     db.drop_all()
     db.create_all()
     db.session.commit()
+    init_migrate(current_app)
+    stamp()
 
 
 @cli.command()
@@ -43,20 +95,295 @@ def drop_db():
 
 @cli.command()
 def create_admin():
-    """Creates the admin user."""
-    db.session.add(User(email='ad@min.com', password='admin', admin=True))
+    """Creates the admin user and prints its API token."""
+    user = User(email='ad@min.com', password='admin', admin=True)
+    db.session.add(user)
+    token = user.get_token()
+    db.session.commit()
+    print('API token: %s' % token)
+
+
+@cli.command()
+@click.option('--email', required=True)
+def create_token(email):
+    """Issues a new API token for the user."""
+    user = User.query.filter_by(email=email).first()
+    if not user:
+        sys.exit('Unknown user %s' % email)
+    token = user.get_token()
+    db.session.commit()
+    print('API token: %s' % token)
+
+
+@cli.command()
+@click.argument('token')
+def revoke_token(token):
+    """Revokes an API token."""
+    if not revoke_api_token(token):
+        sys.exit('Unknown or already revoked token')
     db.session.commit()
 
 
 @cli.command()
 def create_data():
     """Creates sample data."""
-    db.session.add(Product(title="Cap", price=25, bogof=True))
-    db.session.add(Product(title="Banana", price=5))
-    db.session.add(Product(title="Apple", price=2))
-    db.session.add(Product(title="Cat", price=10, bogof=True))
-    db.session.add(Product(title="Butter", price=4))
+    db.session.add(Product(title="Cap", price=2500, bogof=True))
+    db.session.add(Product(title="Banana", price=500))
+    db.session.add(Product(title="Apple", price=200))
+    db.session.add(Product(title="Cat", price=1000, bogof=True))
+    db.session.add(Product(title="Butter", price=400))
+    db.session.commit()
+
+
+@cli.command()
+@click.option('--products', default=1000, show_default=True)
+@click.option('--users', default=1000, show_default=True)
+@click.option('--cart-ratio', default=0.5, show_default=True,
+              help='Share of users with a cart.')
+@click.option('--max-items', default=20, show_default=True,
+              help='Maximum lines per cart.')
+@click.option('--skew', default=1.1, show_default=True,
+              help='Zipf exponent of product popularity.')
+@click.option('--chunk-size', default=10000, show_default=True,
+              help='Rows per bulk insert.')
+@click.option('--password', default='password', show_default=True,
+              help='Password of all generated users.')
+@click.option('--seed', default=0, show_default=True,
+              help='Random seed, same seed same data.')
+def seed_data(products, users, cart_ratio, max_items, skew, chunk_size,
+              password, seed):
+    """
+    Bulk inserts synthetic products, users and carts:
+
+    $ python manage.py seed-data --products 1000000 --users 200000
+
+    """
+    from benchmarks import dataset
+    started = time.perf_counter()
+    written = dataset.generate(products, users, cart_ratio, max_items, skew,
+                               chunk_size, password, seed)
+    for table, (rows, rate) in written.items():
+        print('%-12s %10s rows %10s rows/s' % (table, rows, rate))
+    total = sum(rows for rows, _ in written.values())
+    seconds = time.perf_counter() - started
+    print('%-12s %10s rows %10s rows/s' % ('total', total,
+                                           int(total / seconds)))
+
+
+@cli.command()
+def refresh_catalog():
+    """Bumps the catalog version so every process reloads its product cache."""
+    bump_version(db.session.connection())
+    db.session.commit()
+    snapshot = catalog.refresh()
+    print('Catalog version %s, %s products' % (snapshot.version,
+                                               len(snapshot)))
+
+
+@cli.command()
+def install_search():
+    """Creates the product search index and indexes all products."""
+    from project.server import search
+    backend = search.install(db.session.connection())
     db.session.commit()
+    print('Installed %s search' % backend if backend else
+          'No search index for this database, using memory search')
+
+
+@cli.command()
+def flush_carts():
+    """Writes dirty carts of the cart store to the database, e.g. after a
+    crash."""
+    from project.server.cartstore import cart_store
+    store = cart_store()
+    if store is None:
+        print('No CART_STORE configured, carts are stored in the database')
+        return
+    print('%s cart(s) written' % store.flush())
+
+
+def _amount(cents):
+    return None if cents is None else format_cents(cents)
+
+
+@cli.command()
+@click.option('--product', 'products', type=int, multiple=True,
+              help='Changed product id, can be repeated. '
+                   'All carts by default.')
+@click.option('--chunk-size', default=500, show_default=True,
+              help='Carts per transaction.')
+@click.option('--verify', default=20, show_default=True,
+              help='Repriced carts recomputed with update_cart() to check '
+                   'the results.')
+def reprice_carts(products, chunk_size, verify):
+    """Recomputes item prices and totals of the carts of changed products."""
+    from project.server.repricing import repricer, verify_carts
+    cart_ids, seconds = repricer.run(list(products) or None, chunk_size)
+    rate = int(len(cart_ids) / seconds) if seconds else len(cart_ids)
+    print('%s cart(s) repriced in %.2fs, %s carts/s' % (
+        len(cart_ids), seconds, rate))
+    mismatches = verify_carts(cart_ids, verify)
+    for cart_id, problems in sorted(mismatches.items()):
+        for field, (stored, expected) in sorted(problems.items()):
+            print('Cart %s %s: stored %s, update_cart() %s' % (
+                cart_id, field, _amount(stored), _amount(expected)))
+    print('%s of %s sampled cart(s) differ from update_cart()' % (
+        len(mismatches), min(verify, len(cart_ids))))
+    if mismatches:
+        sys.exit(1)
+
+
+@cli.command()
+@click.option('--fix', is_flag=True, help='Recompute inconsistent carts.')
+def check_carts(fix):
+    """Compares stored cart totals with a full recomputation."""
+    inconsistent = 0
+    for cart in Cart.query.options(*FULL_CART).order_by(Cart.id):
+        problems = check_cart(cart)
+        if not problems:
+            continue
+        inconsistent += 1
+        for field, (stored, expected) in sorted(problems.items()):
+            print('Cart %s %s: stored %s, expected %s' % (
+                cart.id, field, _amount(stored), _amount(expected)))
+        if fix:
+            update_cart(cart)
+    if fix:
+        db.session.commit()
+    print('%s inconsistent cart(s)' % inconsistent)
+    if inconsistent and not fix:
+        sys.exit(1)
+
+
+@cli.command()
+@click.option('--database-url', default='sqlite://', show_default=True,
+              help='Scratch database, its tables are dropped afterwards.')
+@click.option('--users', default=100, show_default=True)
+@click.option('--products', default=50, show_default=True)
+@click.option('--items', default=5, show_default=True,
+              help='Items in the cart of every user.')
+@click.option('--requests', default=200, show_default=True,
+              help='Requests per endpoint.')
+@click.option('--seed', default=0, show_default=True,
+              help='Random seed of data and requests.')
+@click.option('--out', default='bench.json', show_default=True,
+              help='JSON file for the results.')
+@click.option('--baseline', type=click.Path(exists=True),
+              help='Results of a previous run to compare with.')
+@click.option('--threshold', default=0.2, show_default=True,
+              help='Relative increase of latency or queries over the baseline '
+                   'that fails the command.')
+def bench(database_url, users, products, items, requests, seed, out, baseline,
+          threshold):
+    """
+    Benchmarks every endpoint against a seeded database:
+
+    $ python manage.py bench --out after.json --baseline before.json
+
+    """
+    from benchmarks import endpoints
+    current_app.config['SQLALCHEMY_DATABASE_URI'] = database_url
+    try:
+        data = endpoints.run(current_app, users, products, items, requests,
+                             seed, out)
+    except RuntimeError as e:
+        sys.exit(str(e))
+    print(endpoints.report(data))
+    if baseline:
+        with open(baseline) as f:
+            messages = endpoints.regressions(data, json.load(f), threshold)
+        for message in messages:
+            print('Regression %s' % message)
+        if messages:
+            sys.exit(1)
+
+
+@cli.command()
+@click.option('--database-url',
+              help='Scratch database without users, the tables created are '
+                   'dropped afterwards. Defaults to a temporary SQLite file.')
+@click.option('--shoppers', default=16, show_default=True,
+              help='Concurrent shoppers, each with its own user.')
+@click.option('--duration', default=30, show_default=True,
+              help='Seconds to run.')
+@click.option('--interval', default=5, show_default=True,
+              help='Seconds per reported interval.')
+@click.option('--products', default=50, show_default=True)
+@click.option('--seed', default=0, show_default=True,
+              help='Random seed of data and shoppers.')
+@click.option('--out', help='JSON file for the report.')
+@click.option('--max-error-rate', default=0.0, show_default=True,
+              help='Error rate that fails the command.')
+def soak(database_url, shoppers, duration, interval, products, seed, out,
+         max_error_rate):
+    """
+    Runs concurrent shoppers against a server process and checks cart
+    invariants:
+
+    $ python manage.py soak --shoppers 32 --duration 300
+
+    """
+    from benchmarks import soak as soak_test
+    directory = None
+    if not database_url:
+        directory = tempfile.mkdtemp()
+        database_url = 'sqlite:///%s' % os.path.join(directory, 'soak.db')
+    current_app.config['SQLALCHEMY_DATABASE_URI'] = database_url
+    try:
+        created = soak_test.prepare_database()
+    except RuntimeError as e:
+        db.session.remove()
+        if directory:
+            shutil.rmtree(directory)
+        sys.exit(str(e))
+    try:
+        report = soak_test.run(database_url, shoppers, duration, interval,
+                               products, seed)
+    finally:
+        soak_test.drop_tables(created)
+        if directory:
+            shutil.rmtree(directory)
+    print(soak_test.format_report(report))
+    if out:
+        with open(out, 'w') as f:
+            json.dump(report, f, indent=2)
+    requests = sum(entry['requests'] for entry in report['actions'].values())
+    errors = sum(entry['errors'] for entry in report['actions'].values())
+    for problem in report['problems']:
+        print('Broken invariant %s' % problem)
+    print('%s requests, %s errors, %s broken invariants' % (
+        requests, errors, len(report['problems'])))
+    if report['problems'] or errors > max_error_rate * requests:
+        sys.exit(1)
+
+
+@cli.command()
+@click.option('--repeat', default=3, show_default=True,
+              help='Runs per target, the fastest is reported.')
+@click.option('--top', default=10, show_default=True,
+              help='Slowest top level imports shown per target.')
+def import_time(repeat, top):
+    """
+    Reports cold start time of the app factory and of a CLI command:
+
+    $ python manage.py import-time
+
+    Fails if one is over STARTUP_BUDGET_APP_MS or STARTUP_BUDGET_CLI_MS.
+    """
+    from benchmarks import startup
+    results = startup.run(repeat)
+    print(startup.report(results, top))
+    over = []
+    for name in ('app', 'cli'):
+        budget = current_app.config['STARTUP_BUDGET_%s_MS' % name.upper()]
+        if results[name]['ms'] > budget:
+            over.append('%s start took %s ms, budget %s ms' % (
+                name, results[name]['ms'], budget))
+    for message in over:
+        print(message)
+    if over:
+        sys.exit(1)
+
 
 @cli.command()
 @click.option('--test_name')
@@ -0,0 +1,68 @@
+"""Initial schema
+
+Revision ID: 2c4d6e8f0a13
+Revises:
+Create Date: 2026-10-18 09:00:00.000000
+
+Tables as created by `python manage.py create_db` before migrations were
+added. Databases created that way are marked as this revision with
+`python manage.py db stamp 2c4d6e8f0a13` and then upgraded.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2c4d6e8f0a13'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'carts',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('total', sa.Numeric(precision=10, scale=2), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_table(
+        'products',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('title', sa.String(length=255), nullable=False),
+        sa.Column('price', sa.Numeric(precision=10, scale=2), nullable=False),
+        sa.Column('bogof', sa.Boolean(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_table(
+        'users',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('email', sa.String(length=255), nullable=False),
+        sa.Column('password', sa.String(length=255), nullable=False),
+        sa.Column('registered_on', sa.DateTime(), nullable=False),
+        sa.Column('admin', sa.Boolean(), nullable=False),
+        sa.Column('loyalty_card', sa.Boolean(), nullable=True),
+        sa.Column('cart_id', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['cart_id'], ['carts.id']),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('email'),
+    )
+    op.create_table(
+        'cart_items',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('quantity', sa.Integer(), nullable=True),
+        sa.Column('price', sa.Numeric(precision=10, scale=2), nullable=False),
+        sa.Column('cart_id', sa.Integer(), nullable=True),
+        sa.Column('product_id', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['cart_id'], ['carts.id']),
+        sa.ForeignKeyConstraint(['product_id'], ['products.id']),
+        sa.PrimaryKeyConstraint('id'),
+    )
+
+
+def downgrade():
+    op.drop_table('cart_items')
+    op.drop_table('users')
+    op.drop_table('products')
+    op.drop_table('carts')
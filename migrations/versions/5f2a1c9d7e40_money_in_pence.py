@@ -0,0 +1,46 @@
+"""Store money as integer pence
+
+Revision ID: 5f2a1c9d7e40
+Revises: 8d1f3a5b7c92
+Create Date: 2026-10-18 10:00:00.000000
+
+Flush the cart store (python manage.py flush-carts) before upgrading, the
+amounts it writes back must be in the same unit as the columns.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5f2a1c9d7e40'
+down_revision = '8d1f3a5b7c92'
+branch_labels = None
+depends_on = None
+
+COLUMNS = [
+    ('products', 'price', False),
+    ('cart_items', 'price', False),
+    ('carts', 'subtotal', True),
+    ('carts', 'total', True),
+]
+
+
+def upgrade():
+    for table, column, nullable in COLUMNS:
+        if op.get_bind().dialect.name == 'sqlite':
+            # Columns are dynamically typed, recreating the table in batch
+            # mode would drop the search triggers of products
+            op.execute('UPDATE %s SET %s = CAST(ROUND(%s * 100) AS INTEGER)' % (table, column, column))
+        else:
+            op.alter_column(table, column, type_=sa.BigInteger(), existing_nullable=nullable,
+                            postgresql_using='round(%s * 100)::bigint' % column)
+
+
+def downgrade():
+    for table, column, nullable in COLUMNS:
+        if op.get_bind().dialect.name == 'sqlite':
+            op.execute('UPDATE %s SET %s = %s / 100.0' % (table, column, column))
+        else:
+            op.alter_column(table, column, type_=sa.Numeric(10, 2), existing_nullable=nullable,
+                            postgresql_using='%s / 100.0' % column)
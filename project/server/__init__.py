@@ -8,23 +8,30 @@ from flask_api import FlaskAPI
 from flask_babel import Babel
 from flask_login import LoginManager
 from flask_bcrypt import Bcrypt
-from flask_debugtoolbar import DebugToolbarExtension
 from flask_bootstrap import Bootstrap
 from flask_marshmallow import Marshmallow
-from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
+
+from project.server.database import SQLAlchemy
 
 
 # instantiate the extensions
 login_manager = LoginManager()
 bcrypt = Bcrypt()
-toolbar = DebugToolbarExtension()
 bootstrap = Bootstrap()
 db = SQLAlchemy()
-migrate = Migrate()
 ma = Marshmallow()
 babel = Babel()
 
+
+def init_migrate(app):
+    """
+    Flask-Migrate for the `db` commands, it imports alembic which is
+    expensive and not needed by anything else.
+    """
+    from flask_migrate import Migrate
+    Migrate(app, db)
+
+
 def create_app(script_info=None):
 
     # instantiate the app
@@ -41,12 +48,18 @@ def create_app(script_info=None):
     # set up extensions
     login_manager.init_app(app)
     bcrypt.init_app(app)
-    toolbar.init_app(app)
     bootstrap.init_app(app)
     db.init_app(app)
-    migrate.init_app(app, db)
     ma.init_app(app)
     babel.init_app(app)
+    if app.config['DEBUG_TB_ENABLED']:
+        # Development only, not imported otherwise
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    # amounts in pence rendered in pounds, {{ product.price|cents }}
+    from project.server.money import format_cents
+    app.add_template_filter(format_cents, 'cents')
 
     # register blueprints
     from project.server.main.views import main_blueprint
@@ -57,14 +70,58 @@ def create_app(script_info=None):
     app.register_blueprint(main_blueprint)
     app.register_blueprint(api_blueprint)
 
-    # flask login
-    from project.server.models import User
+    # api tokens
+    from project.server import metrics
+    from project.server.user import tokens
+    tokens.init_app(app)
+    metrics.register('auth', tokens.token_cache.stats)
+
+    # password hashing pool
+    from project.server.user import hashing
+    hashing.init_app(app)
+    metrics.register('hashing', hashing.password_hasher.stats)
+
+    # product catalog cache
+    from project.server.catalog import catalog
+    catalog.init_app(app)
+    metrics.register('catalog', catalog.stats)
+
+    # hot cart store
+    from project.server import cartstore
+    cartstore.init_app(app)
+    metrics.register('cartstore', cartstore.stats)
+
+    # repricing of carts after product changes
+    from project.server.repricing import repricer
+    metrics.register('repricing', repricer.stats)
+
+    # coalesced cart item updates
+    from project.server.main.coalescing import coalescer
+    metrics.register('coalescing', coalescer.stats)
+
+    # api unit of work
+    from project.server.main.transactions import transaction_stats
+    metrics.register('transactions', transaction_stats.stats)
+
+    # per request sql instrumentation
+    from project.server import sqlstats
+    sqlstats.init_app(app)
+    metrics.register('sql', sqlstats.sql_stats.stats)
+
+    # connection pool
+    from project.server.database import pool_stats, warmup
+    metrics.register('pool', pool_stats.stats)
+
+    # flask login, current_user is a cached identity of the user
+    from project.server.user import identity
+    identity.init_app(app)
+    metrics.register('identity', identity.identity_cache.stats)
     login_manager.login_view = 'user.login'
     login_manager.login_message_category = 'danger'
 
     @login_manager.user_loader
     def load_user(user_id):
-        return User.query.filter(User.id == int(user_id)).first()
+        return identity.load_identity(int(user_id))
 
     # error handlers
     @app.errorhandler(401)
@@ -83,6 +140,13 @@ def create_app(script_info=None):
     def server_error_page(error):
         return render_template('errors/500.html'), 500
 
+    @app.before_first_request
+    def warmup_database():
+        # Not in create_app(): CLI commands don't need it and pre-fork servers
+        # would share the connections with their workers
+        if app.config['DATABASE_WARMUP']:
+            warmup(app)
+
     # shell context for flask cli
     @app.shell_context_processor
     def ctx():
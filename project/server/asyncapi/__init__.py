@@ -0,0 +1,79 @@
+# project/server/asyncapi/__init__.py
+"""
+Cart API on an asyncio server: the cart endpoints of the Flask API served by
+aiohttp, with `databases` (asyncpg on PostgreSQL, aiosqlite on SQLite) as
+driver. A request waiting for the database doesn't hold a worker, so one
+process serves thousands of concurrent connections.
+
+    $ python -m project.server.asyncapi --port 8001
+
+Products, the storefront, cart operations and quotes stay on the Flask app.
+Carts are served from SQL, it refuses to start with a CART_STORE.
+In-memory SQLite databases can't be shared with it, use a file or PostgreSQL.
+"""
+
+
+import os
+
+from aiohttp import web
+from flask import Config
+
+from project.server.user.tokens import token_cache
+
+
+def database_options(config):
+    """
+    Pool size and statement timeout of asyncpg from the SQLAlchemy settings.
+    """
+    if not config['SQLALCHEMY_DATABASE_URI'].startswith('postgresql'):
+        return {}
+    options = {}
+    if config['SQLALCHEMY_POOL_SIZE'] is not None:
+        options['min_size'] = config['SQLALCHEMY_POOL_SIZE']
+        options['max_size'] = (config['SQLALCHEMY_POOL_SIZE'] +
+                               (config['SQLALCHEMY_MAX_OVERFLOW'] or 0))
+    if config['DATABASE_STATEMENT_TIMEOUT']:
+        options['server_settings'] = {
+            'statement_timeout': str(config['DATABASE_STATEMENT_TIMEOUT'])}
+    return options
+
+
+def create_app(config=None):
+    """
+    :param config: mapping of settings, e.g. the config of the Flask app.
+        Loaded from APP_SETTINGS like the Flask app if None.
+    :return: aiohttp application
+    """
+    from databases import Database
+
+    from project.server.asyncapi.queries import AsyncCatalog
+    from project.server.asyncapi.views import routes, errors
+
+    if config is None:
+        config = Config(os.getcwd())
+        config.from_object(os.getenv(
+            'APP_SETTINGS', 'project.server.config.DevelopmentConfig'))
+    if config['CART_STORE']:
+        # Carts would be changed behind the store's back
+        raise RuntimeError(
+            'The async API serves carts from SQL only, unset CART_STORE')
+    token_cache.configure(config['API_TOKEN_CACHE_SIZE'],
+                          config['API_TOKEN_CACHE_TTL'])
+
+    app = web.Application(middlewares=[errors])
+    app['config'] = config
+    app['database'] = database = Database(config['SQLALCHEMY_DATABASE_URI'],
+                                          **database_options(config))
+    app['catalog'] = AsyncCatalog(database,
+                                  config['CATALOG_VERSION_CHECK_INTERVAL'])
+    app.add_routes(routes)
+
+    async def connect(app):
+        await database.connect()
+
+    async def disconnect(app):
+        await database.disconnect()
+
+    app.on_startup.append(connect)
+    app.on_cleanup.append(disconnect)
+    return app
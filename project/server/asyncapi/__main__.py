@@ -0,0 +1,14 @@
+# project/server/asyncapi/__main__.py
+
+
+import argparse
+
+from aiohttp import web
+
+from project.server.asyncapi import create_app
+
+parser = argparse.ArgumentParser(description='Serve the cart API on aiohttp.')
+parser.add_argument('--host', default='127.0.0.1')
+parser.add_argument('--port', type=int, default=8001)
+args = parser.parse_args()
+web.run_app(create_app(), host=args.host, port=args.port)
@@ -0,0 +1,251 @@
+# project/server/asyncapi/queries.py
+"""
+Data access of the async API through the `databases` driver. Statements are
+SQLAlchemy core on the model tables, shared with the Flask API where possible.
+"""
+
+
+import asyncio
+import time
+from collections import namedtuple
+
+from sqlalchemy import select, text
+from sqlalchemy.dialects import sqlite
+
+from project.server.catalog import CatalogSnapshot, ProductRecord
+from project.server.main.serializers import OwnerRecord, CartRecord, \
+    CartItemRecord
+from project.server.main.utils import supports_returning, cart_item_upsert, \
+    select_cart_item, subtotal_delta_update, added_unit_price, line_price
+from project.server.models import User, Product, Cart, CartItem, ApiToken, \
+    CatalogVersion
+from project.server.user.tokens import token_cache
+
+users = User.__table__
+products = Product.__table__
+carts = Cart.__table__
+cart_items = CartItem.__table__
+api_tokens = ApiToken.__table__
+catalog_version = CatalogVersion.__table__
+
+UserRecord = namedtuple('UserRecord', ['id', 'cart_id', 'loyalty_card'])
+
+
+async def execute_update(database, statement):
+    """
+    Run an UPDATE of numbers whose parameters may be used several times.
+    The SQLite backend of `databases` binds every parameter once, on SQLite
+    the values are inlined instead.
+    """
+    if database.url.dialect == 'sqlite':
+        statement = text(str(statement.compile(
+            dialect=sqlite.dialect(), compile_kwargs={'literal_binds': True})))
+    return await database.execute(statement)
+
+
+class AsyncCatalog(object):
+    """
+    Catalog snapshots of the async app, same staleness rules as
+    project.server.catalog.Catalog: catalog_version is checked at most
+    every check_interval seconds and the snapshot reloaded when it moved.
+    """
+
+    def __init__(self, database, check_interval):
+        self.database = database
+        self.check_interval = check_interval
+        self._snapshot = None
+        self._checked_at = 0
+        self._lock = asyncio.Lock()
+        self.loads = 0
+
+    async def snapshot(self):
+        snapshot = self._snapshot
+        now = time.monotonic()
+        if (snapshot is not None
+                and now - self._checked_at < self.check_interval):
+            return snapshot
+        row = await self.database.fetch_one(
+            select([catalog_version.c.version]).where(
+                catalog_version.c.id == CatalogVersion.ROW_ID))
+        version = row['version'] if row else 0
+        if snapshot is None or snapshot.version != version:
+            async with self._lock:
+                snapshot = self._snapshot
+                if snapshot is None or snapshot.version != version:
+                    snapshot = self._snapshot = await self._load(
+                        version)
+        self._checked_at = now
+        return snapshot
+
+    async def _load(self, version):
+        self.loads += 1
+        rows = await self.database.fetch_all(
+            select([products.c.id, products.c.title, products.c.price,
+                    products.c.bogof]).order_by(products.c.id))
+        return CatalogSnapshot(
+            version, [ProductRecord(*row.values()) for row in rows],
+            self._snapshot)
+
+
+async def user_id_for_token(database, token):
+    """
+    Async variant of project.server.user.tokens.user_id_for_token, sharing
+    its cache.
+
+    :return: user id, None for unknown or revoked tokens
+    """
+    token_hash = ApiToken.hash(token)
+    user_id = token_cache.get(token_hash)
+    if user_id is None:
+        row = await database.fetch_one(select([api_tokens.c.user_id]).where(
+            (api_tokens.c.token_hash == token_hash)
+            & api_tokens.c.revoked_on.is_(None)))
+        if row is None:
+            return None
+        user_id = row['user_id']
+        token_cache.set(token_hash, user_id)
+    return user_id
+
+
+async def get_user(database, user_id):
+    """
+    :return: UserRecord, None for unknown ids
+    """
+    row = await database.fetch_one(
+        select([users.c.id, users.c.cart_id, users.c.loyalty_card]).where(
+            users.c.id == user_id))
+    return UserRecord(*row.values()) if row else None
+
+
+async def get_cart_version(database, user_id):
+    """
+    :return: (cart id, version) of the user's cart, None without a cart
+    """
+    row = await database.fetch_one(
+        select([carts.c.id, carts.c.version]).select_from(
+            carts.join(users, users.c.cart_id == carts.c.id)).where(
+            users.c.id == user_id))
+    return tuple(row.values()) if row else None
+
+
+async def get_cart(database, cart_id, snapshot):
+    """
+    Cart with its items, products come from the catalog snapshot.
+
+    :return: CartRecord, None for unknown ids
+    """
+    row = await database.fetch_one(
+        select([carts.c.id, carts.c.total, carts.c.version,
+                users.c.id.label('user_id')]).select_from(
+            carts.outerjoin(users, users.c.cart_id == carts.c.id)).where(
+            carts.c.id == cart_id))
+    if row is None:
+        return None
+    items = await database.fetch_all(
+        select([cart_items.c.id, cart_items.c.cart_id, cart_items.c.quantity,
+                cart_items.c.price, cart_items.c.product_id]).where(
+            cart_items.c.cart_id == cart_id).order_by(cart_items.c.id))
+    user = OwnerRecord(row['user_id']) if row['user_id'] is not None else None
+    return CartRecord(row['id'], row['total'], row['version'], user, [
+        CartItemRecord(item['id'], item['cart_id'], item['quantity'],
+                       item['price'], snapshot.get(item['product_id']))
+        for item in items])
+
+
+async def get_cart_item(database, pk, user_id):
+    """
+    :return: (item row, loyalty card of the cart owner), None for ids of
+        items not in the user's cart
+    """
+    row = await database.fetch_one(
+        select([cart_items, users.c.loyalty_card]).select_from(
+            cart_items.join(users, users.c.cart_id == cart_items.c.cart_id)
+        ).where((cart_items.c.id == pk) & (users.c.id == user_id)))
+    return (row, bool(row['loyalty_card'])) if row else None
+
+
+async def get_or_create_cart_id(database, user):
+    """
+    Same as project.server.main.utils.get_or_create_cart_id, only the first
+    concurrent writer links its cart to the user.
+    """
+    if user.cart_id:
+        return user.cart_id
+    cart_id = await database.execute(
+        carts.insert().values(subtotal=0, total=0, version=0))
+    await database.execute(users.update().where(
+        (users.c.id == user.id) & users.c.cart_id.is_(None)).values(
+        cart_id=cart_id))
+    row = await database.fetch_one(
+        select([users.c.cart_id]).where(users.c.id == user.id))
+    if row['cart_id'] != cart_id:
+        # Lost the race, use the cart created by the other request
+        await database.execute(carts.delete().where(carts.c.id == cart_id))
+    return row['cart_id']
+
+
+async def add_cart_item(database, cart_id, product, loyalty_card):
+    """
+    Same statements as project.server.main.utils.add_cart_item.
+
+    :return: CartItemRecord of the line
+    """
+    returning = supports_returning(database.url.dialect)
+    statement = cart_item_upsert(product, returning).bindparams(
+        cart_id=cart_id, product_id=product.id, unit_price=product.price)
+    if returning:
+        row = await database.fetch_one(statement)
+    else:
+        await database.execute(statement)
+        row = await database.fetch_one(
+            select_cart_item(cart_id, product.id))
+    cart_item_id, quantity = row.values()
+    await execute_update(database, subtotal_delta_update(
+        cart_id, added_unit_price(product, quantity), loyalty_card))
+    return CartItemRecord(cart_item_id, cart_id, quantity,
+                          line_price(product, quantity), product)
+
+
+async def reprice_cart_item(database, item, loyalty_card, quantity, product):
+    """
+    Set the quantity of a cart line and apply its price delta to the cart,
+    like project.server.main.utils.reprice_cart_item. Lines with
+    quantity <= 0 are deleted.
+
+    :param item: cart_items row as returned by get_cart_item()
+    :param product: product of the line, None if it was deleted
+    :return: CartItemRecord, None if the line was deleted
+    """
+    if product is None:
+        # Lines of deleted products can't be priced, they are removed
+        quantity = 0
+    previous = item['price'] or 0
+    price = line_price(product, quantity) if quantity > 0 else 0
+    if quantity > 0:
+        await database.execute(cart_items.update().where(
+            cart_items.c.id == item['id']).values(
+            quantity=quantity, price=price))
+    else:
+        await database.execute(
+            cart_items.delete().where(cart_items.c.id == item['id']))
+    await execute_update(database, subtotal_delta_update(
+        item['cart_id'], price - previous, loyalty_card))
+    if quantity <= 0:
+        return None
+    return CartItemRecord(item['id'], item['cart_id'], quantity, price,
+                          product)
+
+
+async def toggle_loyalty_card(database, user):
+    """
+    Flip the user's loyalty card and derive the total of their cart again.
+
+    :return: new loyalty card flag
+    """
+    card = not user.loyalty_card
+    await database.execute(users.update().where(
+        users.c.id == user.id).values(loyalty_card=card))
+    if user.cart_id:
+        await execute_update(
+            database, subtotal_delta_update(user.cart_id, 0, card))
+    return card
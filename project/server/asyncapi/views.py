@@ -0,0 +1,186 @@
+# project/server/asyncapi/views.py
+"""
+Cart endpoints of project.server.main.api on aiohttp, same URLs, pricing
+rules and response formats. Only token authentication is supported.
+"""
+
+
+from functools import wraps
+
+from aiohttp import web
+from flask_api import status
+from flask_babel import gettext
+from werkzeug.exceptions import BadRequest
+from werkzeug.http import parse_etags
+
+from project.server.asyncapi import queries
+from project.server.main.serializers import (
+    dump_cart, dump_cart_item, load_cart_item_quantity)
+from project.server.main.utils import (
+    validation_error, error_payload, cart_etag)
+
+routes = web.RouteTableDef()
+
+
+def json_response(data, status_code=status.HTTP_200_OK, headers=None):
+    return web.json_response(data, status=status_code, headers=headers)
+
+
+def error_response(status_code):
+    return json_response(error_payload(status_code), status_code)
+
+
+def login_required(view):
+    """
+    Resolve `Authorization: Token <value>` to request['user_id'], 403
+    otherwise.
+    """
+    @wraps(view)
+    async def wrapper(request):
+        header = request.headers.get('Authorization', '')
+        scheme, _, token = header.partition(' ')
+        user_id = None
+        if scheme == 'Token' and token:
+            user_id = await queries.user_id_for_token(
+                request.app['database'], token.strip())
+        if user_id is None:
+            return error_response(status.HTTP_403_FORBIDDEN)
+        request['user_id'] = user_id
+        return await view(request)
+    return wrapper
+
+
+async def request_data(request):
+    """
+    JSON body of the request, {} without one.
+    """
+    if not request.can_read_body:
+        return {}
+    try:
+        data = await request.json()
+    except ValueError:
+        validation_error('message', 'JSON parse error')
+    return data if isinstance(data, dict) else {}
+
+
+@routes.get('/api/cart')
+@login_required
+async def get_cart(request):
+    """
+    Same as project.server.main.api.get_cart, including conditional requests.
+    """
+    database = request.app['database']
+    snapshot = await request.app['catalog'].snapshot()
+    row = await queries.get_cart_version(database, request['user_id'])
+    if not row:
+        return error_response(status.HTTP_404_NOT_FOUND)
+    headers = {'Cache-Control': 'private, no-cache'}
+    etag = cart_etag(row[0], row[1], snapshot.version)
+    if parse_etags(request.headers.get('If-None-Match')).contains(etag):
+        headers['ETag'] = '"%s"' % etag
+        return web.Response(status=status.HTTP_304_NOT_MODIFIED,
+                            headers=headers)
+    cart = await queries.get_cart(database, row[0], snapshot)
+    # Version of the loaded cart, it may have changed since the lookup
+    etag = cart_etag(cart.id, cart.version, snapshot.version)
+    headers['ETag'] = '"%s"' % etag
+    return json_response(dump_cart(cart), headers=headers)
+
+
+@routes.post('/api/cart_item')
+@login_required
+async def add_to_cart(request):
+    """
+    Same as project.server.main.api.add_to_cart.
+    """
+    database = request.app['database']
+    data = await request_data(request)
+    snapshot = await request.app['catalog'].snapshot()
+    product = snapshot.get(data.get('product', -1))
+    if not product:
+        validation_error('product',
+                         gettext('Please specify a valid product id'))
+    async with database.transaction():
+        user = await queries.get_user(database, request['user_id'])
+        cart_id = await queries.get_or_create_cart_id(database, user)
+        cart_item = await queries.add_cart_item(database, cart_id, product,
+                                                user.loyalty_card)
+    return json_response({'data': dump_cart_item(cart_item)},
+                         status.HTTP_201_CREATED)
+
+
+@routes.route('PUT', r'/api/cart_item/{pk:\d+}/')
+@routes.route('PATCH', r'/api/cart_item/{pk:\d+}/')
+@login_required
+async def update_cart_item(request):
+    """
+    Same as project.server.main.api.update_cart_item, only quantity is read.
+    """
+    database = request.app['database']
+    data = await request_data(request)
+    snapshot = await request.app['catalog'].snapshot()
+    async with database.transaction():
+        found = await queries.get_cart_item(
+            database, int(request.match_info['pk']), request['user_id'])
+        if not found:
+            return error_response(status.HTTP_404_NOT_FOUND)
+        item, loyalty_card = found
+        quantity = load_cart_item_quantity(
+            data, partial=request.method == 'PATCH')
+        if quantity is None:
+            quantity = item['quantity']
+        cart_item = await queries.reprice_cart_item(
+            database, item, loyalty_card, quantity,
+            snapshot.get(item['product_id']))
+    return json_response(dump_cart_item(cart_item) if cart_item else {})
+
+
+@routes.delete(r'/api/cart_item/{pk:\d+}/')
+@login_required
+async def remove_cart_item(request):
+    """
+    Same as project.server.main.api.remove_cart_item.
+    """
+    database = request.app['database']
+    snapshot = await request.app['catalog'].snapshot()
+    async with database.transaction():
+        found = await queries.get_cart_item(
+            database, int(request.match_info['pk']), request['user_id'])
+        if not found:
+            return error_response(status.HTTP_404_NOT_FOUND)
+        item, loyalty_card = found
+        await queries.reprice_cart_item(database, item, loyalty_card, 0,
+                                        snapshot.get(item['product_id']))
+    return json_response({'status': 'ok'})
+
+
+@routes.patch(r'/api/user/{pk:\d+}/')
+@login_required
+async def toggle_loyalty_card(request):
+    """
+    Same as project.server.main.api.toggle_loyalty_card.
+    """
+    database = request.app['database']
+    if request['user_id'] != int(request.match_info['pk']):
+        validation_error('id', gettext('Updating another user is not allowed'))
+    async with database.transaction():
+        user = await queries.get_user(database, request['user_id'])
+        card = await queries.toggle_loyalty_card(database, user)
+    return json_response({'card': card})
+
+
+@web.middleware
+async def errors(request, handler):
+    """
+    Validation errors and unknown URLs in the format of
+    project.server.main.handlers.
+    """
+    try:
+        return await handler(request)
+    except web.HTTPNotFound:
+        return json_response({'message': 'Not found'},
+                             status.HTTP_404_NOT_FOUND)
+    except web.HTTPMethodNotAllowed:
+        return error_response(status.HTTP_405_METHOD_NOT_ALLOWED)
+    except BadRequest as e:
+        return json_response(e.data, status.HTTP_400_BAD_REQUEST)
@@ -0,0 +1,721 @@
+# project/server/cartstore.py
+"""
+Hot cart store: carts of active users are kept out of the database, the
+cart endpoints read and mutate them there and dirty carts are written back
+to carts/cart_items in batches.
+
+CART_STORE picks the backend, carts are served from SQL as before without
+one.
+
+memory: dict in the worker process, every user's requests have to reach the
+    same process, e.g. a single process server or sticky sessions
+kv: local key-value file (SQLite) shared by the processes of a host, a
+    stand-in for an external key-value store. Survives crashes.
+
+CART_STORE_FLUSH_INTERVAL is the durability: a background thread writes
+dirty carts every that many seconds, changes since the last flush are lost
+when a memory store's process dies. A kv store keeps them and the next flush
+of any process on the host replays them, `python manage.py flush-carts`
+does it right away. 0 writes every change in the transaction of its request.
+
+Adding a product a cart doesn't contain yet goes to SQL right away to
+create its line, later changes of the line only to the store.
+"""
+
+
+import atexit
+import json
+import logging
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import current_app
+from sqlalchemy import event, text, bindparam
+from sqlalchemy.exc import DBAPIError, DataError, IntegrityError
+from sqlalchemy.orm import Session
+
+from project.server import db
+from project.server.catalog import catalog
+from project.server.main.serializers import (
+    OwnerRecord, CartRecord, CartItemRecord)
+from project.server.main.utils import (
+    line_price, cart_total, get_or_create_cart_id, add_cart_item)
+from project.server.models import User, Cart, CartItem
+from project.server.loading import AUTH_ONLY
+from project.server.money import Cents
+
+logger = logging.getLogger(__name__)
+
+# Session.info key of carts written in a request transaction:
+# [(store, user_id, version, removed, drop)]
+_WRITTEN = 'cart_store_written'
+# Session.info key of lines a write-behind store added in SQL:
+# [(store, user_id, item_id, version, before)]
+_ADDED = 'cart_store_added'
+
+_UPSERT_ITEM = text('''
+INSERT INTO cart_items (id, cart_id, product_id, quantity, price)
+VALUES (:id, :cart_id, :product_id, :quantity, :price)
+ON CONFLICT (id) DO UPDATE
+SET quantity = excluded.quantity, price = excluded.price
+''').bindparams(bindparam('price', type_=Cents))
+_DELETE_ITEM = text('DELETE FROM cart_items WHERE id = :id')
+_UPDATE_CART = text(
+    'UPDATE carts SET subtotal = :subtotal, total = :total, '
+    'version = :version WHERE id = :id'
+).bindparams(bindparam('subtotal', type_=Cents),
+             bindparam('total', type_=Cents))
+_UPDATE_USER = text(
+    'UPDATE users SET loyalty_card = :loyalty_card WHERE id = :id')
+
+
+class StoredCart(object):
+    """
+    Cart of one user in the store. Items are
+    {item id: [product id, quantity, price]}, removed holds ids of deleted
+    items not flushed yet.
+    """
+
+    __slots__ = ('user_id', 'cart_id', 'loyalty_card', 'version', 'subtotal',
+                 'total', 'items', 'removed', 'dirty', 'touched')
+
+    def __init__(self, user_id, cart_id, loyalty_card, version=0, subtotal=0,
+                 total=0, items=None, removed=None, dirty=False,
+                 touched=None):
+        self.user_id = user_id
+        self.cart_id = cart_id
+        self.loyalty_card = bool(loyalty_card)
+        self.version = version
+        self.subtotal = subtotal
+        self.total = total
+        self.items = items if items is not None else {}
+        self.removed = removed if removed is not None else []
+        self.dirty = dirty
+        self.touched = touched if touched is not None else time.time()
+
+    def copy(self):
+        items = {item_id: list(item) for item_id, item in self.items.items()}
+        return StoredCart(self.user_id, self.cart_id, self.loyalty_card,
+                          self.version, self.subtotal, self.total, items,
+                          list(self.removed), self.dirty, self.touched)
+
+    def to_json(self):
+        items = [[item_id, product_id, quantity, price] for
+                 item_id, (product_id, quantity, price) in self.items.items()]
+        return json.dumps([self.user_id, self.cart_id, self.loyalty_card,
+                           self.version, self.subtotal, self.total, items,
+                           self.removed, self.dirty, self.touched])
+
+    @classmethod
+    def from_json(cls, value):
+        (user_id, cart_id, loyalty_card, version, subtotal, total, items,
+         removed, dirty, touched) = json.loads(value)
+        return cls(user_id, cart_id, loyalty_card, version, subtotal, total,
+                   {item_id: [product_id, quantity, price]
+                    for item_id, product_id, quantity, price in items},
+                   removed, dirty, touched)
+
+    def reprice(self, item_id=None, product=None):
+        """
+        Price the given item with the product and derive the cart totals.
+        """
+        if item_id is not None:
+            item = self.items[item_id]
+            item[2] = line_price(product, item[1])
+        self.subtotal = sum(price for _, _, price in self.items.values())
+        self.total = cart_total(self.subtotal, self.loyalty_card)
+        self.version += 1
+        self.dirty = True
+
+    def record(self, snapshot):
+        """
+        :return: CartRecord for dump_cart(), items in id order with products
+            of the snapshot
+        """
+        items = [self.item_record(item_id, snapshot)
+                 for item_id in sorted(self.items)]
+        return CartRecord(self.cart_id, self.total, self.version,
+                          OwnerRecord(self.user_id), items)
+
+    def item_record(self, item_id, snapshot):
+        product_id, quantity, price = self.items[item_id]
+        return CartItemRecord(item_id, self.cart_id, quantity, price,
+                              snapshot.get(product_id))
+
+
+def _refused(error):
+    # Errors of the data written rather than of the database, retrying
+    # doesn't help
+    return isinstance(error, (IntegrityError, DataError))
+
+
+class FlushStats(object):
+    """
+    Counters of the flushes of a store, part of /api/_metrics/cartstore.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.flushes = self.carts = self.errors = self.quarantined = 0
+        self.last_flush_ms = None
+
+    def flushed(self, carts, seconds):
+        with self._lock:
+            self.flushes += 1
+            self.carts += carts
+            self.last_flush_ms = round(seconds * 1000, 3)
+
+    def failed(self):
+        with self._lock:
+            self.errors += 1
+
+    def quarantine(self):
+        with self._lock:
+            self.quarantined += 1
+
+
+class CartStore(object):
+    """
+    Cart operations of the API and write-behind to SQL. Backends implement
+    the storage: locked(), _get(), _put(), _drop(), _dirty(), _dirty_count(),
+    _evict_idle() and __len__().
+    """
+
+    name = None
+
+    def __init__(self, config):
+        self.flush_interval = config['CART_STORE_FLUSH_INTERVAL']
+        self.batch_size = config['CART_STORE_FLUSH_BATCH']
+        self.idle_seconds = config['CART_STORE_IDLE_SECONDS']
+        self.flush_stats = FlushStats()
+        self._flusher = None
+        self._closed = threading.Event()
+
+    # Cart operations, in the transaction of the current request
+
+    def get(self, user_id):
+        """
+        :return: CartRecord, None if the user has no cart
+        """
+        snapshot = catalog.snapshot()
+        with self.locked(user_id):
+            cart = self._cart(user_id)
+            return cart.record(snapshot) if cart.cart_id else None
+
+    def add(self, user_id, product):
+        """
+        Add one unit of product to the user's cart.
+
+        :return: CartItemRecord
+        """
+        with self.locked(user_id):
+            cart = self._cart(user_id)
+            item_id = self._item_of(cart, product.id)
+            if item_id is not None:
+                cart.items[item_id][1] += 1
+                return self._changed(cart, item_id, product)
+        # New line, created in SQL with the atomic add of the API
+        cart_id = cart.cart_id or get_or_create_cart_id(
+            User.query.options(*AUTH_ONLY).get(user_id))
+        item_id = add_cart_item(cart_id, product, cart.loyalty_card)
+        with self.locked(user_id):
+            cart = self._cart(user_id)
+            before = cart.copy()
+            cart.cart_id = cart_id
+            item = cart.items.get(item_id)
+            if item is None:
+                cart.items[item_id] = [product.id, 1, 0]
+                if item_id in cart.removed:
+                    # Removed but not deleted yet, the line is still there
+                    cart.removed.remove(item_id)
+            else:
+                # Concurrent add of the same product
+                item[1] += 1
+            record = self._changed(cart, item_id, product)
+            if self.flush_interval:
+                # The line is only in this transaction, the store mustn't
+                # keep it if it rolls back
+                db.session.info.setdefault(_ADDED, []).append(
+                    (self, user_id, item_id, cart.version, before))
+            return record
+
+    def update(self, user_id, item_id, quantity):
+        """
+        Set the quantity of an item of the user's cart, removing it at
+        quantity <= 0.
+
+        :param quantity: None reprices the item as is
+        :return: CartItemRecord, None if the item was removed
+        :raises KeyError: for items not in the user's cart
+        """
+        with self.locked(user_id):
+            cart = self._cart(user_id)
+            item = cart.items[item_id]
+            if quantity is not None:
+                item[1] = quantity
+            product = catalog.get(item[0])
+            if item[1] <= 0 or product is None:
+                # Lines of deleted products can't be priced, they are removed
+                self._remove(cart, item_id)
+                return None
+            return self._changed(cart, item_id, product)
+
+    def remove(self, user_id, item_id):
+        """
+        :raises KeyError: for items not in the user's cart
+        """
+        with self.locked(user_id):
+            cart = self._cart(user_id)
+            if item_id not in cart.items:
+                raise KeyError(item_id)
+            self._remove(cart, item_id)
+
+    def toggle_loyalty_card(self, user_id):
+        """
+        :return: new loyalty card flag
+        """
+        with self.locked(user_id):
+            cart = self._cart(user_id)
+            cart.loyalty_card = not cart.loyalty_card
+            cart.reprice()
+            self._save(cart)
+            return cart.loyalty_card
+
+    def evict(self, user_id):
+        """
+        Write the user's cart in the current transaction and forget it once
+        committed, before the cart is changed in SQL directly.
+        """
+        with self.locked(user_id):
+            cart = self._get(user_id)
+            if cart is None:
+                return
+            if cart.dirty:
+                self.write([cart])
+            self._written(cart, drop=True)
+
+    def _cart(self, user_id):
+        cart = self._get(user_id)
+        if cart is None:
+            cart = self._load(user_id)
+        cart.touched = time.time()
+        self._put(cart)
+        return cart
+
+    def _load(self, user_id):
+        user = db.session.query(User.cart_id, User.loyalty_card).filter(
+            User.id == user_id).one()
+        cart = StoredCart(user_id, user.cart_id, user.loyalty_card)
+        if user.cart_id:
+            row = db.session.query(
+                Cart.subtotal, Cart.total, Cart.version).filter(
+                Cart.id == user.cart_id).one()
+            cart.subtotal = row.subtotal or 0
+            cart.total = row.total or 0
+            cart.version = row.version
+            rows = db.session.query(
+                CartItem.id, CartItem.product_id, CartItem.quantity,
+                CartItem.price).filter(
+                CartItem.cart_id == user.cart_id).order_by(CartItem.id)
+            for item_id, product_id, quantity, price in rows:
+                cart.items[item_id] = [product_id, quantity, price]
+        return cart
+
+    @staticmethod
+    def _item_of(cart, product_id):
+        for item_id, item in cart.items.items():
+            if item[0] == product_id:
+                return item_id
+        return None
+
+    def _remove(self, cart, item_id):
+        del cart.items[item_id]
+        cart.removed.append(item_id)
+        cart.reprice()
+        self._save(cart)
+
+    def _changed(self, cart, item_id, product):
+        cart.reprice(item_id, product)
+        self._save(cart)
+        return cart.item_record(item_id, catalog.snapshot())
+
+    def _save(self, cart):
+        if self.flush_interval:
+            self._put(cart)
+            self._start_flusher()
+        else:
+            # Write-through, in the transaction of the request
+            self.write([cart])
+            self._put(cart)
+            self._written(cart)
+
+    def _written(self, cart, drop=False):
+        db.session.info.setdefault(_WRITTEN, []).append(
+            (self, cart.user_id, cart.version, list(cart.removed), drop))
+
+    def _undo_add(self, user_id, item_id, version, before):
+        """
+        Take back an add() whose new line was rolled back, other changes of
+        the cart may not be written yet and are kept.
+
+        :param version: version of the cart after the add
+        :param before: copy of the cart before the add
+        """
+        with self.locked(user_id):
+            cart = self._get(user_id)
+            if cart is None:
+                return
+            if cart.version == version and not before.dirty:
+                # Nothing else changed since the last flush, reload from SQL
+                self._drop(user_id)
+                return
+            if item_id in before.items:
+                # Concurrent add of the same product, the line is as before
+                cart.items[item_id] = list(before.items[item_id])
+            else:
+                cart.items.pop(item_id, None)
+                if item_id in before.removed and item_id not in cart.removed:
+                    cart.removed.append(item_id)
+            if before.cart_id is None:
+                cart.cart_id = None
+            cart.reprice()
+            self._put(cart)
+
+    # Write-behind
+
+    def write(self, carts):
+        """
+        Write carts to SQL in the current session with one statement per
+        table. Items are upserted by id, writing the same cart again changes
+        nothing.
+        """
+        removed = [{'id': item_id}
+                   for cart in carts for item_id in cart.removed]
+        items = [{'id': item_id, 'cart_id': cart.cart_id,
+                  'product_id': product_id, 'quantity': quantity,
+                  'price': price}
+                 for cart in carts
+                 for item_id, (product_id, quantity, price)
+                 in cart.items.items()]
+        if removed:
+            db.session.execute(_DELETE_ITEM, removed)
+        if items:
+            db.session.execute(_UPSERT_ITEM, items)
+        with_cart = [cart for cart in carts if cart.cart_id]
+        if with_cart:
+            db.session.execute(_UPDATE_CART, [
+                {'id': cart.cart_id, 'subtotal': cart.subtotal,
+                 'total': cart.total, 'version': cart.version}
+                for cart in with_cart])
+        db.session.execute(_UPDATE_USER, [
+            {'id': cart.user_id, 'loyalty_card': cart.loyalty_card}
+            for cart in carts])
+
+    def flush(self):
+        """
+        Write all dirty carts, CART_STORE_FLUSH_BATCH per transaction, and
+        evict clean carts idle for CART_STORE_IDLE_SECONDS.
+
+        :return: number of carts written
+        """
+        written = 0
+        carts = self._dirty()
+        for start in range(0, len(carts), self.batch_size):
+            batch = carts[start:start + self.batch_size]
+            started = time.perf_counter()
+            error = self._commit(batch)
+            if error is not None:
+                logger.warning('Cart store flush failed: %s', error.orig)
+                if not _refused(error):
+                    # The database is unavailable, the next flush retries
+                    break
+                # A cart the database refuses would fail its batch on every
+                # flush, write them one by one
+                if len(batch) > 1:
+                    errors = [(cart, self._commit([cart])) for cart in batch]
+                else:
+                    errors = [(batch[0], error)]
+                for cart, error in errors:
+                    if error is not None and _refused(error):
+                        self._quarantine(cart)
+                batch = [cart for cart, error in errors if error is None]
+            for cart in batch:
+                self.mark_clean(cart.user_id, cart.version, cart.removed)
+            written += len(batch)
+            self.flush_stats.flushed(len(batch),
+                                     time.perf_counter() - started)
+        self._evict_idle(time.time() - self.idle_seconds)
+        return written
+
+    def _commit(self, carts):
+        """
+        Write carts in a transaction of their own.
+
+        :return: None, or the DBAPIError the transaction was rolled back for
+        """
+        try:
+            self.write(carts)
+            db.session.commit()
+        except DBAPIError as e:
+            db.session.rollback()
+            self.flush_stats.failed()
+            return e
+        return None
+
+    def _quarantine(self, cart):
+        """
+        Forget a cart the database refuses, unless it changed since, it's
+        served from SQL again. Its changes are only logged.
+        """
+        logger.error('Cart store dropped cart of user %s that can\'t be '
+                     'written: %s', cart.user_id, cart.to_json())
+        self.flush_stats.quarantine()
+        self.mark_clean(cart.user_id, cart.version, cart.removed, drop=True)
+
+    def mark_clean(self, user_id, version, removed, drop=False):
+        """
+        Record that the cart was written at the given version, unless it
+        changed since.
+        """
+        with self.locked(user_id):
+            cart = self._get(user_id)
+            if cart is None:
+                return
+            if drop and cart.version == version:
+                self._drop(user_id)
+                return
+            cart.removed = [item_id for item_id in cart.removed
+                            if item_id not in removed]
+            if cart.version == version:
+                cart.dirty = False
+            self._put(cart)
+
+    def _start_flusher(self):
+        if self._flusher is not None:
+            return
+        app = current_app._get_current_object()
+        with _flusher_lock:
+            if self._flusher is None:
+                self._flusher = threading.Thread(
+                    target=self._flush_every_interval, args=(app,),
+                    name='cart-store-flusher', daemon=True)
+                self._flusher.start()
+                atexit.register(self.close, app)
+
+    def _flush_every_interval(self, app):
+        while not self._closed.wait(self.flush_interval):
+            with app.app_context():
+                try:
+                    self.flush()
+                except Exception:
+                    logger.exception('Cart store flush failed')
+                finally:
+                    db.session.remove()
+
+    def close(self, app=None):
+        """
+        Stop the flusher, writing dirty carts a last time if an app is given.
+        """
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        if app is not None:
+            with app.app_context():
+                self.flush()
+                db.session.remove()
+
+    def stats(self):
+        return {
+            'backend': self.name,
+            'carts': len(self),
+            'dirty': self._dirty_count(),
+            'flush_interval': self.flush_interval,
+            'flushes': self.flush_stats.flushes,
+            'flushed_carts': self.flush_stats.carts,
+            'flush_errors': self.flush_stats.errors,
+            'quarantined_carts': self.flush_stats.quarantined,
+            'last_flush_ms': self.flush_stats.last_flush_ms,
+        }
+
+
+_flusher_lock = threading.Lock()
+
+
+class MemoryCartStore(CartStore):
+    """
+    Carts in a dict of this process, locked per user.
+    """
+
+    name = 'memory'
+    LOCKS = 64
+
+    def __init__(self, config):
+        super(MemoryCartStore, self).__init__(config)
+        self._carts = {}
+        self._locks = [threading.RLock() for _ in range(self.LOCKS)]
+
+    @contextmanager
+    def locked(self, user_id):
+        with self._locks[user_id % self.LOCKS]:
+            yield
+
+    def _get(self, user_id):
+        return self._carts.get(user_id)
+
+    def _put(self, cart):
+        self._carts[cart.user_id] = cart
+
+    def _drop(self, user_id):
+        self._carts.pop(user_id, None)
+
+    def _dirty(self):
+        carts = []
+        for cart in list(self._carts.values()):
+            with self.locked(cart.user_id):
+                if cart.dirty:
+                    carts.append(cart.copy())
+        return carts
+
+    def _dirty_count(self):
+        return sum(cart.dirty for cart in list(self._carts.values()))
+
+    def _evict_idle(self, before):
+        for cart in list(self._carts.values()):
+            with self.locked(cart.user_id):
+                if not cart.dirty and cart.touched < before:
+                    self._drop(cart.user_id)
+
+    def __len__(self):
+        return len(self._carts)
+
+
+class KeyValueCartStore(CartStore):
+    """
+    Carts as JSON values of a SQLite file at CART_STORE_PATH, one connection
+    per thread. Mutations hold the file's write lock, which serializes them
+    across the processes of the host.
+    """
+
+    name = 'kv'
+
+    def __init__(self, config):
+        super(KeyValueCartStore, self).__init__(config)
+        self.path = config['CART_STORE_PATH']
+        self._local = threading.local()
+        self._connection().execute(
+            'CREATE TABLE IF NOT EXISTS carts (user_id INTEGER PRIMARY KEY, '
+            'value TEXT NOT NULL, dirty INTEGER NOT NULL, '
+            'touched REAL NOT NULL)')
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = sqlite3.connect(
+                self.path, timeout=30, isolation_level=None)
+            self._local.depth = 0
+        return connection
+
+    @contextmanager
+    def locked(self, user_id):
+        connection = self._connection()
+        if self._local.depth:
+            # Nested in a locked() block of the same thread
+            self._local.depth += 1
+            try:
+                yield
+            finally:
+                self._local.depth -= 1
+            return
+        connection.execute('BEGIN IMMEDIATE')
+        self._local.depth = 1
+        try:
+            yield
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        else:
+            connection.execute('COMMIT')
+        finally:
+            self._local.depth = 0
+
+    def _get(self, user_id):
+        row = self._connection().execute(
+            'SELECT value FROM carts WHERE user_id = ?', (user_id,)).fetchone()
+        return StoredCart.from_json(row[0]) if row else None
+
+    def _put(self, cart):
+        self._connection().execute(
+            'INSERT OR REPLACE INTO carts VALUES (?, ?, ?, ?)',
+            (cart.user_id, cart.to_json(), cart.dirty, cart.touched))
+
+    def _drop(self, user_id):
+        self._connection().execute('DELETE FROM carts WHERE user_id = ?',
+                                   (user_id,))
+
+    def _dirty(self):
+        rows = self._connection().execute(
+            'SELECT value FROM carts WHERE dirty')
+        return [StoredCart.from_json(value) for value, in rows]
+
+    def _dirty_count(self):
+        return self._connection().execute(
+            'SELECT count(*) FROM carts WHERE dirty').fetchone()[0]
+
+    def _evict_idle(self, before):
+        self._connection().execute(
+            'DELETE FROM carts WHERE NOT dirty AND touched < ?', (before,))
+
+    def __len__(self):
+        return self._connection().execute(
+            'SELECT count(*) FROM carts').fetchone()[0]
+
+
+BACKENDS = {store.name: store
+            for store in (MemoryCartStore, KeyValueCartStore)}
+
+
+def init_app(app):
+    """
+    Create the store configured by CART_STORE, None disables it.
+    """
+    name = app.config['CART_STORE']
+    store = BACKENDS[name](app.config) if name else None
+    app.extensions['cart_store'] = store
+    return store
+
+
+def cart_store():
+    """
+    :return: CartStore of the current app, None if carts are served from SQL
+    """
+    return current_app.extensions.get('cart_store')
+
+
+def stats():
+    store = cart_store()
+    return store.stats() if store is not None else None
+
+
+@event.listens_for(Session, 'after_commit')
+def mark_written_clean(session):
+    session.info.pop(_ADDED, None)
+    written = session.info.pop(_WRITTEN, ())
+    for store, user_id, version, removed, drop in written:
+        store.mark_clean(user_id, version, removed, drop)
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_written(session):
+    # Latest first, each add is taken back from the cart as it left it
+    added = session.info.pop(_ADDED, ())
+    for store, user_id, item_id, version, before in reversed(added):
+        store._undo_add(user_id, item_id, version, before)
+    # Written through, the store is ahead of the database now, reload those
+    # carts from it
+    written = session.info.pop(_WRITTEN, ())
+    for store, user_id, version, removed, drop in written:
+        if not drop:
+            with store.locked(user_id):
+                store._drop(user_id)
@@ -0,0 +1,196 @@
+# project/server/catalog.py
+
+
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from types import MappingProxyType
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+from project.server import db
+from project.server.models import Product, CatalogVersion
+
+ProductRecord = namedtuple('ProductRecord', ['id', 'title', 'price', 'bogof'])
+
+_CHANGED = 'catalog_changed'
+
+
+class CatalogSnapshot(object):
+    """
+    Immutable view of all products at one catalog version, ordered by id.
+    """
+
+    def __init__(self, version, products, previous=None):
+        self.version = version
+        self.products = MappingProxyType(
+            OrderedDict((product.id, product) for product in products))
+        self._price_table = None
+        self._search_index = None
+        # Snapshot with a search index to derive this one's from
+        if previous is not None and previous._search_index is None:
+            previous = None
+        self._previous = previous
+
+    def __iter__(self):
+        return iter(self.products.values())
+
+    def __len__(self):
+        return len(self.products)
+
+    def get(self, product_id):
+        """
+        :return: ProductRecord, None for unknown or malformed ids
+        """
+        try:
+            return self.products.get(int(product_id))
+        except (TypeError, ValueError):
+            return None
+
+    @property
+    def price_table(self):
+        """Columnar prices for the quote engine, built on first use."""
+        if self._price_table is None:
+            from project.server.main.pricing import PriceTable
+            self._price_table = PriceTable.from_rows(
+                (p.id, p.price, p.bogof) for p in self)
+        return self._price_table
+
+    @property
+    def search_index(self):
+        """
+        Title PrefixIndex for the memory search backend, built on first use.
+        Derived from the index of the previous snapshot if it had one.
+        """
+        if self._search_index is None:
+            from project.server.search import PrefixIndex
+            previous, self._previous = self._previous, None
+            if previous is not None:
+                self._search_index = previous._search_index.updated(
+                    previous, self)
+            else:
+                self._search_index = PrefixIndex.from_products(self)
+        return self._search_index
+
+
+class Catalog(object):
+    """
+    Per process product catalog cache.
+
+    The snapshot is reloaded when catalog_version differs from its version.
+    That check runs at most every CATALOG_VERSION_CHECK_INTERVAL seconds,
+    changes committed by this process invalidate the snapshot immediately.
+    """
+
+    def __init__(self):
+        self.check_interval = 0
+        self._snapshot = None
+        # Invalidated snapshot, the next one derives its search index from it
+        self._stale = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+        self.loads = 0
+
+    def init_app(self, app):
+        self.check_interval = app.config['CATALOG_VERSION_CHECK_INTERVAL']
+
+    def snapshot(self):
+        snapshot = self._snapshot
+        now = time.monotonic()
+        if (snapshot is not None and
+                now - self._checked_at < self.check_interval):
+            return snapshot
+        version = current_version()
+        if snapshot is None or snapshot.version != version:
+            with self._lock:
+                snapshot = self._snapshot
+                if snapshot is None or snapshot.version != version:
+                    snapshot = self._snapshot = self._load(version)
+        self._checked_at = now
+        return snapshot
+
+    def get(self, product_id):
+        return self.snapshot().get(product_id)
+
+    def invalidate(self):
+        self._stale = self._snapshot or self._stale
+        self._snapshot = None
+
+    def refresh(self):
+        self.invalidate()
+        return self.snapshot()
+
+    def _load(self, version):
+        self.loads += 1
+        rows = db.session.query(
+            Product.id, Product.title, Product.price, Product.bogof
+        ).order_by(Product.id)
+        previous = self._snapshot or self._stale
+        self._stale = None
+        return CatalogSnapshot(
+            version, [ProductRecord(*row) for row in rows], previous)
+
+    def stats(self):
+        snapshot = self._snapshot
+        return {
+            'version': snapshot.version if snapshot else None,
+            'products': len(snapshot) if snapshot else None,
+            'loads': self.loads,
+            'check_interval': self.check_interval,
+        }
+
+
+catalog = Catalog()
+
+
+def current_version():
+    row = db.session.query(CatalogVersion.version).filter(
+        CatalogVersion.id == CatalogVersion.ROW_ID).first()
+    return row.version if row else 0
+
+
+def bump_version(connection):
+    """
+    Increment the catalog version in the transaction of the given connection.
+    """
+    table = CatalogVersion.__table__
+    updated = connection.execute(
+        table.update().where(table.c.id == CatalogVersion.ROW_ID).values(
+            version=table.c.version + 1))
+    if not updated.rowcount:
+        connection.execute(table.insert().values(id=CatalogVersion.ROW_ID,
+                                                 version=1))
+
+
+@event.listens_for(Product, 'after_insert')
+@event.listens_for(Product, 'after_delete')
+def product_changed(mapper, connection, target):
+    bump_version(connection)
+    object_session(target).info[_CHANGED] = True
+
+
+@event.listens_for(Product, 'after_update')
+def product_updated(mapper, connection, target):
+    # Also fired for dirty instances without net changes
+    if object_session(target).is_modified(target):
+        product_changed(mapper, connection, target)
+
+
+@event.listens_for(Session, 'after_bulk_update')
+@event.listens_for(Session, 'after_bulk_delete')
+def products_changed(context):
+    if context.mapper.class_ is Product:
+        bump_version(context.session.connection())
+        context.session.info[_CHANGED] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_on_commit(session):
+    if session.info.pop(_CHANGED, False):
+        catalog.invalidate()
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_on_rollback(session):
+    session.info.pop(_CHANGED, None)
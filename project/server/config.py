@@ -5,14 +5,102 @@ import os
 basedir = os.path.abspath(os.path.dirname(__file__))
 
 
+def env_int(name, default=None):
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+def env_bool(name, default=False):
+    value = os.getenv(name)
+    return value.lower() in ('1', 'true', 'yes') if value else default
+
+
 class BaseConfig(object):
     """Base configuration."""
     APP_NAME = os.getenv('APP_NAME', 'meneto')
     BCRYPT_LOG_ROUNDS = 4
+    # Calibrate BCRYPT_LOG_ROUNDS at startup to hash in about this many ms,
+    # see project/server/user/hashing.py
+    BCRYPT_TARGET_MS = env_int('BCRYPT_TARGET_MS')
+    BCRYPT_MIN_ROUNDS = env_int('BCRYPT_MIN_ROUNDS', 10)
+    BCRYPT_MAX_ROUNDS = env_int('BCRYPT_MAX_ROUNDS', 16)
+    # Password hashing processes, 0 hashes in the request thread
+    PASSWORD_HASH_WORKERS = env_int('PASSWORD_HASH_WORKERS', 0)
+    # Hashes running or queued before logins and registrations get a 503
+    PASSWORD_HASH_QUEUE = env_int('PASSWORD_HASH_QUEUE', 8)
+    PASSWORD_HASH_TIMEOUT = float(os.getenv('PASSWORD_HASH_TIMEOUT', 5))
     DEBUG_TB_ENABLED = False
     SECRET_KEY = os.getenv('SECRET_KEY', 'my_precious')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     WTF_CSRF_ENABLED = False
+    # In-process API token -> user id cache
+    API_TOKEN_CACHE_SIZE = int(os.getenv('API_TOKEN_CACHE_SIZE', 10000))
+    API_TOKEN_CACHE_TTL = int(os.getenv('API_TOKEN_CACHE_TTL', 300))
+    # In-process user id -> session identity cache, see
+    # project/server/user/identity.py
+    USER_IDENTITY_CACHE_SIZE = int(
+        os.getenv('USER_IDENTITY_CACHE_SIZE', 10000))
+    USER_IDENTITY_CACHE_TTL = int(os.getenv('USER_IDENTITY_CACHE_TTL', 60))
+    CART_OPS_MAX_OPERATIONS = int(os.getenv('CART_OPS_MAX_OPERATIONS', 1000))
+    # GET /api/products page sizes, also the first page of the storefront
+    PRODUCTS_PAGE_SIZE = int(os.getenv('PRODUCTS_PAGE_SIZE', 50))
+    PRODUCTS_PAGE_MAX = int(os.getenv('PRODUCTS_PAGE_MAX', 500))
+    # Rows fetched per round trip when streaming products as NDJSON
+    PRODUCTS_STREAM_BATCH = int(os.getenv('PRODUCTS_STREAM_BATCH', 1000))
+    # auto, fts5, trigram or memory, see project/server/search.py
+    PRODUCT_SEARCH_BACKEND = os.getenv('PRODUCT_SEARCH_BACKEND', 'auto')
+    PRODUCT_SEARCH_LIMIT = int(os.getenv('PRODUCT_SEARCH_LIMIT', 20))
+    # Matches ranked per search query at most
+    PRODUCT_SEARCH_CANDIDATES = int(
+        os.getenv('PRODUCT_SEARCH_CANDIDATES', 1000))
+    # Seconds between checks of other processes' catalog changes
+    CATALOG_VERSION_CHECK_INTERVAL = float(
+        os.getenv('CATALOG_VERSION_CHECK_INTERVAL', 1))
+    # API unit of work, see project/server/main/transactions.py
+    API_ISOLATION_LEVEL = os.getenv('API_ISOLATION_LEVEL')
+    API_TRANSACTION_RETRIES = int(os.getenv('API_TRANSACTION_RETRIES', 3))
+    API_TRANSACTION_RETRY_BACKOFF = float(
+        os.getenv('API_TRANSACTION_RETRY_BACKOFF', 0.01))
+    # Report SQL count and time of every request in a Server-Timing header
+    SQL_SERVER_TIMING = env_bool('SQL_SERVER_TIMING')
+    # Connection pool, see project/server/database.py. None keeps SQLAlchemy's
+    # defaults, SQLite files aren't pooled unless SQLALCHEMY_POOL_SIZE is set
+    SQLALCHEMY_POOL_SIZE = env_int('SQLALCHEMY_POOL_SIZE')
+    SQLALCHEMY_MAX_OVERFLOW = env_int('SQLALCHEMY_MAX_OVERFLOW')
+    SQLALCHEMY_POOL_TIMEOUT = env_int('SQLALCHEMY_POOL_TIMEOUT')
+    SQLALCHEMY_POOL_RECYCLE = env_int('SQLALCHEMY_POOL_RECYCLE')
+    # Test connections before use, replaces connections dropped by a failover
+    SQLALCHEMY_POOL_PRE_PING = env_bool('SQLALCHEMY_POOL_PRE_PING')
+    # Milliseconds, PostgreSQL only
+    DATABASE_STATEMENT_TIMEOUT = env_int('DATABASE_STATEMENT_TIMEOUT')
+    # Open the pool and run the hot statements before the first request of a
+    # process
+    DATABASE_WARMUP = env_bool('DATABASE_WARMUP')
+    # Hot cart store, see project/server/cartstore.py: memory, kv or None for
+    # SQL only
+    CART_STORE = os.getenv('CART_STORE') or None
+    CART_STORE_PATH = os.getenv('CART_STORE_PATH',
+                                os.path.join(basedir, 'carts.kv'))
+    # Seconds between writes of dirty carts to the database, 0 writes through
+    CART_STORE_FLUSH_INTERVAL = float(
+        os.getenv('CART_STORE_FLUSH_INTERVAL', 1))
+    CART_STORE_FLUSH_BATCH = int(os.getenv('CART_STORE_FLUSH_BATCH', 500))
+    # Clean carts untouched for this long are dropped from the store
+    CART_STORE_IDLE_SECONDS = int(os.getenv('CART_STORE_IDLE_SECONDS', 1800))
+    # Seconds updates of the same cart are collected and applied together, 0
+    # disables, see project/server/main/coalescing.py
+    CART_UPDATE_COALESCE_WINDOW = float(
+        os.getenv('CART_UPDATE_COALESCE_WINDOW', 0))
+    # Seconds a coalesced update waits for its batch before answering 503
+    CART_UPDATE_COALESCE_TIMEOUT = float(
+        os.getenv('CART_UPDATE_COALESCE_TIMEOUT', 10))
+    # Reprice carts when a product's price or BOGOF flag changes, see
+    # project/server/repricing.py
+    CART_REPRICE_ON_PRODUCT_UPDATE = env_bool('CART_REPRICE_ON_PRODUCT_UPDATE')
+    CART_REPRICE_CHUNK_SIZE = env_int('CART_REPRICE_CHUNK_SIZE', 500)
+    # Cold start budgets in ms, see `python manage.py import-time`
+    STARTUP_BUDGET_APP_MS = env_int('STARTUP_BUDGET_APP_MS', 1500)
+    STARTUP_BUDGET_CLI_MS = env_int('STARTUP_BUDGET_CLI_MS', 2000)
 
 
 class DevelopmentConfig(BaseConfig):
@@ -35,5 +123,14 @@ class TestingConfig(BaseConfig):
 class ProductionConfig(BaseConfig):
     """Production configuration."""
     BCRYPT_LOG_ROUNDS = 13
+    BCRYPT_MIN_ROUNDS = env_int('BCRYPT_MIN_ROUNDS', 12)
+    PASSWORD_HASH_WORKERS = env_int('PASSWORD_HASH_WORKERS', 2)
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL')
+    SQLALCHEMY_POOL_SIZE = env_int('SQLALCHEMY_POOL_SIZE', 10)
+    SQLALCHEMY_MAX_OVERFLOW = env_int('SQLALCHEMY_MAX_OVERFLOW', 20)
+    SQLALCHEMY_POOL_TIMEOUT = env_int('SQLALCHEMY_POOL_TIMEOUT', 10)
+    SQLALCHEMY_POOL_RECYCLE = env_int('SQLALCHEMY_POOL_RECYCLE', 1800)
+    SQLALCHEMY_POOL_PRE_PING = env_bool('SQLALCHEMY_POOL_PRE_PING', True)
+    DATABASE_STATEMENT_TIMEOUT = env_int('DATABASE_STATEMENT_TIMEOUT', 30000)
+    DATABASE_WARMUP = env_bool('DATABASE_WARMUP', True)
     WTF_CSRF_ENABLED = True
@@ -0,0 +1,152 @@
+# project/server/database.py
+
+
+import bisect
+import threading
+import time
+
+import flask_sqlalchemy
+from sqlalchemy.exc import DBAPIError, TimeoutError
+from sqlalchemy.pool import QueuePool
+
+# Upper bounds of the checkout wait histogram buckets in ms, the last one is
+# open
+WAIT_BUCKETS = (1, 5, 10, 50, 100, 500, 1000)
+
+
+class PoolStats(object):
+    """
+    Connection checkout waits of TimedQueuePool, served as /api/_metrics/pool.
+    Pool size and usage are those of the last created pool, pools recreated
+    after a disconnect replace their predecessor.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.pool = None
+        self.reset()
+
+    def reset(self):
+        self.checkouts = self.timeouts = 0
+        self.wait_seconds = self.wait_seconds_max = 0.0
+        self.histogram = [0] * (len(WAIT_BUCKETS) + 1)
+        self.warmup = None
+
+    def waited(self, seconds, timed_out=False):
+        bucket = bisect.bisect_left(WAIT_BUCKETS, seconds * 1000)
+        with self._lock:
+            self.checkouts += not timed_out
+            self.timeouts += timed_out
+            self.wait_seconds += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+            self.histogram[bucket] += 1
+
+    def stats(self):
+        pool = self.pool
+        waits = self.checkouts + self.timeouts
+        labels = (['<=%s' % bound for bound in WAIT_BUCKETS] +
+                  ['>%s' % WAIT_BUCKETS[-1]])
+        return {
+            'size': pool.size() if pool else None,
+            'checked_out': pool.checkedout() if pool else None,
+            'overflow': pool.overflow() if pool else None,
+            'checkouts': self.checkouts,
+            'timeouts': self.timeouts,
+            'wait_ms_avg': (round(self.wait_seconds / waits * 1000, 3)
+                            if waits else None),
+            'wait_ms_max': round(self.wait_seconds_max * 1000, 3),
+            'wait_ms_histogram': dict(zip(labels, self.histogram)),
+            'warmup': self.warmup,
+        }
+
+
+pool_stats = PoolStats()
+
+
+class TimedQueuePool(QueuePool):
+    """
+    QueuePool measuring how long checkouts wait for a connection, including
+    opening new ones. Only checkouts from the pool are timed, connections
+    reused by an ongoing transaction never wait.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(TimedQueuePool, self).__init__(*args, **kwargs)
+        pool_stats.pool = self
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super(TimedQueuePool, self)._do_get()
+        except TimeoutError:
+            pool_stats.waited(time.perf_counter() - started, timed_out=True)
+            raise
+        pool_stats.waited(time.perf_counter() - started)
+        return connection
+
+
+class SQLAlchemy(flask_sqlalchemy.SQLAlchemy):
+    """
+    Flask-SQLAlchemy reading the engine options it doesn't support itself
+    from config: SQLALCHEMY_POOL_PRE_PING and DATABASE_STATEMENT_TIMEOUT.
+    Pooled engines use TimedQueuePool.
+    """
+
+    def apply_driver_hacks(self, app, info, options):
+        super(SQLAlchemy, self).apply_driver_hacks(app, info, options)
+        if 'poolclass' not in options:
+            options['poolclass'] = TimedQueuePool
+        if app.config['SQLALCHEMY_POOL_PRE_PING']:
+            options['pool_pre_ping'] = True
+        timeout = app.config['DATABASE_STATEMENT_TIMEOUT']
+        if timeout and info.drivername.startswith('postgresql'):
+            options.setdefault('connect_args', {})['options'] = (
+                '-c statement_timeout=%d' % timeout)
+
+
+def warmup(app):
+    """
+    Open the pool's connections and run the statements of the hot paths once,
+    so the first requests don't pay for connecting, mapper compilation and the
+    catalog load.
+
+    :return: {'connections': n, 'statements': primed, 'ms': duration}
+    """
+    from project.server import db
+    from project.server.catalog import catalog
+    from project.server.loading import AUTH_ONLY, FULL_CART
+    from project.server.models import User, Cart
+    from project.server.user.tokens import user_id_for_token
+
+    started = time.perf_counter()
+    connected = 0
+    primed = False
+    with app.app_context():
+        try:
+            pool = db.engine.pool
+            connections = []
+            try:
+                size = pool.size() if isinstance(pool, QueuePool) else 1
+                for _ in range(size):
+                    connections.append(db.engine.connect())
+            finally:
+                connected = len(connections)
+                for connection in connections:
+                    connection.close()
+            catalog.snapshot()
+            user_id_for_token('warmup')
+            User.query.options(*AUTH_ONLY).get(0)
+            db.session.query(Cart.id, Cart.version).join(Cart.user).filter(
+                User.id == 0).first()
+            Cart.query.options(*FULL_CART).get(0)
+            primed = True
+        except DBAPIError as e:
+            # Database unavailable or tables not created yet, requests connect
+            # on demand
+            app.logger.warning('Database warmup failed: %s', e.orig)
+        finally:
+            db.session.remove()
+    duration = time.perf_counter() - started
+    pool_stats.warmup = {'connections': connected, 'statements': primed,
+                         'ms': round(duration * 1000, 3)}
+    return pool_stats.warmup
@@ -0,0 +1,33 @@
+# project/server/loading.py
+
+# Named loading profiles: the relationships a query loads up front, as query
+# options. Relationships are lazy by default, queries opt into the profile
+# matching the data they touch, e.g. Cart.query.options(*FULL_CART).
+# Add populate_existing() when the object may already be in the session,
+# otherwise it is returned as loaded before, without the profile's relations.
+
+from sqlalchemy.orm import (
+    configure_mappers, joinedload, selectinload, lazyload)
+
+from project.server.models import User, Cart, CartItem
+
+# Backrefs like Cart.user exist once mappers are configured
+configure_mappers()
+
+# User alone, e.g. authentication, the cart is loaded on access
+AUTH_ONLY = (lazyload(User.cart),)
+
+# User with the totals of the cart, no items
+USER_CART_SUMMARY = (joinedload(User.cart).joinedload(Cart.user),)
+
+# Cart totals and the owner's loyalty card, no items
+CART_SUMMARY = (joinedload(Cart.user), lazyload(Cart.cart_items))
+
+# Everything a serialized or repriced cart needs, items in a second query
+# instead of multiplying the cart row per item
+FULL_CART = (joinedload(Cart.user),
+             selectinload(Cart.cart_items).joinedload(CartItem.product))
+
+# Single item with its product, its cart and the cart owner for repricing
+CART_ITEM = (joinedload(CartItem.product),
+             joinedload(CartItem.cart).joinedload(Cart.user))
@@ -1,20 +1,38 @@
-from flask import g, request, Blueprint
+import json
+from decimal import Decimal, InvalidOperation, ROUND_CEILING, ROUND_FLOOR
+
+from flask import current_app, g, request, Response, stream_with_context
 from flask_api import status
 from flask_babel import gettext
 from flask_httpauth import HTTPTokenAuth
 from flask_login import current_user
 
-from project.server import db
-from project.server.main.serializers import CartSchema, CartItemSchema
-from project.server.main.utils import error_response, validation_error, update_cart
-from project.server.models import User, Cart, Product, CartItem
-from project.server.user import admin_user_token
+from project.server import db, metrics, search, cartstore
+from project.server.catalog import catalog
+from project.server.main.coalescing import coalesced_update, finish_request
+from project.server.loading import (
+    AUTH_ONLY, USER_CART_SUMMARY, FULL_CART, CART_ITEM)
+from project.server.main.transactions import TransactionalBlueprint
+from project.server.main.serializers import (
+    dump_cart, dump_cart_item, dump_product, load_cart_item_quantity)
+from project.server.main.utils import (
+    error_response, validation_error, reprice_cart_item, refresh_cart_total,
+    get_or_create_cart_id, add_cart_item, apply_cart_operations, cart_etag)
+from project.server.models import User, Product, Cart, CartItem
+from project.server.money import format_cents
+from project.server.user.identity import load_identity, set_loyalty_card
+from project.server.user.tokens import user_id_for_token
 
-api_blueprint = Blueprint('api', __name__, url_prefix='/api')
+# Every view runs in one transaction committed after it returned, views don't
+# commit
+api_blueprint = TransactionalBlueprint('api', __name__, url_prefix='/api')
 api_blueprint.config = {}
 
 auth = HTTPTokenAuth('Token')
 
+# Release the cart item updates coalesced into this request's batch
+api_blueprint.teardown_request(finish_request)
+
 
 @api_blueprint.record
 def record_params(setup_state):
@@ -27,30 +45,83 @@ def record_params(setup_state):
 def authenticate(token):
     """
     Combine session auth and token auth by checking token or current_user.
+    Only the user id is resolved, token lookups are cached so most requests
+    don't query the database here. Use get_user() for the User itself.
 
     :param token: value from HTTP Header "Authentication: Token <value>"
     :return: True in case of success, False otherwise which raises 401
     """
-    if token == admin_user_token or current_user.is_authenticated:
-        # Hardcoded user to avoid extra time investment into storing/generating tokens.
-        g.user = User.query.filter_by(email='ad@min.com').first()
+    user_id = user_id_for_token(token) if token else None
+    if user_id is not None:
+        g.user_id = user_id
+        return True
+    if current_user.is_authenticated:
+        # A cached SessionUser, not the User
+        g.user_id = current_user.id
         return True
     return False
 
 
+def get_user():
+    """
+    Authenticated User, loaded on first use.
+    """
+    if 'user' not in g:
+        g.user = User.query.options(*AUTH_ONLY).get(g.user_id)
+    return g.user
+
+
 @api_blueprint.route("/cart", methods=['GET'])
 @auth.login_required
 def get_cart():
     """
     Get serialized Cart data with nested relations.
     Only current user cart is available.
+    Supports conditional requests: `If-None-Match` with the current ETag is
+    answered with 304 after a single lookup of the cart version.
     :return:
     """
-    user = g.user
-    cart = Cart.query.filter_by(user=user).first()
-    if not cart:
+    store = cartstore.cart_store()
+    if store is not None:
+        return stored_cart_response(store.get(g.user_id))
+    row = db.session.query(Cart.id, Cart.version).join(Cart.user).filter(
+        User.id == g.user_id).first()
+    if not row:
+        return error_response(status.HTTP_404_NOT_FOUND)
+    headers = {'Cache-Control': 'private, no-cache'}
+    etag = cart_etag(row.id, row.version, catalog.snapshot().version)
+    if request.if_none_match.contains(etag):
+        headers['ETag'] = '"%s"' % etag
+        return '', status.HTTP_304_NOT_MODIFIED, headers
+    cart = Cart.query.options(*FULL_CART).populate_existing().get(row.id)
+    # Version of the loaded cart, it may have changed since the lookup
+    etag = cart_etag(cart.id, cart.version, catalog.snapshot().version)
+    headers['ETag'] = '"%s"' % etag
+    return dump_cart(cart), status.HTTP_200_OK, headers
+
+
+def stored_cart_response(cart):
+    """
+    get_cart() response of a CartRecord from the cart store.
+    """
+    if cart is None:
         return error_response(status.HTTP_404_NOT_FOUND)
-    return CartSchema().dump(cart).data
+    headers = {'Cache-Control': 'private, no-cache'}
+    etag = cart_etag(cart.id, cart.version, catalog.snapshot().version)
+    headers['ETag'] = '"%s"' % etag
+    if request.if_none_match.contains(etag):
+        return '', status.HTTP_304_NOT_MODIFIED, headers
+    return dump_cart(cart), status.HTTP_200_OK, headers
+
+
+def user_cart_item(pk):
+    """
+    :return: CartItem of the current user's cart, None for other ids like
+        the cart store and coalesced updates
+    """
+    return CartItem.query.options(*CART_ITEM).populate_existing().join(
+        User, User.cart_id == CartItem.cart_id).filter(
+        CartItem.id == pk, User.id == g.user_id).first()
 
 
 @api_blueprint.route("/cart_item", methods=['POST'])
@@ -59,7 +130,8 @@ def add_to_cart():
     """
     Receive a POST with only Product.ID, this is the only required field to remove the calculations from front-end.
 
-    Creates CartItem with given product and Cart if needed.
+    Creates CartItem with given product and Cart if needed,
+    otherwise atomically increments its quantity.
 
     Example:
 
@@ -71,34 +143,73 @@ def add_to_cart():
     """
     result = {}
     product_id = request.data.get('product', -1)
-    product = Product.query.get(product_id)
-    user = g.user
+    product = catalog.get(product_id)
 
     if not product:
         return validation_error('product', gettext('Please specify a valid product id'))
-    cart = Cart.query.filter_by(user=user).first()
-    if not cart:
-        cart = Cart(user=user)
-    cart_item = CartItem.query.filter_by(cart=cart, product=product).first()
-    if not cart_item:
-        cart_item = CartItem(product=product, cart=cart, quantity=1, price=product.price)
-    else:
-        cart_item.quantity += 1
-    # Increment item quantity, calculate cart.total and cart_item.price
-    update_cart(cart, cart_item)
-    db.session.add(cart_item)
-    db.session.commit()
+    store = cartstore.cart_store()
+    if store is not None:
+        result['data'] = dump_cart_item(store.add(g.user_id, product))
+        return result, status.HTTP_201_CREATED
+    user = get_user()
+    cart_id = get_or_create_cart_id(user)
+    # Atomic upsert of the line and delta update of the cart totals
+    cart_item_id = add_cart_item(cart_id, product, user.loyalty_card)
 
-    result['data'] = CartItemSchema().dump(cart_item).data
+    # The upsert bypassed the session, don't serialize a stale instance
+    result['data'] = dump_cart_item(CartItem.query.options(
+        *CART_ITEM).populate_existing().get(cart_item_id))
     return result, status.HTTP_201_CREATED
 
 
+@api_blueprint.route("/cart/ops", methods=['POST'])
+@auth.login_required
+def cart_operations():
+    """
+    Apply many cart changes in one transaction with a single repricing pass,
+    e.g. offline edits of mobile clients or bulk orders.
+    Operations are applied in order, if any of them is invalid nothing is
+    applied and the error names the operation index.
+    Example:
+    POST /api/cart/ops
+    {
+        "operations": [
+            {"action": "add", "product": 1, "quantity": 3},
+            {"action": "subtract", "product": 1},
+            {"action": "remove", "product": 2}
+        ]
+    }
+    :return: Cart json
+    """
+    operations = request.data.get('operations')
+    if not isinstance(operations, list) or not operations:
+        return validation_error('operations', gettext(
+            'Please specify a list of operations'))
+    limit = current_app.config['CART_OPS_MAX_OPERATIONS']
+    if len(operations) > limit:
+        return validation_error('operations', gettext(
+            'At most %(limit)s operations are allowed', limit=limit))
+    store = cartstore.cart_store()
+    if store is not None:
+        # Applied in SQL, the store reloads the cart afterwards
+        store.evict(g.user_id)
+    cart = Cart.query.options(*FULL_CART).populate_existing().get(
+        get_or_create_cart_id(get_user()))
+    apply_cart_operations(cart, operations)
+    # Reload with the products of new items and the total as stored,
+    # populate_existing() skips the autoflush
+    db.session.flush()
+    cart = Cart.query.options(*FULL_CART).populate_existing().get(cart.id)
+    return dump_cart(cart), status.HTTP_200_OK
+
+
 @api_blueprint.route("/cart_item/<int:pk>/", methods=['PUT', 'PATCH'])
 @auth.login_required
 def update_cart_item(pk):
     """
     Updated specified CartItem. Used to increment/decrement item quantity in Cart.
-    Can be partial update.
+    Can be partial update. Only quantity is read, price and product are
+    derived on the server.
     Example:
     PUT /api/cart_item/2/
      {
@@ -115,23 +226,43 @@ def update_cart_item(pk):
     :param pk: CartItem.id
     :return: CartItem json
     """
-
-    ci = CartItem.query.get(pk)
-    data = request.data
-    partial = True
-    if request.method == 'PUT':
-        partial = False
-    schema = CartItemSchema().load(data, instance=ci, partial=partial)
-    cart_item = schema.data
-    cart = update_cart(cart_item.cart, cart_item)
+    store = cartstore.cart_store()
+    if store is not None:
+        quantity = load_cart_item_quantity(
+            request.data, partial=request.method == 'PATCH')
+        try:
+            cart_item = store.update(g.user_id, pk, quantity)
+        except KeyError:
+            return error_response(status.HTTP_404_NOT_FOUND)
+        data = dump_cart_item(cart_item) if cart_item else {}
+        return data, status.HTTP_200_OK
+    window = current_app.config['CART_UPDATE_COALESCE_WINDOW']
+    if window:
+        quantity = load_cart_item_quantity(
+            request.data, partial=request.method == 'PATCH')
+        timeout = current_app.config['CART_UPDATE_COALESCE_TIMEOUT']
+        try:
+            data = coalesced_update(g.user_id, pk, quantity, window, timeout)
+        except RuntimeError:
+            return error_response(status.HTTP_503_SERVICE_UNAVAILABLE)
+        if data is None:
+            return error_response(status.HTTP_404_NOT_FOUND)
+        return data, status.HTTP_200_OK
+    cart_item = user_cart_item(pk)
+    if not cart_item:
+        return error_response(status.HTTP_404_NOT_FOUND)
+    quantity = load_cart_item_quantity(request.data,
+                                       partial=request.method == 'PATCH')
+    if quantity is not None:
+        cart_item.quantity = quantity
+    cart = reprice_cart_item(cart_item.cart, cart_item)
     if cart_item.quantity > 0:
         db.session.add(cart_item)
-        data = CartItemSchema().dump(cart_item).data
+        data = dump_cart_item(cart_item)
     else:
         db.session.delete(cart_item)
         db.session.add(cart)
         data = {}
-    db.session.commit()
     return data, status.HTTP_200_OK
 
 
@@ -147,16 +278,184 @@ def remove_cart_item(pk):
     :return
     """
     result = {'status': 'ok'}
-    ci = CartItem.query.get(pk)
-    cart = ci.cart
+    store = cartstore.cart_store()
+    if store is not None:
+        try:
+            store.remove(g.user_id, pk)
+        except KeyError:
+            return error_response(status.HTTP_404_NOT_FOUND)
+        return result, status.HTTP_200_OK
+    ci = user_cart_item(pk)
+    if not ci:
+        return error_response(status.HTTP_404_NOT_FOUND)
+    cart = reprice_cart_item(ci.cart, ci, removed=True)
     db.session.delete(ci)
-    db.session.commit()
-    cart = update_cart(cart)
     db.session.add(cart)
-    db.session.commit()
     return result, status.HTTP_200_OK
 
 
+@api_blueprint.route("/quote", methods=['POST'])
+@auth.login_required
+def quote():
+    """
+    Price a batch of hypothetical baskets without creating any Cart.
+    Same rules as update_cart(): BOGOF, -10% over 20 and -2% for loyalty cards.
+    `loyalty_card` is either one flag for all baskets or a list with a flag
+    per basket.
+    Quantities range from 0 to MAX_QUANTITY of pricing.py.
+    Example:
+    POST /api/quote
+    {
+        "baskets": [[[1, 2], [3, 1]], [[2, 5]]],
+        "loyalty_card": false
+    }
+    :return: subtotal and total for every basket, in request order
+    """
+    # Imports numpy, deferred until the first quote
+    from project.server.main.pricing import MAX_QUANTITY, quote_baskets
+
+    baskets = request.data.get('baskets')
+    if not isinstance(baskets, list) or not all(
+            isinstance(basket, list) for basket in baskets):
+        return validation_error('baskets', gettext(
+            'Please specify a list of baskets'))
+    try:
+        quotes = quote_baskets(baskets,
+                               request.data.get('loyalty_card', False),
+                               catalog.snapshot().price_table)
+    except KeyError as e:
+        return validation_error('baskets', gettext(
+            'Unknown product id %(id)s', id=e.args[0]))
+    except (TypeError, ValueError):
+        return validation_error('baskets', gettext(
+            'Baskets must be lists of [product, quantity] pairs, '
+            'quantities from 0 to %(max)s', max=MAX_QUANTITY))
+    except OverflowError:
+        return validation_error('baskets', gettext(
+            'Baskets are too expensive to quote'))
+    data = [{'subtotal': format_cents(q['subtotal']),
+             'total': format_cents(q['total'])} for q in quotes]
+    return {'data': data}, status.HTTP_200_OK
+
+
+NDJSON = 'application/x-ndjson'
+
+
+def _int_arg(name, default=None, minimum=0, maximum=None):
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        value = None
+    if value is None or value < minimum or (
+            maximum is not None and value > maximum):
+        validation_error(name, gettext('Please specify a valid %(name)s',
+                                       name=name))
+    return value
+
+
+def _price_arg(name, rounding):
+    """
+    :param rounding: of fractional pence, e.g. ROUND_CEILING for lower bounds
+    :return: price in pence
+    """
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        value = Decimal(value)
+    except InvalidOperation:
+        value = None
+    if value is None or not value.is_finite():
+        validation_error(name, gettext('Please specify a valid price'))
+    return int(value.scaleb(2).to_integral_value(rounding))
+
+
+def product_query():
+    """
+    Product rows matching the filters of the request, after the `after` id
+    in id order. Only the serialized columns are selected, no ORM instances
+    are built.
+    """
+    query = db.session.query(
+        Product.id, Product.title, Product.price, Product.bogof
+    ).filter(Product.id > _int_arg('after', default=0))
+    min_price = _price_arg('min_price', ROUND_CEILING)
+    max_price = _price_arg('max_price', ROUND_FLOOR)
+    if min_price is not None:
+        query = query.filter(Product.price >= min_price)
+    if max_price is not None:
+        query = query.filter(Product.price <= max_price)
+    bogof = request.args.get('bogof')
+    if bogof is not None:
+        if bogof.lower() not in ('1', 'true', '0', 'false'):
+            validation_error('bogof', gettext('Please specify true or false'))
+        query = query.filter(Product.bogof.is_(bogof.lower() in ('1', 'true')))
+    return query.order_by(Product.id)
+
+
+# Streamed rows are read after the view returned, a unit of work would
+# already have committed by then. Nothing is written here.
+@api_blueprint.route("/products", methods=['GET'], unit_of_work=False)
+def list_products():
+    """
+    Public product listing with keyset pagination on id, pass the `next` id of
+    a page as `after` to get the following one. `next` is null on the last
+    page.
+    Filters: min_price, max_price, bogof=true|false. Page size: limit.
+    Example:
+    GET /api/products?after=50&limit=50&bogof=true
+
+    With `format=ndjson` or `Accept: application/x-ndjson` every matching
+    product after the cursor is streamed as one JSON object per line from a
+    server side cursor instead, `limit` is then optional. The rows are read
+    while the response is sent, in the request's transaction, which isn't
+    retried.
+    :return: {"data": [product, ...], "next": id or null}
+    """
+    config = current_app.config
+    query = product_query()
+    if (request.args.get('format') == 'ndjson' or
+            request.accept_mimetypes.best == NDJSON):
+        limit = _int_arg('limit', minimum=1)
+        if limit is not None:
+            query = query.limit(limit)
+        rows = query.execution_options(stream_results=True).yield_per(
+            config['PRODUCTS_STREAM_BATCH'])
+        lines = (json.dumps(dump_product(row)) + '\n' for row in rows)
+        return Response(stream_with_context(lines), mimetype=NDJSON)
+    limit = _int_arg('limit', default=config['PRODUCTS_PAGE_SIZE'], minimum=1,
+                     maximum=config['PRODUCTS_PAGE_MAX'])
+    # One extra row tells whether there is a next page
+    rows = query.limit(limit + 1).all()
+    page = rows[:limit]
+    return {
+        'data': [dump_product(row) for row in page],
+        'next': page[-1].id if len(rows) > limit else None,
+    }, status.HTTP_200_OK
+
+
+@api_blueprint.route("/products/search", methods=['GET'])
+def search_products():
+    """
+    Public product search by title, every word of `q` has to start a word of
+    the title. Best matches first, at most `limit`.
+    Example:
+    GET /api/products/search?q=red ch
+    :return: {"data": [product, ...]}
+    """
+    config = current_app.config
+    query = request.args.get('q', '')
+    if not search.tokenize(query):
+        return validation_error('q', gettext('Please specify a search term'))
+    limit = _int_arg('limit', default=config['PRODUCT_SEARCH_LIMIT'],
+                     minimum=1, maximum=config['PRODUCTS_PAGE_MAX'])
+    rows = search.search(query, limit)
+    return {'data': [dump_product(row) for row in rows]}, status.HTTP_200_OK
+
+
 @api_blueprint.route("/user/<int:pk>/", methods=['PATCH'])
 @auth.login_required
 def toggle_loyalty_card(pk):
@@ -166,13 +465,36 @@ def toggle_loyalty_card(pk):
     :return:
     """
     result = {'card': None}
-    if g.user.id != pk:
+    if g.user_id != pk:
         return validation_error('id', gettext('Updating another user is not allowed'))
-    user = User.query.get(pk)
+    store = cartstore.cart_store()
+    if store is not None:
+        result['card'] = store.toggle_loyalty_card(pk)
+        set_loyalty_card(pk, result['card'])
+        return result, status.HTTP_200_OK
+    user = User.query.options(*USER_CART_SUMMARY).populate_existing().get(pk)
     result['card'] = user.loyalty_card = not user.loyalty_card
     if user.cart:
-        cart = update_cart(user.cart)
+        cart = refresh_cart_total(user.cart)
         db.session.add(cart)
     db.session.add(user)
-    db.session.commit()
     return result, status.HTTP_200_OK
+
+
+@api_blueprint.route("/_metrics/<name>", methods=['GET'])
+@auth.login_required
+def get_metrics(name):
+    """
+    In-process metrics of this worker, e.g. GET /api/_metrics/auth for the
+    token cache.
+    Admins only, they show statements and internals of the server.
+    :param name: metric source name
+    :return: current values
+    """
+    identity = load_identity(g.user_id)
+    if identity is None or not identity.admin:
+        return error_response(status.HTTP_403_FORBIDDEN)
+    data = metrics.collect(name)
+    if data is None:
+        return error_response(status.HTTP_404_NOT_FOUND)
+    return data, status.HTTP_200_OK
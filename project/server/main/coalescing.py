@@ -0,0 +1,166 @@
+# project/server/main/coalescing.py
+"""
+Coalescing of cart item updates, e.g. the +/- buttons of the storefront
+sending one request per click.
+
+With CART_UPDATE_COALESCE_WINDOW (seconds) set, the first update of a user's
+cart opens a batch and waits that long, updates of the same cart arriving
+meanwhile join it. The first request applies all of them in its transaction
+with one repricing per item and a single commit, the others wait for it and
+answer with the final state of their item. Batches are per process.
+"""
+
+
+import threading
+import time
+
+from flask import g
+
+from project.server import db
+from project.server.loading import CART_ITEM
+from project.server.main.serializers import dump_cart_item
+from project.server.main.transactions import (
+    begin_transaction, release_connection)
+from project.server.main.utils import reprice_cart_item
+from project.server.models import CartItem
+
+
+class UpdateBatch(object):
+    """
+    Updates of one user's cart, [(item id, quantity or None)] in arrival order.
+    """
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.updates = []
+        # item id -> dumped item, {} for removed items, None for unknown ones
+        self.results = None
+        self.done = threading.Event()
+
+
+class UpdateCoalescer(object):
+    """
+    Open batches by user id and counters, served as /api/_metrics/coalescing.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._open = {}
+        self.reset()
+
+    def reset(self):
+        self.batches = self.updates = self.coalesced = self.failed = 0
+        self.max_batch = 0
+
+    def join(self, user_id, pk, quantity):
+        """
+        Add an update to the open batch of the user, opening one if needed.
+
+        :return: (batch, True if the caller opened it and has to apply it)
+        """
+        with self._lock:
+            batch = self._open.get(user_id)
+            leader = batch is None
+            if leader:
+                batch = self._open[user_id] = UpdateBatch(user_id)
+                self.batches += 1
+            else:
+                self.coalesced += 1
+            batch.updates.append((pk, quantity))
+            self.updates += 1
+            return batch, leader
+
+    def close(self, batch):
+        """Stop accepting updates into the batch."""
+        with self._lock:
+            if self._open.get(batch.user_id) is batch:
+                del self._open[batch.user_id]
+            self.max_batch = max(self.max_batch, len(batch.updates))
+
+    def finish(self, batch, error=None):
+        """Release the waiting requests once the batch is done."""
+        if error is not None or batch.results is None:
+            batch.results = None
+            with self._lock:
+                self.failed += 1
+        batch.done.set()
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'updates': self.updates,
+            'coalesced': self.coalesced,
+            'failed': self.failed,
+            'max_batch': self.max_batch,
+        }
+
+
+coalescer = UpdateCoalescer()
+
+
+def apply_batch(batch):
+    """
+    Apply the updates of a batch in the current transaction: the last quantity
+    of every item wins, each item is repriced once. Items not in the user's
+    cart are skipped.
+
+    :return: {item id: dumped item, {} if removed, None if unknown}
+    """
+    pks = list(dict.fromkeys(pk for pk, _ in batch.updates))
+    query = CartItem.query.options(*CART_ITEM).populate_existing().filter(
+        CartItem.id.in_(pks))
+    items = {item.id: item for item in query
+             if item.cart.user is not None and
+             item.cart.user.id == batch.user_id}
+    for pk, quantity in batch.updates:
+        if pk in items and quantity is not None:
+            items[pk].quantity = quantity
+    results = {}
+    for pk in pks:
+        item = items.get(pk)
+        if item is None:
+            results[pk] = None
+            continue
+        cart = reprice_cart_item(item.cart, item)
+        if item.quantity > 0:
+            results[pk] = dump_cart_item(item)
+        else:
+            db.session.delete(item)
+            results[pk] = {}
+        db.session.add(cart)
+    return results
+
+
+def coalesced_update(user_id, pk, quantity, window, timeout):
+    """
+    Update a cart item through a batch, see the module docstring.
+
+    :return: dumped item, {} if removed, None if unknown
+    :raises RuntimeError: if the batch of another request failed or timed out
+    """
+    # A retried transaction applies the same batch again
+    batch = g.get('cart_update_batch')
+    if batch is None:
+        batch, leader = coalescer.join(user_id, pk, quantity)
+        # authenticate() may have checked out a connection, don't hold it
+        # idle while waiting
+        release_connection()
+        if not leader:
+            if not batch.done.wait(timeout) or batch.results is None:
+                raise RuntimeError('Coalesced cart update failed')
+            return batch.results[pk]
+        g.cart_update_batch = batch
+        time.sleep(window)
+        coalescer.close(batch)
+        begin_transaction()
+    batch.results = apply_batch(batch)
+    return batch.results[pk]
+
+
+def finish_request(error=None):
+    """
+    Teardown of requests: release the requests waiting for this one's batch.
+    """
+    batch = g.pop('cart_update_batch', None)
+    if batch is not None:
+        coalescer.finish(batch, error)
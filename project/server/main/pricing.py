@@ -0,0 +1,142 @@
+from numbers import Integral
+
+import numpy as np
+
+from project.server import db
+from project.server.main.utils import DISCOUNT_THRESHOLD, DISCOUNT_PERCENT, \
+    LOYALTY_PERCENT
+from project.server.models import Product
+
+# Quantities are bounded before they reach int64 arrays
+MAX_QUANTITY = 10 ** 6
+
+# Largest amount in pence whose total, scaled by the integer discounts of
+# quote_baskets(), still fits into int64
+MAX_AMOUNT = (np.iinfo(np.int64).max - 10000) // 20000
+
+
+def _line(line):
+    """
+    Validate a (product_id, quantity) pair, numpy would silently truncate
+    floats and parse strings.
+    """
+    product_id, quantity = line
+    for value in (product_id, quantity):
+        if not isinstance(value, Integral) or isinstance(value, bool):
+            raise ValueError('Expected integer, got %r' % (value,))
+    if not 0 <= quantity <= MAX_QUANTITY:
+        raise ValueError('Quantity out of range: %r' % (quantity,))
+    return product_id, quantity
+
+
+class PriceTable(object):
+    """
+    Columnar product prices: ``ids`` sorted ascending with aligned
+    ``cents`` (int64) and ``bogof`` (bool) arrays.
+    """
+
+    def __init__(self, ids, cents, bogof):
+        ids = np.asarray(ids, dtype=np.int64)
+        order = np.argsort(ids, kind='mergesort')
+        self.ids = ids[order]
+        self.cents = np.asarray(cents, dtype=np.int64)[order]
+        self.bogof = np.asarray(bogof, dtype=bool)[order]
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Build a table from (id, price in pence, bogof) rows.
+        """
+        rows = list(rows)
+        count = len(rows)
+        return cls(
+            np.fromiter((row[0] for row in rows), np.int64, count),
+            np.fromiter((row[1] for row in rows), np.int64, count),
+            np.fromiter((bool(row[2]) for row in rows), bool, count),
+        )
+
+    @classmethod
+    def load(cls, product_ids=None):
+        """
+        Load prices with a single column query, no ORM objects are built.
+        :param product_ids: restrict the table to these ids, all products
+            if None
+        """
+        query = db.session.query(Product.id, Product.price, Product.bogof)
+        if product_ids is not None:
+            query = query.filter(Product.id.in_(product_ids))
+        return cls.from_rows(query)
+
+    def positions(self, product_ids):
+        """
+        Look up row positions for product ids.
+        :raises KeyError: with the first unknown product id
+        """
+        product_ids = np.asarray(product_ids, dtype=np.int64)
+        if not len(self.ids):
+            if len(product_ids):
+                raise KeyError(int(product_ids[0]))
+            return product_ids
+        positions = np.searchsorted(self.ids, product_ids)
+        positions = np.minimum(positions, len(self.ids) - 1)
+        missing = self.ids[positions] != product_ids
+        if missing.any():
+            raise KeyError(int(product_ids[missing][0]))
+        return positions
+
+
+def quote_baskets(baskets, loyalty_card=False, prices=None):
+    """
+    Price many hypothetical carts at once with the rules of ``update_cart()``.
+
+    All arithmetic runs on int64 pence with the integer discounts and
+    rounding of ``cart_total()``, totals are exactly the ones of
+    ``update_cart()``.
+
+    :param baskets: sequence of baskets, each a list of (product_id, quantity)
+    :param loyalty_card: one flag for all baskets or a sequence of
+        per-basket flags
+    :param prices: PriceTable to use, loaded for the quoted products if None
+    :return: list of {'subtotal': pence, 'total': pence} in basket order
+    :raises KeyError: for an unknown product id
+    :raises ValueError: for malformed baskets or quantities out of
+        0..MAX_QUANTITY
+    :raises OverflowError: if the amounts exceed MAX_AMOUNT
+    """
+    baskets = [list(basket) for basket in baskets]
+    sizes = np.array([len(basket) for basket in baskets], dtype=np.int64)
+    lines = np.array([_line(line) for basket in baskets for line in basket],
+                     dtype=np.int64).reshape(-1, 2)
+    product_ids, quantities = lines[:, 0], lines[:, 1]
+    loyalty = np.broadcast_to(np.asarray(loyalty_card, dtype=bool),
+                              sizes.shape)
+
+    if prices is None:
+        prices = PriceTable.load(np.unique(product_ids).tolist())
+    positions = prices.positions(product_ids)
+    # Summed in floats, which don't wrap around like int64 does
+    amount = np.sum(quantities * prices.cents[positions].astype(np.float64))
+    if amount > MAX_AMOUNT:
+        raise OverflowError('Basket amounts out of range')
+
+    # Subtract even products from qty for "buy one get one free" products
+    quantities = np.where(prices.bogof[positions],
+                          quantities - quantities // 2, quantities)
+    line_cents = quantities * prices.cents[positions]
+    running = np.concatenate(([0], np.cumsum(line_cents)))
+    ends = np.cumsum(sizes)
+    subtotals = running[ends] - running[ends - sizes]
+
+    # cart_total(): combined discounts as rate / 10000, rounded half up
+    totals = subtotals * np.where(subtotals > DISCOUNT_THRESHOLD,
+                                  DISCOUNT_PERCENT, 100)
+    totals = totals * np.where(loyalty, LOYALTY_PERCENT, 100)
+    totals = (2 * totals + 10000) // 20000
+
+    return [
+        {'subtotal': int(subtotal), 'total': int(total)}
+        for subtotal, total in zip(subtotals, totals)
+    ]
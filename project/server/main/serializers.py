@@ -1,16 +1,42 @@
+from collections import namedtuple
+
+from flask_babel import gettext
 from marshmallow import fields
+from marshmallow_sqlalchemy.fields import Related
+from sqlalchemy import inspect
+from sqlalchemy.orm.interfaces import MANYTOONE
 
-from project.server import ma
+from project.server import db, ma
+from project.server.main.utils import validation_error
 from project.server.models import Product, CartItem, Cart
+from project.server.money import format_cents, to_cents
+
+
+class Money(fields.Field):
+    """
+    Amount in pence, serialized in pounds as a string, e.g. "12.34".
+    """
+    default_error_messages = {'invalid': 'Not a valid amount.'}
+
+    def _serialize(self, value, attr, obj):
+        return None if value is None else format_cents(value)
+
+    def _deserialize(self, value, attr, data):
+        try:
+            return to_cents(value)
+        except ValueError:
+            self.fail('invalid')
 
 
 class PriceMixin():
-    price = fields.Decimal(as_string=True)
+    price = Money()
 
 
 class ProductSchema(ma.ModelSchema, PriceMixin):
     class Meta:
         model = Product
+        sqla_session = db.session
+        ordered = True
 
 
 class CartItemSchema(ma.ModelSchema, PriceMixin):
@@ -18,11 +44,113 @@ class CartItemSchema(ma.ModelSchema, PriceMixin):
 
     class Meta:
         model = CartItem
+        sqla_session = db.session
+        ordered = True
 
 
 class CartSchema(ma.ModelSchema):
     cart_items = fields.Nested(CartItemSchema, many=True, exclude=('cart',))
-    total = fields.Decimal(as_string=True)
+    total = Money()
 
     class Meta:
         model = Cart
+        sqla_session = db.session
+        ordered = True
+        exclude = ('subtotal', 'version')
+
+
+def _getter(attr):
+    """
+    Attribute getter reading loaded values straight from the instance dict,
+    unloaded or expired attributes go through the ORM descriptor, objects
+    without instance dict like result rows or ProductRecords use getattr.
+    """
+    def get(obj):
+        try:
+            return obj.__dict__[attr]
+        except (KeyError, AttributeError):
+            return getattr(obj, attr)
+    return get
+
+
+def _compile_field(schema, name, field):
+    attr = field.attribute or name
+    get = _getter(attr)
+    if isinstance(field, fields.Nested):
+        dump = compile_schema(field.schema)
+        if field.many:
+            return lambda obj: [dump(item) for item in get(obj)]
+        return lambda obj: _none_or(get(obj), dump)
+    if isinstance(field, Related) and len(field.related_keys) == 1:
+        prop = inspect(field.model).get_property(attr)
+        if prop.direction is MANYTOONE and len(prop.local_columns) == 1:
+            # Foreign key column of the object itself, no need to load the
+            # relation
+            column = next(iter(prop.local_columns))
+            return _getter(
+                inspect(field.model).get_property_by_column(column).key)
+        get_pk = _getter(field.related_keys[0].key)
+        return lambda obj: _none_or(get(obj), get_pk)
+    if isinstance(field, Money):
+        return lambda obj: _none_or(get(obj), format_cents)
+    if type(field) in (fields.Integer, fields.Boolean, fields.String):
+        # Database values already have the serialized type
+        return get
+    return lambda obj: field.serialize(attr, obj,
+                                       accessor=schema.get_attribute)
+
+
+def _none_or(value, dump):
+    return None if value is None else dump(value)
+
+
+def compile_schema(schema):
+    """
+    Precompile a schema instance into a plain function returning the same
+    data as `schema.dump(obj).data`, in the same key order, without
+    marshmallow's per object machinery. Unknown field types fall back to
+    their own serialize().
+    """
+    getters = [(name, _compile_field(schema, name, field))
+               for name, field in schema.fields.items()]
+
+    def dump(obj):
+        return {name: getter(obj) for name, getter in getters}
+
+    return dump
+
+
+# Schema instances are reused across requests, compiled dumpers are the fast
+# path.
+cart_schema = CartSchema()
+cart_item_schema = CartItemSchema()
+dump_cart = compile_schema(cart_schema)
+dump_cart_item = compile_schema(cart_item_schema)
+# Products without their cart items, also dumps result rows and catalog
+# ProductRecords
+dump_product = compile_schema(ProductSchema(exclude=('cartitem',)))
+
+# Carts and items not loaded by the ORM, with the attributes the dumpers read
+OwnerRecord = namedtuple('OwnerRecord', ['id'])
+CartRecord = namedtuple('CartRecord',
+                        ['id', 'total', 'version', 'user', 'cart_items'])
+CartItemRecord = namedtuple('CartItemRecord',
+                            ['id', 'cart_id', 'quantity', 'price', 'product'])
+
+
+def load_cart_item_quantity(data, partial=False):
+    """
+    Lightweight input validation for CartItem updates. Quantity is the only
+    field clients may change, everything else is derived on the server.
+
+    :param data: request data, e.g. a previously dumped CartItem
+    :param partial: quantity may be omitted
+    :return: quantity, None if omitted in a partial update
+    """
+    quantity = data.get('quantity')
+    if quantity is None and partial:
+        return None
+    if not isinstance(quantity, int) or isinstance(quantity, bool):
+        validation_error('quantity',
+                         gettext('Please specify a valid quantity'))
+    return quantity
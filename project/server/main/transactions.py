@@ -0,0 +1,145 @@
+# project/server/main/transactions.py
+
+
+import random
+import threading
+import time
+from functools import wraps
+
+from flask import Blueprint, current_app
+from sqlalchemy.exc import DBAPIError
+
+from project.server import db
+
+# PostgreSQL serialization_failure and deadlock_detected
+RETRYABLE_PGCODES = ('40001', '40P01')
+
+
+class TransactionStats(object):
+    """
+    Counters of the unit of work, served as /api/_metrics/transactions.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.requests = self.commits = self.rollbacks = 0
+        self.retries = self.retries_exhausted = 0
+        self.commit_seconds = self.commit_seconds_max = 0.0
+
+    def add(self, **counters):
+        with self._lock:
+            for name, value in counters.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def commit_took(self, seconds):
+        with self._lock:
+            self.commits += 1
+            self.commit_seconds += seconds
+            self.commit_seconds_max = max(self.commit_seconds_max, seconds)
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'commits': self.commits,
+            'rollbacks': self.rollbacks,
+            'retries': self.retries,
+            'retries_exhausted': self.retries_exhausted,
+            'commit_ms_avg': (
+                round(self.commit_seconds / self.commits * 1000, 3)
+                if self.commits else None),
+            'commit_ms_max': round(self.commit_seconds_max * 1000, 3),
+        }
+
+
+transaction_stats = TransactionStats()
+
+
+def is_retryable(error):
+    """
+    Serialization failures and deadlocks succeed when the transaction is
+    simply run again, so does SQLite's lock timeout.
+    """
+    orig = getattr(error, 'orig', None)
+    if getattr(orig, 'pgcode', None) in RETRYABLE_PGCODES:
+        return True
+    return 'database is locked' in str(orig)
+
+
+def begin_transaction():
+    """
+    Start the transaction of the unit of work at API_ISOLATION_LEVEL, other
+    levels would have to be set before its first statement.
+    """
+    level = current_app.config['API_ISOLATION_LEVEL']
+    if level:
+        db.session.connection(execution_options={'isolation_level': level})
+
+
+def release_connection():
+    """
+    End the transaction of the unit of work early and return its connection
+    to the pool, before a view waits. Only for views that haven't written
+    anything yet, call begin_transaction() to go on.
+    """
+    db.session.close()
+
+
+def unit_of_work(view):
+    """
+    Run the view in one transaction, committed exactly once after the view
+    returned and rolled back on any exception. Views must not commit.
+
+    The whole view is run again, up to API_TRANSACTION_RETRIES times, when the
+    database aborts the transaction with a serialization failure or deadlock,
+    which PostgreSQL does at API_ISOLATION_LEVEL repeatable read or
+    serializable.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        config = current_app.config
+        transaction_stats.add(requests=1)
+        attempt = 0
+        while True:
+            try:
+                begin_transaction()
+                rv = view(*args, **kwargs)
+                started = time.perf_counter()
+                db.session.commit()
+                transaction_stats.commit_took(time.perf_counter() - started)
+                return rv
+            except DBAPIError as e:
+                db.session.rollback()
+                transaction_stats.add(rollbacks=1)
+                if not is_retryable(e):
+                    raise
+                if attempt >= config['API_TRANSACTION_RETRIES']:
+                    transaction_stats.add(retries_exhausted=1)
+                    raise
+                attempt += 1
+                transaction_stats.add(retries=1)
+                # Randomized exponential backoff so conflicting requests
+                # don't collide again
+                backoff = config['API_TRANSACTION_RETRY_BACKOFF']
+                time.sleep(random.uniform(0, backoff * 2 ** attempt))
+            except BaseException:
+                db.session.rollback()
+                transaction_stats.add(rollbacks=1)
+                raise
+    return wrapper
+
+
+class TransactionalBlueprint(Blueprint):
+    """
+    Blueprint running every view in a unit_of_work, except routes added with
+    unit_of_work=False, e.g. views streaming their response. Those read in
+    the session's own transaction, rolled back when the request ends.
+    """
+
+    def add_url_rule(self, rule, endpoint=None, view_func=None, **options):
+        if view_func is not None and options.pop('unit_of_work', True):
+            view_func = unit_of_work(view_func)
+        super(TransactionalBlueprint, self).add_url_rule(
+            rule, endpoint, view_func, **options)
@@ -1,40 +1,386 @@
-from decimal import Decimal
+import sqlite3
 
 from flask import jsonify
+from flask_babel import gettext
+from sqlalchemy import inspect, case, func, text, bindparam
 from werkzeug.exceptions import BadRequest
 from werkzeug.http import HTTP_STATUS_CODES
 
-from project.server.models import CartItem
+from project.server import db
+from project.server.catalog import catalog
+from project.server.models import User, Cart, CartItem
+from project.server.money import Cents, divide_half_up
+
+# Pricing rules shared by update_cart(), the batch quote engine and the SQL
+# repricing. Amounts are in pence, discounts in percent.
+DISCOUNT_THRESHOLD = 2000
+DISCOUNT_PERCENT = 90
+LOYALTY_PERCENT = 98
+
+
+def line_price(product, quantity):
+    if product.bogof:
+        # Subtract even products from qty for "buy one get one free" products
+        quantity = quantity - quantity // 2
+    return quantity * product.price
+
+
+def cart_rate(over_threshold, loyalty_card):
+    """
+    Combined cart discounts as a fraction.
+
+    :param over_threshold: subtotal > DISCOUNT_THRESHOLD
+    :return: (numerator, denominator)
+    """
+    rate, scale = 1, 1
+    if over_threshold:
+        rate, scale = DISCOUNT_PERCENT, 100  # -10% if total is bigger than 20
+    if loyalty_card:
+        # -2% discount for loyalty cards users
+        rate, scale = rate * LOYALTY_PERCENT, scale * 100
+    return rate, scale
+
+
+def cart_total(subtotal, loyalty_card):
+    """
+    Apply cart level discounts to the sum of item prices. The discounts are
+    combined and the result is rounded half up to the penny once.
+    """
+    rate, scale = cart_rate(subtotal > DISCOUNT_THRESHOLD, loyalty_card)
+    return divide_half_up(subtotal * rate, scale)
+
+
+def cart_total_clause(subtotal, loyalty_card):
+    """
+    cart_total() in SQL, integer arithmetic on PostgreSQL and SQLite alike.
+
+    :param subtotal: SQL expression in pence
+    :param loyalty_card: bool, or a boolean SQL expression
+    """
+    def discounted(over_threshold, loyalty):
+        rate, scale = cart_rate(over_threshold, loyalty)
+        # divide_half_up(), both operands are integers so / truncates
+        if rate == scale:
+            return subtotal
+        return (subtotal * (2 * rate) + scale) / (2 * scale)
+
+    over = subtotal > DISCOUNT_THRESHOLD
+    if isinstance(loyalty_card, bool):
+        return case([(over, discounted(True, loyalty_card))],
+                    else_=discounted(False, loyalty_card))
+    return case([
+        (over & loyalty_card, discounted(True, True)),
+        (over, discounted(True, False)),
+        (loyalty_card, discounted(False, True)),
+    ], else_=subtotal)
 
 
 def update_cart(cart, cart_item=None):
+    """
+    Full recomputation of every item price, cart.subtotal and cart.total.
+    Loads all items with their products, mutations should prefer
+    reprice_cart_item().
+    """
     cart = cart_item.cart if cart_item else cart
-    cart.total = 0
+    cart.subtotal = 0
     for item in cart.cart_items:
-        product = item.product
-        qty = item.quantity
-        if product.bogof:
-            # Subtract even products from qty for "buy one get one free" products
-            qty = qty - qty // 2
-        item.price = qty * product.price
-        cart.total += item.price
-    if cart.total > Decimal('20'):
-        cart.total *= Decimal('0.9')  # -10% if total is bigger than 20
-    if cart.user.loyalty_card:
-        cart.total *= Decimal('0.98')  # -2% discount for loyalty cards users
+        item.price = line_price(item.product, item.quantity)
+        cart.subtotal += item.price
+    cart.total = cart_total(cart.subtotal, cart.user.loyalty_card)
+    return bump_cart_version(cart)
+
+
+def bump_cart_version(cart):
+    """
+    Mark the cart as changed. Persisted carts are incremented in SQL so
+    concurrent mutations can't produce the same version twice.
+    """
+    if inspect(cart).persistent:
+        cart.version = Cart.version + 1
+    else:
+        cart.version = (cart.version or 0) + 1
     return cart
 
 
-def validation_error(key, message):
+def _stored_price(cart_item):
+    """
+    Price of the item as currently counted in cart.subtotal, i.e. the last
+    persisted value, ignoring any unflushed change. New items count as 0.
+    """
+    history = inspect(cart_item).attrs.price.history
+    if history.deleted:
+        return history.deleted[0] or 0
+    if history.unchanged:
+        return history.unchanged[0] or 0
+    return 0
+
+
+def reprice_cart_item(cart, cart_item, removed=False, product=None):
+    """
+    Incrementally update cart totals after a change of a single CartItem.
+    Only the given item is repriced and its price delta applied to
+    cart.subtotal, other items of the cart are neither loaded nor written.
+
+    :param cart: Cart owning the item
+    :param cart_item: added, changed or removed CartItem
+    :param removed: item is being deleted, items with quantity <= 0 are
+        treated the same
+    :param product: product of the item if already at hand, e.g. from the
+        catalog
+    :return: cart. The quantity of an item whose product was deleted is set
+        to 0, callers delete it.
+    """
+    previous = _stored_price(cart_item)
+    if removed or cart_item.quantity <= 0:
+        price = 0
+    else:
+        product = product or cart_item.product
+        if product is None:
+            # Lines of deleted products can't be priced, they are removed
+            cart_item.quantity = price = 0
+        else:
+            price = cart_item.price = line_price(product, cart_item.quantity)
+    cart.subtotal = (cart.subtotal or 0) - previous + price
+    return refresh_cart_total(cart)
+
+
+def refresh_cart_total(cart):
+    """
+    Derive cart.total from the stored subtotal, e.g. when the loyalty card
+    changes.
+    """
+    cart.total = cart_total(cart.subtotal or 0, cart.user.loyalty_card)
+    return bump_cart_version(cart)
+
+
+# Same syntax on PostgreSQL >= 9.5 and SQLite >= 3.24. Every parameter
+# appears once, the positional parameters of SQLite drivers can't repeat one.
+_UPSERT_CART_ITEM = '''
+INSERT INTO cart_items (cart_id, product_id, quantity, price)
+VALUES (:cart_id, :product_id, 1, :unit_price)
+ON CONFLICT (cart_id, product_id) DO UPDATE
+SET quantity = cart_items.quantity + 1, price = {price}
+'''
+_UNIT_PRICE = '(cart_items.quantity + 1) * excluded.price'
+_BOGOF_PRICE = ('(cart_items.quantity + 1 - (cart_items.quantity + 1) / 2) '
+                '* excluded.price')
+_SELECT_CART_ITEM = ('SELECT id, quantity FROM cart_items '
+                     'WHERE cart_id = :cart_id AND product_id = :product_id')
+
+
+def supports_returning(dialect):
+    """
+    :param dialect: database dialect name
+    """
+    return dialect == 'postgresql' or (
+        dialect == 'sqlite' and sqlite3.sqlite_version_info >= (3, 35))
+
+
+def cart_item_upsert(product, returning):
+    """
+    Statement adding one unit of product to its line in a cart, priced in
+    SQL from the current quantity. Parameters: cart_id, product_id and
+    unit_price.
+
+    :param returning: return the id and quantity of the line
+    """
+    upsert = _UPSERT_CART_ITEM.format(
+        price=_BOGOF_PRICE if product.bogof else _UNIT_PRICE)
+    if returning:
+        upsert += 'RETURNING id, quantity'
+    return text(upsert).bindparams(bindparam('unit_price', type_=Cents))
+
+
+def select_cart_item(cart_id, product_id):
+    """
+    Id and quantity of a cart line, for databases without RETURNING.
+    """
+    return text(_SELECT_CART_ITEM).bindparams(cart_id=cart_id,
+                                              product_id=product_id)
+
+
+def subtotal_delta_update(cart_id, delta, loyalty_card):
+    """
+    UPDATE moving carts.subtotal by delta and deriving carts.total from it
+    in SQL, with the same rules as cart_total(). Bumps carts.version.
+    """
+    table = Cart.__table__
+    subtotal = func.coalesce(table.c.subtotal, 0) + delta
+    return table.update().where(table.c.id == cart_id).values(
+        subtotal=subtotal,
+        total=cart_total_clause(subtotal, bool(loyalty_card)),
+        version=table.c.version + 1)
+
+
+def get_or_create_cart_id(user):
+    """
+    Return id of the user's cart, creating it if needed.
+    Safe against concurrent creation: only the first writer links its cart
+    to the user.
+    """
+    if user.cart_id:
+        return user.cart_id
+    cart = Cart(subtotal=0, total=0)
+    db.session.add(cart)
+    db.session.flush()
+    linked = User.query.filter(
+        User.id == user.id, User.cart_id.is_(None)
+    ).update({User.cart_id: cart.id}, synchronize_session=False)
+    if not linked:
+        # Lost the race, use the cart created by the other request. The new
+        # cart has no items or user, nothing for a session delete to cascade to
+        db.session.expunge(cart)
+        Cart.query.filter(Cart.id == cart.id).delete(synchronize_session=False)
+    db.session.expire(user, ['cart_id', 'cart'])
+    return user.cart_id
+
+
+def add_cart_item(cart_id, product, loyalty_card):
+    """
+    Atomically add one unit of product to a cart.
+
+    Two statements without reading the cart first: an upsert incrementing
+    `quantity = quantity + 1` on the unique (cart_id, product_id) line, and an
+    UPDATE applying the line price delta to carts.subtotal and carts.total.
+    Concurrent requests can't lose increments or create duplicate lines.
+    ORM instances of the cart and the item are stale until the session is
+    expired.
+
+    :return: CartItem.id
+    """
+    returning = supports_returning(db.session.get_bind().dialect.name)
+    statement = cart_item_upsert(product, returning)
+    row = db.session.execute(statement, {
+        'cart_id': cart_id, 'product_id': product.id,
+        'unit_price': product.price}).first()
+    if row is None:
+        row = db.session.execute(select_cart_item(cart_id, product.id)).first()
+    cart_item_id, quantity = row
+    apply_subtotal_delta(cart_id, added_unit_price(product, quantity),
+                         loyalty_card)
+    return cart_item_id
+
+
+def added_unit_price(product, quantity):
+    """
+    Price difference of a line after one unit was added, zero for every
+    second unit of "buy one get one free" products.
+    """
+    return line_price(product, quantity) - line_price(product, quantity - 1)
+
+
+def apply_subtotal_delta(cart_id, delta, loyalty_card):
+    """
+    Run subtotal_delta_update() in the session's transaction.
+    """
+    db.session.execute(subtotal_delta_update(cart_id, delta, loyalty_card))
+
+
+def apply_cart_operations(cart, operations):
+    """
+    Apply an ordered list of {action, product, quantity} operations to a cart
+    in memory, then reprice each touched item once. Nothing is committed, on
+    a validation error the caller's transaction is rolled back as a whole.
+
+    add: add quantity (default 1) units, creating the item if needed
+    subtract: remove quantity (default 1) units, the item is deleted at zero
+    remove: delete the item
+
+    :raises BadRequest: with data {'operations': message, 'index': n} for
+        the first invalid operation
+    :return: cart
+    """
+    items = {item.product_id: item for item in cart.cart_items}
+    products = {}
+    # New items can only be flushed once priced
+    with db.session.no_autoflush:
+        for index, operation in enumerate(operations):
+            def fail(message):
+                validation_error('operations', message, index=index)
+
+            if not isinstance(operation, dict):
+                fail(gettext('Operation must be an object'))
+            action = operation.get('action')
+            if action not in CartItem.ACTIONS:
+                fail(gettext('Action must be one of %(actions)s',
+                             actions=', '.join(CartItem.ACTIONS)))
+            product = catalog.get(operation.get('product'))
+            if not product:
+                fail(gettext('Please specify a valid product id'))
+            quantity = operation.get('quantity', 1)
+            if (not isinstance(quantity, int) or isinstance(quantity, bool) or
+                    quantity < 1):
+                fail(gettext('Quantity must be a positive integer'))
+            item = items.get(product.id)
+            if action == CartItem.ADD:
+                if item is None:
+                    item = items[product.id] = CartItem(
+                        cart=cart, product_id=product.id, quantity=0)
+                item.quantity += quantity
+            elif item is None or item.quantity <= 0:
+                fail(gettext('Product is not in the cart'))
+            elif action == CartItem.SUBTRACT:
+                item.quantity = max(item.quantity - quantity, 0)
+            else:
+                item.quantity = 0
+            products[product.id] = product
+
+        # Single repricing pass over the touched items
+        for product_id, product in products.items():
+            item = items[product_id]
+            reprice_cart_item(cart, item, product=product)
+            if item.quantity <= 0:
+                # delete-orphan cascade deletes persisted items, drops new ones
+                cart.cart_items.remove(item)
+    return cart
+
+
+def check_cart(cart):
+    """
+    Consistency checker for incrementally maintained totals.
+    Recomputes the cart from scratch without modifying it.
+
+    :return: dict of inconsistencies {field: (stored, expected)}, item prices
+        are reported under 'item <id>' keys. Empty dict if the cart is
+        consistent.
+    """
+    problems = {}
+    subtotal = 0
+    for item in cart.cart_items:
+        price = line_price(item.product, item.quantity)
+        subtotal += price
+        if item.price != price:
+            problems['item %s' % item.id] = (item.price, price)
+    total = cart_total(subtotal, cart.user.loyalty_card)
+    for field, expected in (('subtotal', subtotal), ('total', total)):
+        stored = getattr(cart, field)
+        if stored != expected:
+            problems[field] = (stored, expected)
+    return problems
+
+
+def cart_etag(cart_id, version, catalog_version):
+    """
+    Strong ETag of the serialized cart. Includes the catalog version as the
+    response embeds product data.
+    """
+    return '%s-%s-%s' % (cart_id, version, catalog_version)
+
+
+def validation_error(key, message, **extra):
     error = BadRequest(message)
-    error.data = {key: message}
+    error.data = dict({key: message}, **extra)
     raise error
 
 
-def error_response(status_code, message=None):
+def error_payload(status_code, message=None):
     payload = {'error': HTTP_STATUS_CODES.get(status_code, 'Unknown error')}
     if message:
         payload['message'] = message
-    response = jsonify(payload)
+    return payload
+
+
+def error_response(status_code, message=None):
+    response = jsonify(error_payload(status_code, message))
     response.status_code = status_code
     return response
@@ -1,15 +1,22 @@
 # project/server/main/views.py
 
-from flask import render_template, request, g, Blueprint
+import itertools
 
-from project.server.models import Product
+from flask import current_app, render_template, Blueprint
+
+from project.server.catalog import catalog
 
 main_blueprint = Blueprint('main', __name__)
 
 
 @main_blueprint.route('/')
 def home():
+    # First page only, the page loads the following ones from GET /api/products
+    snapshot = catalog.snapshot()
+    page_size = current_app.config['PRODUCTS_PAGE_SIZE']
+    products = list(itertools.islice(snapshot, page_size))
     data = {
-        'products': Product.query.all()
+        'products': products,
+        'next': products[-1].id if len(snapshot) > page_size else None,
     }
     return render_template('main/home.html', **data)
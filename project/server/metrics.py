@@ -0,0 +1,21 @@
+# project/server/metrics.py
+
+# Named metric sources, each a callable returning a JSON serializable dict.
+# Served by the api blueprint under /api/_metrics/<name>.
+_sources = {}
+
+
+def register(name, source):
+    _sources[name] = source
+
+
+def collect(name):
+    """
+    :return: current values of the named source, None if it isn't registered
+    """
+    source = _sources.get(name)
+    return source() if source else None
+
+
+def names():
+    return sorted(_sources)
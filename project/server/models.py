@@ -2,12 +2,21 @@
 
 
 import datetime
+import hashlib
+import os
+import secrets
 
 from flask import current_app
 from sqlalchemy.orm import backref
 
-from project.server import db, bcrypt
-from project.server.user import admin_user_token
+from project.server import db
+from project.server.money import Cents
+from project.server.user.hashing import password_hasher
+
+# Loading strategy of relationships that a query doesn't load explicitly,
+# see project/server/loading.py. Tests use 'raise_on_sql' so that code relying
+# on implicit lazy loads fails instead of silently running extra queries.
+RELATIONSHIP_LOADING = os.getenv('SQLALCHEMY_RELATIONSHIP_LOADING', 'select')
 
 
 class User(db.Model):
@@ -21,14 +30,18 @@ class User(db.Model):
     admin = db.Column(db.Boolean, nullable=False, default=False)
     loyalty_card = db.Column(db.Boolean, default=False)
 
-    cart_id = db.Column(db.Integer, db.ForeignKey('carts.id'), nullable=True)
-    cart = db.relationship('Cart', backref=backref("user", uselist=False), uselist=False, lazy='joined')
+    # Indexed for the owner lookups of set-based cart repricing
+    cart_id = db.Column(db.Integer, db.ForeignKey('carts.id'), nullable=True,
+                        index=True)
+    cart = db.relationship(
+        'Cart', uselist=False, lazy=RELATIONSHIP_LOADING,
+        backref=backref("user", uselist=False, lazy=RELATIONSHIP_LOADING))
 
     def __init__(self, email, password, admin=False):
         self.email = email
-        self.password = bcrypt.generate_password_hash(
-            password, current_app.config.get('BCRYPT_LOG_ROUNDS')
-        ).decode('utf-8')
+        # Raises HashingBusy if the hashing pool is saturated
+        self.password = password_hasher.hash(
+            password, current_app.config.get('BCRYPT_LOG_ROUNDS'))
         self.registered_on = datetime.datetime.now()
         self.admin = admin
 
@@ -45,15 +58,53 @@ class User(db.Model):
         return self.id
 
     def get_token(self):
-        # Hardcoded token
-        return admin_user_token
+        """
+        Issue a new API token, only its hash is stored so the plain value
+        can't be retrieved later. Committing is up to the caller.
+        """
+        return ApiToken.issue(self)
 
     def __repr__(self):
         return '<User {0}>'.format(self.email)
 
 
+class ApiToken(db.Model):
+    __tablename__ = 'api_tokens'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+
+    # sha256 hex digest of the token, tokens are random so no salt is needed
+    token_hash = db.Column(db.String(64), unique=True, nullable=False)
+    created_on = db.Column(db.DateTime, nullable=False,
+                           default=datetime.datetime.now)
+    revoked_on = db.Column(db.DateTime, nullable=True)
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False,
+                        index=True)
+    user = db.relationship('User',
+                           backref=backref('api_tokens', lazy='dynamic'),
+                           lazy=RELATIONSHIP_LOADING)
+
+    @staticmethod
+    def hash(token):
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def issue(cls, user):
+        token = secrets.token_urlsafe(32)
+        db.session.add(cls(user=user, token_hash=cls.hash(token)))
+        return token
+
+
 class CartItem(db.Model):
     __tablename__ = 'cart_items'
+    __table_args__ = (
+        # One line per product in a cart, target of the add-to-cart upsert
+        db.UniqueConstraint('cart_id', 'product_id',
+                            name='uq_cart_items_cart_product'),
+        # Carts containing a product, for repricing after product changes
+        db.Index('ix_cart_items_product_cart', 'product_id', 'cart_id'),
+    )
 
     # Constants
     ADD = 'add'
@@ -64,13 +115,20 @@ class CartItem(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
 
     quantity = db.Column(db.Integer, default=1)
-    price = db.Column(db.Numeric(asdecimal=True, precision=10, scale=2), nullable=False)
+    # Pence, see project/server/money.py
+    price = db.Column(Cents, nullable=False)
 
     cart_id = db.Column(db.Integer, db.ForeignKey('carts.id'), nullable=True)
-    cart = db.relationship('Cart', backref=backref("cart_items", lazy='joined', cascade="all, delete-orphan"),
-                           lazy=True)
+    cart = db.relationship(
+        'Cart', lazy=RELATIONSHIP_LOADING,
+        backref=backref("cart_items", lazy=RELATIONSHIP_LOADING,
+                        cascade="all, delete-orphan"))
     product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable=True)
-    product = db.relationship('Product', backref="cartitem", uselist=False, lazy='joined')
+    # Items of a product are only loaded by the session, to detach them when
+    # the product is deleted
+    product = db.relationship('Product',
+                              backref=backref("cartitem", lazy='select'),
+                              uselist=False, lazy=RELATIONSHIP_LOADING)
 
 
 class Product(db.Model):
@@ -79,13 +137,33 @@ class Product(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
 
     title = db.Column(db.String(255), nullable=False)
-    price = db.Column(db.Numeric(asdecimal=True, precision=10, scale=2), nullable=False)
+    # Pence, see project/server/money.py
+    price = db.Column(Cents, nullable=False)
     bogof = db.Column(db.Boolean, default=False)
 
 
+class CatalogVersion(db.Model):
+    """
+    Single row counter bumped on every Product change, lets every process
+    check its catalog snapshot for staleness with one primary key lookup.
+    """
+    __tablename__ = 'catalog_version'
+
+    ROW_ID = 1
+
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
 class Cart(db.Model):
     __tablename__ = 'carts'
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
 
-    total = db.Column(db.Numeric(asdecimal=True, precision=10, scale=2), default=0)
+    # Sum of item prices before cart discounts in pence, maintained
+    # incrementally
+    subtotal = db.Column(Cents, default=0)
+    total = db.Column(Cents, default=0)
+    # Incremented by every cart mutation, used for ETags
+    version = db.Column(db.Integer, nullable=False, default=0,
+                        server_default='0')
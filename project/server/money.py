@@ -0,0 +1,60 @@
+# project/server/money.py
+"""
+Money in integer minor units (pence). Prices, subtotals and totals are ints
+in the models, the pricing code and the cart store, and only become "12.34"
+strings in the API. Discounts are integer percentages, see cart_total() in
+project/server/main/utils.py for the rounding rule.
+"""
+
+
+from decimal import Decimal, InvalidOperation
+
+from sqlalchemy.types import TypeDecorator, BigInteger
+
+CENTS = 100
+
+
+class Cents(TypeDecorator):
+    """
+    Column of an amount in pence. Refuses Decimals and floats, which would
+    be taken for pence instead of pounds.
+    """
+    impl = BigInteger
+
+    def process_bind_param(self, value, dialect):
+        if value is not None and (not isinstance(value, int) or
+                                  isinstance(value, bool)):
+            raise TypeError('Amounts are integer pence, got %r' % (value,))
+        return value
+
+
+def to_cents(value):
+    """
+    Parse an amount in pounds, e.g. "12.34" or Decimal('12.34').
+
+    :return: pence
+    :raises ValueError: for invalid amounts or fractional pence
+    """
+    try:
+        cents = Decimal(value).scaleb(2)
+    except (InvalidOperation, TypeError):
+        raise ValueError('Invalid amount %r' % (value,))
+    if not cents.is_finite() or cents != cents.to_integral_value():
+        raise ValueError('Amount %s has fractional pence' % (value,))
+    return int(cents)
+
+
+def format_cents(cents):
+    """
+    :return: amount in pounds with two decimals, e.g. '12.34'
+    """
+    sign = '-' if cents < 0 else ''
+    pounds, pence = divmod(abs(cents), CENTS)
+    return '%s%d.%02d' % (sign, pounds, pence)
+
+
+def divide_half_up(numerator, denominator):
+    """
+    Integer division rounding halves up, e.g. a discounted amount in pence.
+    """
+    return (2 * numerator + denominator) // (2 * denominator)
@@ -0,0 +1,224 @@
+# project/server/repricing.py
+"""
+Repricing of stored carts after products changed their price or BOGOF flag.
+Carts containing the products are found through ix_cart_items_product_cart
+and recomputed with set-based SQL, a chunk of carts per transaction, without
+loading them into the ORM: item prices first, then subtotals, then totals
+with the cart discounts of project/server/main/utils.py.
+
+    $ python manage.py reprice-carts --product 3 --product 7
+
+With CART_REPRICE_ON_PRODUCT_UPDATE, committing a price or BOGOF change
+through the ORM starts the job for the changed products in a background
+thread of the committing process.
+"""
+
+
+import random
+import threading
+import time
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, case, func, inspect, select
+from sqlalchemy.orm import Session, object_session
+
+from project.server import db, cartstore
+from project.server.loading import FULL_CART
+from project.server.main.utils import cart_total_clause, update_cart
+from project.server.models import User, Product, Cart, CartItem
+
+# Session info key of the ids of repriced products, True for all
+_CHANGED = 'products_repriced'
+
+_items = CartItem.__table__
+_products = Product.__table__
+_carts = Cart.__table__
+_users = User.__table__
+
+
+def item_prices(cart_ids, product_ids=None):
+    """
+    UPDATE of the item prices of carts, line_price() in SQL.
+
+    :param product_ids: only items of these products, all by default
+    """
+    units = case([(_products.c.bogof,
+                   _items.c.quantity - _items.c.quantity / 2)],
+                 else_=_items.c.quantity)
+    price = select([units * _products.c.price]).where(
+        _products.c.id == _items.c.product_id).as_scalar()
+    where = _items.c.cart_id.in_(cart_ids)
+    if product_ids is None:
+        where &= _items.c.product_id.isnot(None)
+    else:
+        where &= _items.c.product_id.in_(product_ids)
+    return _items.update().where(where).values(price=price)
+
+
+def cart_subtotals(cart_ids):
+    """UPDATE of cart subtotals from their item prices, bumps versions."""
+    subtotal = select([func.coalesce(func.sum(_items.c.price), 0)]).where(
+        _items.c.cart_id == _carts.c.id).as_scalar()
+    return _carts.update().where(_carts.c.id.in_(cart_ids)).values(
+        subtotal=subtotal, version=_carts.c.version + 1)
+
+
+def cart_totals(cart_ids):
+    """UPDATE of cart totals from their subtotals, cart_total() in SQL."""
+    loyalty_card = select([_users.c.loyalty_card]).where(
+        _users.c.cart_id == _carts.c.id).limit(1).as_scalar()
+    return _carts.update().where(_carts.c.id.in_(cart_ids)).values(
+        total=cart_total_clause(_carts.c.subtotal, loyalty_card))
+
+
+def affected_cart_ids(product_ids=None):
+    """
+    :param product_ids: changed products, None for all carts
+    :return: ids of the carts containing any of the products, ascending
+    """
+    if product_ids is None:
+        query = db.session.query(Cart.id).order_by(Cart.id)
+    else:
+        query = db.session.query(CartItem.cart_id).filter(
+            CartItem.product_id.in_(product_ids), CartItem.cart_id.isnot(None)
+        ).distinct().order_by(CartItem.cart_id)
+    return [cart_id for cart_id, in query]
+
+
+def verify_carts(cart_ids, sample, seed=None):
+    """
+    Recompute a sample of carts with update_cart() and compare with the
+    stored values, nothing is written.
+
+    :return: {cart id: {field: (stored, expected)}} of the carts that differ
+    """
+    picked = random.Random(seed).sample(cart_ids, min(sample, len(cart_ids)))
+    mismatches = {}
+    for cart in Cart.query.options(*FULL_CART).filter(Cart.id.in_(picked)):
+        if cart.user is None:
+            continue
+        fields = [(cart, 'subtotal', 'subtotal'),
+                  (cart, 'total', 'total')] + [
+            (item, 'price', 'item %s' % item.id)
+            for item in cart.cart_items]
+        stored = [getattr(target, attr) for target, attr, _ in fields]
+        update_cart(cart)
+        problems = {name: (value, getattr(target, attr))
+                    for (target, attr, name), value in zip(fields, stored)
+                    if value != getattr(target, attr)}
+        if problems:
+            mismatches[cart.id] = problems
+    db.session.rollback()
+    return mismatches
+
+
+class Repricer(object):
+    """
+    Runs repricing jobs, one at a time per process. Counters are served as
+    /api/_metrics/repricing.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.job = None
+        self.runs = self.carts = 0
+        self.seconds = 0.0
+        self.last_carts_per_second = None
+
+    def run(self, product_ids=None, chunk_size=500):
+        """
+        Reprice the carts containing the products, committing every chunk.
+
+        :param product_ids: changed products, None for all carts
+        :return: (ids of the repriced carts, seconds)
+        """
+        with self._lock:
+            started = time.perf_counter()
+            cart_ids = affected_cart_ids(product_ids)
+            store = cartstore.cart_store()
+            for start in range(0, len(cart_ids), chunk_size):
+                chunk = cart_ids[start:start + chunk_size]
+                if store is not None:
+                    # Stored copies of the carts would overwrite the new
+                    # prices
+                    for user_id, in db.session.query(User.id).filter(
+                            User.cart_id.in_(chunk)):
+                        store.evict(user_id)
+                db.session.execute(item_prices(chunk, product_ids))
+                db.session.execute(cart_subtotals(chunk))
+                db.session.execute(cart_totals(chunk))
+                db.session.commit()
+            seconds = time.perf_counter() - started
+            self.runs += 1
+            self.carts += len(cart_ids)
+            self.seconds += seconds
+            self.last_carts_per_second = (
+                round(len(cart_ids) / seconds, 1)
+                if cart_ids and seconds else None)
+            return cart_ids, seconds
+
+    def start(self, app, product_ids=None):
+        """Run a job in a background thread with its own session."""
+        self.job = threading.Thread(target=self._run_in_background,
+                                    args=(app, product_ids),
+                                    name='cart-repricing', daemon=True)
+        self.job.start()
+
+    def _run_in_background(self, app, product_ids):
+        with app.app_context():
+            try:
+                self.run(product_ids, app.config['CART_REPRICE_CHUNK_SIZE'])
+            except Exception:
+                app.logger.exception('Repricing carts of products %s failed',
+                                     product_ids)
+            finally:
+                db.session.remove()
+
+    def wait(self, timeout=None):
+        """Wait for the background job, if any."""
+        if self.job is not None:
+            self.job.join(timeout)
+
+    def stats(self):
+        return {
+            'runs': self.runs,
+            'carts': self.carts,
+            'seconds': round(self.seconds, 3),
+            'carts_per_second': (round(self.carts / self.seconds, 1)
+                                 if self.seconds else None),
+            'last_carts_per_second': self.last_carts_per_second,
+        }
+
+
+repricer = Repricer()
+
+
+@event.listens_for(Product, 'after_update')
+def product_updated(mapper, connection, target):
+    state = inspect(target)
+    if (state.attrs.price.history.has_changes() or
+            state.attrs.bogof.history.has_changes()):
+        changed = object_session(target).info.setdefault(_CHANGED, set())
+        if changed is not True:
+            changed.add(target.id)
+
+
+@event.listens_for(Session, 'after_bulk_update')
+def products_updated(context):
+    # Neither the products nor the columns are known, reprice every cart
+    if context.mapper.class_ is Product:
+        context.session.info[_CHANGED] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def reprice_on_commit(session):
+    changed = session.info.pop(_CHANGED, None)
+    if changed and has_app_context() and current_app.config[
+            'CART_REPRICE_ON_PRODUCT_UPDATE']:
+        repricer.start(current_app._get_current_object(),
+                       None if changed is True else sorted(changed))
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_on_rollback(session):
+    session.info.pop(_CHANGED, None)
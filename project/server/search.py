@@ -0,0 +1,282 @@
+# project/server/search.py
+"""
+Product title search.
+
+Backends, PRODUCT_SEARCH_BACKEND picks one or 'auto' detects it per database.
+All of them rank at most PRODUCT_SEARCH_CANDIDATES matches per query.
+
+fts5: SQLite FTS5 table product_search kept in sync with products by triggers
+trigram: PostgreSQL pg_trgm GIN index on products.title
+memory: PrefixIndex of the catalog snapshot, used when neither is installed
+
+Database indexes are installed with the products table, `python manage.py
+install-search` adds them to existing databases.
+"""
+
+
+import bisect
+import re
+from array import array
+from itertools import islice
+
+from flask import current_app
+from sqlalchemy import event, text
+from sqlalchemy.exc import DBAPIError
+
+from project.server import db
+from project.server.models import Product
+
+FTS5 = 'fts5'
+TRIGRAM = 'trigram'
+MEMORY = 'memory'
+BACKENDS = (FTS5, TRIGRAM, MEMORY)
+
+# Same words as the unicode61 tokenizer of FTS5: letters and digits, case
+# folded
+_TOKEN = re.compile(r'[^\W_]+')
+
+_SQLITE_INSTALL = (
+    'DROP TABLE IF EXISTS product_search',
+    "CREATE VIRTUAL TABLE product_search USING fts5("
+    "title, content='products', content_rowid='id', prefix='2 3')",
+    '''CREATE TRIGGER product_search_insert AFTER INSERT ON products BEGIN
+        INSERT INTO product_search (rowid, title) VALUES (new.id, new.title);
+    END''',
+    '''CREATE TRIGGER product_search_delete AFTER DELETE ON products BEGIN
+        INSERT INTO product_search (product_search, rowid, title)
+        VALUES ('delete', old.id, old.title);
+    END''',
+    '''CREATE TRIGGER product_search_update AFTER UPDATE OF title ON products
+    BEGIN
+        INSERT INTO product_search (product_search, rowid, title)
+        VALUES ('delete', old.id, old.title);
+        INSERT INTO product_search (rowid, title) VALUES (new.id, new.title);
+    END''',
+    "INSERT INTO product_search (product_search) VALUES ('rebuild')",
+)
+_POSTGRESQL_INSTALL = (
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    'CREATE INDEX IF NOT EXISTS ix_products_title_trgm ON products '
+    'USING gin (title gin_trgm_ops)',
+)
+_DETECT = {
+    'sqlite': (FTS5, "SELECT 1 FROM sqlite_master "
+                     "WHERE name = 'product_search'"),
+    'postgresql': (TRIGRAM, "SELECT 1 FROM pg_indexes "
+                            "WHERE indexname = 'ix_products_title_trgm'"),
+}
+
+# Database url -> detected backend
+_detected = {}
+
+
+def tokenize(value):
+    """
+    :return: list of distinct lower case words in order of appearance
+    """
+    return list(dict.fromkeys(_TOKEN.findall(value.casefold())))
+
+
+def install(connection):
+    """
+    Create the search index of the database, existing products are indexed.
+
+    :return: installed backend, None if the database supports none
+    """
+    dialect = connection.dialect.name
+    statements = {'sqlite': _SQLITE_INSTALL,
+                  'postgresql': _POSTGRESQL_INSTALL}.get(dialect)
+    if statements is None:
+        return None
+    try:
+        for statement in statements:
+            connection.execute(text(statement))
+    except DBAPIError:
+        # SQLite without FTS5 or no permission to create extensions
+        return None
+    finally:
+        _detected.clear()
+    return _DETECT[dialect][0]
+
+
+@event.listens_for(Product.__table__, 'after_create')
+def install_on_create(table, connection, **kwargs):
+    install(connection)
+
+
+@event.listens_for(Product.__table__, 'before_drop')
+def uninstall_on_drop(table, connection, **kwargs):
+    # The triggers and the PostgreSQL index go with the table
+    if connection.dialect.name == 'sqlite':
+        connection.execute('DROP TABLE IF EXISTS product_search')
+    _detected.clear()
+
+
+def backend():
+    configured = current_app.config['PRODUCT_SEARCH_BACKEND']
+    if configured != 'auto':
+        return configured
+    bind = db.session.get_bind()
+    key = str(bind.url)
+    if key not in _detected:
+        name, query = _DETECT.get(bind.dialect.name, (MEMORY, None))
+        if (query is not None and
+                db.session.execute(text(query)).first() is None):
+            name = MEMORY
+        _detected[key] = name
+    return _detected[key]
+
+
+def search(query, limit):
+    """
+    Products whose title contains a word starting with every word of the
+    query, titles starting with the query first, then shorter ones.
+    Trigram search matches the words anywhere in titles.
+
+    :return: list of rows with id, title, price and bogof
+    """
+    tokens = tokenize(query)
+    if not tokens:
+        return []
+    name = backend()
+    if name == MEMORY:
+        from project.server.catalog import catalog
+        snapshot = catalog.snapshot()
+        return snapshot.search_index.search(
+            snapshot.products, tokens, limit,
+            current_app.config['PRODUCT_SEARCH_CANDIDATES'])
+    columns = (Product.id, Product.title, Product.price, Product.bogof)
+    # Ranking every match of a short prefix would take long on big catalogs,
+    # like the memory backend only the first candidates are ranked
+    params = {'limit': limit,
+              'candidates': current_app.config['PRODUCT_SEARCH_CANDIDATES'],
+              'phrase': ' '.join(tokens) + '%'}
+    if name == FTS5:
+        params['match'] = ' '.join('"%s"*' % token for token in tokens)
+        candidates = ('SELECT rowid FROM product_search '
+                      'WHERE product_search MATCH :match LIMIT :candidates')
+        starts_with = 'title LIKE :phrase'
+    else:
+        conditions = []
+        for i, token in enumerate(tokens):
+            params['token%s' % i] = '%%%s%%' % token
+            conditions.append('title ILIKE :token%s' % i)
+        candidates = 'SELECT id FROM products WHERE %s LIMIT :candidates' % (
+            ' AND '.join(conditions))
+        starts_with = 'title ILIKE :phrase'
+    statement = text(
+        'SELECT id, title, price, bogof FROM products WHERE id IN (%s) '
+        'ORDER BY %s DESC, length(title), id LIMIT :limit' % (
+            candidates, starts_with))
+    return db.session.execute(statement.columns(*columns), params).fetchall()
+
+
+class PrefixIndex(object):
+    """
+    In-memory inverted index of product titles: sorted distinct words and
+    the sorted product ids of every word. Treated as immutable once built,
+    updated() derives the index of the next catalog snapshot.
+    """
+
+    # Changed products above this share of the catalog rebuild the index
+    REBUILD_RATIO = 0.05
+    # Words of a prefix counted when picking the most selective query word
+    ESTIMATE_WORDS = 64
+
+    def __init__(self, postings):
+        self.postings = postings
+        self.words = sorted(postings)
+
+    @classmethod
+    def from_products(cls, products):
+        postings = {}
+        for product in products:
+            for token in tokenize(product.title):
+                ids = postings.get(token)
+                if ids is None:
+                    ids = postings[token] = array('l')
+                ids.append(product.id)
+        # Products come ordered by id, so every posting list is sorted already
+        return cls(postings)
+
+    def updated(self, old, new):
+        """
+        Index of snapshot `new`, given this one indexes snapshot `old`.
+        Only products whose title changed are touched, posting lists are
+        copied before they change.
+        """
+        def changed(product, snapshot):
+            other = snapshot.products.get(product.id)
+            return other is None or other.title != product.title
+
+        removed = [product for product in old if changed(product, new)]
+        added = [product for product in new if changed(product, old)]
+        if len(removed) + len(added) > len(new) * self.REBUILD_RATIO + 100:
+            return self.from_products(new)
+        index = PrefixIndex.__new__(PrefixIndex)
+        index.postings = dict(self.postings)
+        index.words = self.words
+        copied = set()
+
+        def ids(token):
+            if token not in copied:
+                copied.add(token)
+                index.postings[token] = array(
+                    'l', index.postings.get(token, ()))
+            return index.postings[token]
+
+        for product in removed:
+            for token in tokenize(product.title):
+                ids(token).remove(product.id)
+        for product in added:
+            for token in tokenize(product.title):
+                bisect.insort(ids(token), product.id)
+        for token in copied:
+            if not index.postings[token]:
+                del index.postings[token]
+        if any((token in index.postings) != (token in self.postings)
+               for token in copied):
+            index.words = sorted(index.postings)
+        return index
+
+    def _range(self, prefix):
+        start = bisect.bisect_left(self.words, prefix)
+        end = bisect.bisect_left(
+            self.words, prefix[:-1] + chr(ord(prefix[-1]) + 1), start)
+        return start, end
+
+    def _estimate(self, prefix):
+        start, end = self._range(prefix)
+        words = islice(self.words, start,
+                       min(end, start + self.ESTIMATE_WORDS))
+        return sum(len(self.postings[word]) for word in words)
+
+    def search(self, products, tokens, limit, candidates):
+        """
+        :param products: {id: ProductRecord} of the indexed snapshot
+        :param tokens: tokenized query
+        :param candidates: product ids collected for the most selective
+            query word at most, matches beyond them are not found
+        :return: list of ProductRecords, best matches first
+        """
+        driver = min(tokens, key=self._estimate)
+        start, end = self._range(driver)
+        found = set()
+        for word in islice(self.words, start, end):
+            found.update(islice(self.postings[word], candidates - len(found)))
+            if len(found) >= candidates:
+                break
+        others = [token for token in tokens if token != driver]
+        phrase = ' '.join(tokens)
+        ranked = []
+        for product_id in found:
+            product = products[product_id]
+            words = tokenize(product.title)
+            if all(any(word.startswith(token) for word in words)
+                   for token in others):
+                exact = sum(token in words for token in tokens)
+                key = (not ' '.join(words).startswith(phrase), -exact,
+                       len(product.title), product.id)
+                ranked.append((key, product))
+        ranked.sort(key=lambda entry: entry[0])
+        return [product for _, product in ranked[:limit]]
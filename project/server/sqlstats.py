@@ -0,0 +1,165 @@
+# project/server/sqlstats.py
+
+
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_IN_LIST = re.compile(r'\(\s*(?:\?|%\(\w+\)s|:\w+)'
+                      r'(?:\s*,\s*(?:\?|%\(\w+\)s|:\w+))+\s*\)')
+_SPACES = re.compile(r'\s+')
+
+_local = threading.local()
+
+
+def normalize(statement):
+    """
+    Statement text without literal differences so equivalent queries aggregate,
+    e.g. `IN (?, ?, ?)` becomes `IN (?)`.
+    """
+    return _IN_LIST.sub('(?)', _SPACES.sub(' ', statement).strip())
+
+
+class QueryLog(list):
+    """
+    (statement, seconds) of the queries run while recording.
+    """
+
+    @property
+    def seconds(self):
+        return sum(duration for _, duration in self)
+
+    def __str__(self):
+        return '\n'.join('%.3fms %s' % (duration * 1000, statement)
+                         for statement, duration in self)
+
+
+def _recorders():
+    if not hasattr(_local, 'recorders'):
+        _local.recorders = []
+    return _local.recorders
+
+
+@contextmanager
+def record():
+    """
+    Collect the queries run by this thread within the block, blocks may be
+    nested.
+    """
+    log = QueryLog()
+    recorders = _recorders()
+    recorders.append(log)
+    try:
+        yield log
+    finally:
+        recorders.remove(log)
+
+
+class SqlStats(object):
+    """
+    Aggregated queries of all requests by normalized statement,
+    served as /api/_metrics/sql. At most `max_statements` distinct
+    statements are tracked, others are only counted in the totals.
+    """
+
+    def __init__(self, max_statements=500, top=20):
+        self.max_statements = max_statements
+        self.top = top
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = self.queries = 0
+            self.seconds = 0.0
+            self.statements = {}
+
+    def add_request(self, log):
+        with self._lock:
+            self.requests += 1
+            self.queries += len(log)
+            self.seconds += log.seconds
+            for statement, duration in log:
+                entry = self.statements.get(statement)
+                if entry is None:
+                    if len(self.statements) >= self.max_statements:
+                        continue
+                    entry = self.statements[statement] = [0, 0.0, 0.0]
+                entry[0] += 1
+                entry[1] += duration
+                entry[2] = max(entry[2], duration)
+
+    def stats(self):
+        with self._lock:
+            statements = sorted(self.statements.items(),
+                                key=lambda item: item[1][1], reverse=True)
+            return {
+                'requests': self.requests,
+                'queries': self.queries,
+                'queries_per_request': (
+                    round(self.queries / self.requests, 2)
+                    if self.requests else None),
+                'total_ms': round(self.seconds * 1000, 3),
+                'statements': [{
+                    'statement': statement,
+                    'count': count,
+                    'total_ms': round(seconds * 1000, 3),
+                    'max_ms': round(max_seconds * 1000, 3),
+                } for statement, (count, seconds, max_seconds)
+                    in statements[:self.top]],
+            }
+
+
+sql_stats = SqlStats()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    if _recorders():
+        conn.info.setdefault('sqlstats_started', []).append(
+            time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    recorders = _recorders()
+    started = conn.info.get('sqlstats_started')
+    if not recorders or not started:
+        return
+    entry = (normalize(statement), time.perf_counter() - started.pop())
+    for log in recorders:
+        log.append(entry)
+
+
+def init_app(app):
+    """
+    Record the queries of every request. With SQL_SERVER_TIMING enabled their
+    count and time are reported in a `Server-Timing` response header.
+    """
+    @app.before_request
+    def start_recording():
+        log = request.environ['sqlstats.log'] = QueryLog()
+        _recorders().append(log)
+
+    @app.after_request
+    def server_timing(response):
+        log = request.environ.get('sqlstats.log')
+        if log is not None and app.config['SQL_SERVER_TIMING']:
+            response.headers.add('Server-Timing',
+                                 'sql;dur=%.3f;desc="%d queries"' % (
+                                     log.seconds * 1000, len(log)))
+        return response
+
+    @app.teardown_request
+    def stop_recording(exc=None):
+        log = request.environ.pop('sqlstats.log', None)
+        if log is not None:
+            _recorders().remove(log)
+            sql_stats.add_request(log)
@@ -1,2 +1 @@
 # project/server/user/__init__.py
-admin_user_token = 'admin_auth_token'
\ No newline at end of file
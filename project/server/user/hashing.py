@@ -0,0 +1,185 @@
+# project/server/user/hashing.py
+"""
+Password hashing off the request workers. bcrypt at production cost takes
+most of a second of CPU, so registrations and logins hash in a small process
+pool instead of the thread serving the request. When more hashes are queued
+than PASSWORD_HASH_QUEUE, new ones fail fast with HashingBusy, answered with
+503, so that login spikes don't starve cart traffic.
+PASSWORD_HASH_WORKERS = 0 hashes in the calling thread.
+
+With BCRYPT_TARGET_MS set, BCRYPT_LOG_ROUNDS is calibrated at startup to hash
+in about that long on the current hardware. Hashes of another cost are
+replaced on the next successful login.
+"""
+
+
+import math
+import multiprocessing
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+import flask_bcrypt
+
+# Forking a threaded server process isn't safe. ProcessPoolExecutor takes
+# another start method from Python 3.7 on, 3.6 forks.
+POOL_OPTIONS = {'mp_context': multiprocessing.get_context('spawn')} \
+    if sys.version_info >= (3, 7) else {}
+
+
+class HashingBusy(Exception):
+    """Too many password hashes queued or the pool didn't answer in time."""
+
+
+def _hash(password, rounds):
+    hashed = flask_bcrypt.generate_password_hash(password, rounds)
+    return hashed.decode('utf-8')
+
+
+def _check(pw_hash, password):
+    return flask_bcrypt.check_password_hash(pw_hash, password)
+
+
+def hash_rounds(pw_hash):
+    """
+    :param pw_hash: bcrypt hash, e.g. '$2b$12$...'
+    :return: log2 of its cost
+    """
+    return int(pw_hash.split('$')[2])
+
+
+def calibrate(target_ms, min_rounds, max_rounds, probe_rounds=8):
+    """
+    Pick the bcrypt cost hashing in about target_ms on this machine,
+    every round doubles the time of a hash.
+
+    :return: rounds between min_rounds and max_rounds
+    """
+    elapsed = min(_timed_hash(probe_rounds) for _ in range(3))
+    rounds = probe_rounds + round(math.log2(target_ms / 1000.0 / elapsed))
+    return max(min_rounds, min(max_rounds, rounds))
+
+
+def _timed_hash(rounds):
+    start = time.perf_counter()
+    _hash('calibration', rounds)
+    return time.perf_counter() - start
+
+
+class PasswordHasher(object):
+    """
+    Bounded process pool hashing and checking passwords, started on first use.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self.configure()
+
+    def configure(self, workers=0, queue_limit=0, timeout=None):
+        """
+        :param workers: processes, 0 hashes in the calling thread
+        :param queue_limit: hashes running or waiting at most
+        :param timeout: seconds a caller waits for its hash
+        """
+        self.close()
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.timeout = timeout
+        self.pending = 0
+        self.hashed = self.checked = self.rehashed = 0
+        self.rejected = self.timeouts = 0
+
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def _run(self, fn, *args):
+        if not self.workers:
+            return fn(*args)
+        with self._lock:
+            if self.pending >= self.queue_limit:
+                self.rejected += 1
+                raise HashingBusy()
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(self.workers,
+                                                     **POOL_OPTIONS)
+            self.pending += 1
+            future = self._executor.submit(fn, *args)
+        # A caller giving up doesn't free the slot, its hash still runs
+        future.add_done_callback(self._done)
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            self.timeouts += 1
+            raise HashingBusy()
+
+    def _done(self, future):
+        with self._lock:
+            self.pending -= 1
+
+    def hash(self, password, rounds):
+        """
+        :return: bcrypt hash of the password
+        :raises HashingBusy: if the pool is saturated
+        """
+        pw_hash = self._run(_hash, password, rounds)
+        self.hashed += 1
+        return pw_hash
+
+    def check(self, pw_hash, password):
+        """
+        :return: True if the password matches the hash
+        :raises HashingBusy: if the pool is saturated
+        """
+        result = self._run(_check, pw_hash, password)
+        self.checked += 1
+        return result
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'pending': self.pending,
+            'hashed': self.hashed,
+            'checked': self.checked,
+            'rehashed': self.rehashed,
+            'rejected': self.rejected,
+            'timeouts': self.timeouts,
+        }
+
+
+password_hasher = PasswordHasher()
+
+
+def init_app(app):
+    config = app.config
+    if config['BCRYPT_TARGET_MS']:
+        config['BCRYPT_LOG_ROUNDS'] = calibrate(
+            config['BCRYPT_TARGET_MS'], config['BCRYPT_MIN_ROUNDS'],
+            config['BCRYPT_MAX_ROUNDS'])
+    password_hasher.configure(config['PASSWORD_HASH_WORKERS'],
+                              config['PASSWORD_HASH_QUEUE'],
+                              config['PASSWORD_HASH_TIMEOUT'])
+
+
+def check_and_upgrade(user, password, rounds):
+    """
+    Check the password of a user and rehash it if it was stored with another
+    cost than rounds. Committing is up to the caller.
+
+    :return: True if the password matches
+    :raises HashingBusy: if the pool is saturated when checking
+    """
+    if not password_hasher.check(user.password, password):
+        return False
+    if hash_rounds(user.password) != rounds:
+        try:
+            user.password = password_hasher.hash(password, rounds)
+            password_hasher.rehashed += 1
+        except HashingBusy:
+            # Upgraded on a later login
+            pass
+    return True
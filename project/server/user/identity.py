@@ -0,0 +1,107 @@
+# project/server/user/identity.py
+
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+from project.server import db
+from project.server.cache import TTLCache
+from project.server.models import User
+
+# Session info key of the ids of users changed in the transaction, True for all
+_CHANGED = 'identity_changed'
+
+# user id -> SessionUser of logged in users. Changes made through the ORM
+# invalidate the entry in this process, other processes and raw SQL updates
+# are picked up within the TTL.
+identity_cache = TTLCache()
+
+
+class SessionUser(object):
+    """
+    What session authentication and the templates need of a logged in user,
+    with the Flask-Login interface of User. Load the User for anything else.
+    """
+    __slots__ = ('id', 'email', 'admin', 'loyalty_card')
+
+    def __init__(self, id, email, admin, loyalty_card):
+        self.id = id
+        self.email = email
+        self.admin = admin
+        self.loyalty_card = loyalty_card
+
+    def is_authenticated(self):
+        return True
+
+    def is_active(self):
+        return True
+
+    def is_anonymous(self):
+        return False
+
+    def get_id(self):
+        return self.id
+
+
+def init_app(app):
+    identity_cache.configure(app.config['USER_IDENTITY_CACHE_SIZE'],
+                             app.config['USER_IDENTITY_CACHE_TTL'])
+
+
+def load_identity(user_id):
+    """
+    Served from the cache when possible, otherwise a single primary key lookup.
+
+    :return: SessionUser, None for unknown users
+    """
+    identity = identity_cache.get(user_id)
+    if identity is None:
+        row = db.session.query(
+            User.id, User.email, User.admin, User.loyalty_card).filter(
+            User.id == user_id).first()
+        if row is None:
+            return None
+        identity = SessionUser(*row)
+        identity_cache.set(user_id, identity)
+    return identity
+
+
+def set_loyalty_card(user_id, loyalty_card):
+    """
+    Update a cached identity, for changes that don't go through the ORM
+    like the write-behind of the cart store.
+    """
+    identity = identity_cache.get(user_id)
+    if identity is not None:
+        identity_cache.set(user_id, SessionUser(
+            identity.id, identity.email, identity.admin, loyalty_card))
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def user_changed(mapper, connection, target):
+    changed = object_session(target).info.setdefault(_CHANGED, set())
+    if changed is not True:
+        changed.add(target.id)
+
+
+@event.listens_for(Session, 'after_bulk_update')
+@event.listens_for(Session, 'after_bulk_delete')
+def users_changed(context):
+    if context.mapper.class_ is User:
+        context.session.info[_CHANGED] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_on_commit(session):
+    changed = session.info.pop(_CHANGED, None)
+    if changed is True:
+        identity_cache.clear()
+    elif changed:
+        for user_id in changed:
+            identity_cache.pop(user_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_on_rollback(session):
+    session.info.pop(_CHANGED, None)
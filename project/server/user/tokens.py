@@ -0,0 +1,54 @@
+# project/server/user/tokens.py
+
+
+import datetime
+
+from project.server import db
+from project.server.cache import TTLCache
+from project.server.models import ApiToken
+
+# token hash -> user id of valid tokens. Revocation invalidates the entry in
+# this process, other processes keep accepting the token for at most the TTL.
+token_cache = TTLCache()
+
+
+def init_app(app):
+    token_cache.configure(app.config['API_TOKEN_CACHE_SIZE'],
+                          app.config['API_TOKEN_CACHE_TTL'])
+
+
+def user_id_for_token(token):
+    """
+    Resolve an API token to the id of its user.
+    Served from the cache when possible, otherwise a single indexed lookup.
+
+    :return: user id, None for unknown or revoked tokens
+    """
+    token_hash = ApiToken.hash(token)
+    user_id = token_cache.get(token_hash)
+    if user_id is None:
+        row = db.session.query(ApiToken.user_id).filter(
+            ApiToken.token_hash == token_hash,
+            ApiToken.revoked_on.is_(None)
+        ).first()
+        if row is None:
+            return None
+        user_id = row.user_id
+        token_cache.set(token_hash, user_id)
+    return user_id
+
+
+def revoke_token(token):
+    """
+    Revoke an API token. Committing is up to the caller.
+
+    :return: True if a valid token was revoked
+    """
+    token_hash = ApiToken.hash(token)
+    revoked = ApiToken.query.filter(
+        ApiToken.token_hash == token_hash,
+        ApiToken.revoked_on.is_(None)
+    ).update({ApiToken.revoked_on: datetime.datetime.now()},
+             synchronize_session=False)
+    token_cache.pop(token_hash)
+    return bool(revoked)
@@ -2,25 +2,36 @@
 
 
 from flask import render_template, Blueprint, url_for, \
-    redirect, flash, request
+    redirect, flash, request, current_app
 from flask_login import login_user, logout_user, login_required
 
-from project.server import bcrypt, db
+from project.server import db
 from project.server.models import User
+from project.server.user.hashing import HashingBusy, check_and_upgrade
 from project.server.user.forms import LoginForm, RegisterForm
 
 
 user_blueprint = Blueprint('user', __name__,)
 
 
+def busy(template, form):
+    """Answer 503 when the password hashing pool is saturated."""
+    flash('Too many requests right now, please try again in a moment.',
+          'danger')
+    return render_template(template, form=form), 503, {'Retry-After': '1'}
+
+
 @user_blueprint.route('/register', methods=['GET', 'POST'])
 def register():
     form = RegisterForm(request.form)
     if form.validate_on_submit():
-        user = User(
-            email=form.email.data,
-            password=form.password.data
-        )
+        try:
+            user = User(
+                email=form.email.data,
+                password=form.password.data
+            )
+        except HashingBusy:
+            return busy('user/register.html', form)
         db.session.add(user)
         db.session.commit()
 
@@ -37,8 +48,15 @@ def login():
     form = LoginForm(request.form)
     if form.validate_on_submit():
         user = User.query.filter_by(email=form.email.data).first()
-        if user and bcrypt.check_password_hash(
-                user.password, request.form['password']):
+        try:
+            valid = user and check_and_upgrade(
+                user, request.form['password'],
+                current_app.config['BCRYPT_LOG_ROUNDS'])
+        except HashingBusy:
+            return busy('user/login.html', form)
+        if valid:
+            # Stores the password hash if it was upgraded
+            db.session.commit()
             login_user(user)
             flash('You are logged in. Welcome!', 'success')
             return redirect(url_for('main.home'))
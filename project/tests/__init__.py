@@ -1 +1,7 @@
 # project/server/tests/__init__.py
+
+import os
+
+# Fail on implicit lazy loads, queries must load what they use
+# (project/server/loading.py). Set before the models are imported.
+os.environ.setdefault('SQLALCHEMY_RELATIONSHIP_LOADING', 'raise_on_sql')
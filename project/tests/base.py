@@ -1,14 +1,29 @@
 # project/server/tests/base.py
 
 
+from contextlib import contextmanager
+
+from flask import g
 from flask_testing import TestCase
 
-from project.server import db, create_app
-from project.server.models import User, Product
+from project.server import db, create_app, sqlstats
+from project.server.catalog import catalog
+from project.server.main.utils import check_cart
+from project.server.loading import FULL_CART
+from project.server.models import User, Product, Cart
+from project.server.user.identity import identity_cache
+from project.server.user.tokens import token_cache
 
 app = create_app()
 
 
+@app.before_request
+def forget_user():
+    # flask_testing keeps one app context, and its g, for all the requests
+    # of a test. Don't let a request reuse the User another one loaded.
+    g.pop('user', None)
+
+
 class BaseTestCase(TestCase):
 
     def create_app(self):
@@ -17,15 +32,46 @@ class BaseTestCase(TestCase):
 
     def setUp(self):
         self.db = db
+        token_cache.clear()
+        identity_cache.clear()
+        catalog.invalidate()
         db.create_all()
-        user = User(email="ad@min.com", password="admin_user")
+        user = User(email="ad@min.com", password="admin_user", admin=True)
         db.session.add(user)
-        db.session.add(Product(title="Apple", price=2))
-        db.session.add(Product(title="Cat", price=10, bogof=True))
-        db.session.add(Product(title="Butter", price=4))
+        db.session.add(Product(title="Apple", price=200))
+        db.session.add(Product(title="Cat", price=1000, bogof=True))
+        db.session.add(Product(title="Butter", price=400))
         db.session.commit()
-        self.user = user
+        self.user_id = user.id
+
+    @property
+    def user(self):
+        """
+        The test user. Flask 1.0.2's test client removes the session when
+        given json=, instances loaded before a request are detached after it.
+        """
+        return User.query.get(self.user_id)
 
     def tearDown(self):
         db.session.remove()
         db.drop_all()
+
+    def load_cart(self, cart_id=None):
+        """Cart with everything loaded, the first one if no id is given."""
+        query = Cart.query.options(*FULL_CART).populate_existing()
+        if cart_id:
+            return query.get(cart_id)
+        return query.order_by(Cart.id).first()
+
+    def assertCartConsistent(self, cart):
+        """Ensure incremental totals match a full recomputation."""
+        self.assertEqual(check_cart(self.load_cart(cart.id)), {})
+
+    @contextmanager
+    def assertMaxQueries(self, n):
+        """Fail if the block runs more than n SQL queries."""
+        with sqlstats.record() as queries:
+            yield queries
+        if len(queries) > n:
+            self.fail('%d queries executed, at most %d expected:\n%s' % (
+                len(queries), n, queries))
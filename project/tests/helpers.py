@@ -1 +1,88 @@
 # tests/helpers.py
+
+
+import asyncio
+import threading
+from json import dumps, loads
+
+from aiohttp.test_utils import TestClient, TestServer
+
+
+class AsyncResponse(object):
+    """Subset of the Flask test response the API tests read."""
+
+    def __init__(self, status_code, headers, data):
+        self.status_code = status_code
+        self.headers = headers
+        self.data = data
+        self.mimetype = headers.get('Content-Type', '').split(';')[0]
+
+    @property
+    def json(self):
+        return loads(self.data.decode('utf-8')) if self.data else None
+
+
+class AsyncAppClient(object):
+    """
+    Synchronous client of an aiohttp application, with the interface of the
+    Flask test client used by the API tests. The application is served by
+    an event loop in a background thread.
+    """
+
+    def __init__(self, app):
+        self.environ_base = {}
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       daemon=True)
+        self.thread.start()
+        self.client = self._run(self._start(app))
+
+    async def _start(self, app):
+        client = TestClient(TestServer(app))
+        await client.start_server()
+        return client
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def close(self):
+        self._run(self.client.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    async def _request(self, method, path, data, headers):
+        async with self.client.request(method, path, data=data,
+                                       headers=headers) as response:
+            return AsyncResponse(response.status, response.headers,
+                                 await response.read())
+
+    def open(self, path, method='GET', json=None, data=None, headers=None,
+             content_type=None):
+        environ = {'HTTP_AUTHORIZATION': 'Authorization',
+                   'CONTENT_TYPE': 'Content-Type'}
+        request_headers = {header: self.environ_base[key]
+                           for key, header in environ.items()
+                           if self.environ_base.get(key) is not None}
+        if json is not None:
+            data = dumps(json)
+            content_type = 'application/json'
+        if content_type:
+            request_headers['Content-Type'] = content_type
+        request_headers.update(headers or {})
+        return self._run(self._request(method, path, data, request_headers))
+
+    def get(self, path, **kwargs):
+        return self.open(path, 'GET', **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.open(path, 'POST', **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.open(path, 'PUT', **kwargs)
+
+    def patch(self, path, **kwargs):
+        return self.open(path, 'PATCH', **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.open(path, 'DELETE', **kwargs)
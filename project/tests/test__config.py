@@ -3,14 +3,22 @@
 
 import unittest
 import os
+import tempfile
 
 from flask import current_app
 from flask_testing import TestCase
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import TimeoutError
 
-from project.server import create_app
+from project.server import create_app, init_migrate, db
+from project.server.database import TimedQueuePool, pool_stats, warmup
 
 app = create_app()
 
+MIGRATIONS = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir,
+                          'migrations')
+
 
 class TestDevelopmentConfig(TestCase):
 
@@ -54,5 +62,88 @@ class TestProductionConfig(TestCase):
             'SECRET_KEY', default='my_precious'))
 
 
+class TestDatabaseConfig(TestCase):
+
+    def create_app(self):
+        # Own app, TESTING would leak into the config of the shared one
+        database_app = create_app()
+        database_app.config.from_object('project.server.config.TestingConfig')
+        return database_app
+
+    def test_engine_options(self):
+        options = {}
+        self.app.config.update(SQLALCHEMY_POOL_PRE_PING=True,
+                               DATABASE_STATEMENT_TIMEOUT=5000)
+        db.apply_driver_hacks(
+            self.app, make_url('postgresql://localhost/meneto'), options)
+        self.assertEqual(options['poolclass'], TimedQueuePool)
+        self.assertTrue(options['pool_pre_ping'])
+        self.assertEqual(options['connect_args'],
+                         {'options': '-c statement_timeout=5000'})
+        options = {}
+        self.app.config.update(SQLALCHEMY_POOL_PRE_PING=False)
+        db.apply_driver_hacks(self.app, make_url('sqlite://'), options)
+        self.assertNotEqual(options['poolclass'], TimedQueuePool)
+        self.assertNotIn('pool_pre_ping', options)
+
+    def test_pool_stats(self):
+        pool_stats.reset()
+        with tempfile.NamedTemporaryFile(suffix='.db') as f:
+            engine = create_engine('sqlite:///%s' % f.name,
+                                   poolclass=TimedQueuePool, pool_size=1,
+                                   max_overflow=0, pool_timeout=0.05)
+            connection = engine.connect()
+            with self.assertRaises(TimeoutError):
+                engine.connect()
+            stats = pool_stats.stats()
+            connection.close()
+            engine.dispose()
+        self.assertEqual((stats['size'], stats['checked_out'],
+                          stats['checkouts'], stats['timeouts']),
+                         (1, 1, 1, 1))
+        self.assertGreaterEqual(stats['wait_ms_max'], 50)
+        self.assertEqual(warmup(self.app)['connections'], 1)
+
+    def test_warmup_on_first_request(self):
+        pool_stats.warmup = None
+        self.app.config['DATABASE_WARMUP'] = True
+        self.client.get('/missing')
+        self.assertEqual(pool_stats.warmup['connections'], 1)
+
+    def test_migrations_match_models(self):
+        from flask_migrate import upgrade
+        init_migrate(self.app)
+        with tempfile.TemporaryDirectory() as directory:
+            url = 'sqlite:///%s' % os.path.join(directory, 'migrated.db')
+            self.app.config['SQLALCHEMY_DATABASE_URI'] = url
+            upgrade(MIGRATIONS)
+            engine = create_engine(url)
+            inspector = inspect(engine)
+            for table in db.metadata.sorted_tables:
+                columns = inspector.get_columns(table.name)
+                self.assertEqual({column['name'] for column in columns},
+                                 set(table.columns.keys()))
+                indexes = inspector.get_indexes(table.name)
+                self.assertLessEqual({index.name for index in table.indexes},
+                                     {index['name'] for index in indexes})
+            engine.dispose()
+
+
+class TestDeferredImports(unittest.TestCase):
+    """
+    Start times are checked by `manage.py import-time`, wall clock budgets
+    don't hold on loaded machines. Here: what the app factory doesn't import.
+    """
+
+    def test_deferred_imports(self):
+        from benchmarks import startup
+        for name, arguments in startup.TARGETS[1:]:
+            modules = startup.measure(arguments, repeat=1)[2]
+            self.assertIn('flask', modules)
+            # Deferred until the db commands or the first quote need them
+            self.assertNotIn('flask_migrate', modules)
+            self.assertNotIn('numpy', modules)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,19 +1,47 @@
 # project/server/tests/test_main.py
 import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError, StatementError
 from sqlalchemy.sql import func
 
 from flask import url_for
 
-from project.server.models import Product, Cart, CartItem
+from project.server import cartstore
+from project.server.catalog import catalog
+from project.server.asyncapi import create_app as create_async_app
+from project.server.sqlstats import sql_stats, normalize
+from project.server.loading import CART_ITEM
+from project.server.main.coalescing import coalescer
+from project.server.main.pricing import MAX_QUANTITY, quote_baskets
+from project.server.main.transactions import unit_of_work, transaction_stats
+from project.server.repricing import repricer, verify_carts
+from project.server.main.serializers import (
+    CartSchema, CartItemSchema, dump_cart, dump_cart_item)
+from project.server.main.utils import update_cart, check_cart, cart_total
+from project.server.models import User, Product, Cart, CartItem
+from project.server.money import format_cents, to_cents
+from project.server.user.tokens import (
+    token_cache, user_id_for_token, revoke_token)
 from project.tests.base import BaseTestCase
+from project.tests.helpers import AsyncAppClient
 
 
 class TestApiBlueprint(BaseTestCase):
     def setUp(self):
         super().setUp()
-        # self.headers = {'Content-Type': 'application/json', 'Authorization': 'Token %s' % self.user.get_token()}
-        self.client.environ_base['HTTP_AUTHORIZATION'] = 'Token %s' % self.user.get_token()
+        self.token = self.user.get_token()
+        self.db.session.commit()
+        self.client.environ_base['HTTP_AUTHORIZATION'] = (
+            'Token %s' % self.token)
         self.client.environ_base['CONTENT_TYPE'] = 'application/json'
 
     def add_product_to_cart(self, product):
@@ -28,6 +56,44 @@ class TestApiBlueprint(BaseTestCase):
             url_for('api.get_cart'),
         )
         self.assertEqual(res.status_code, 403)
+        self.client.environ_base['HTTP_AUTHORIZATION'] = (
+            'Token admin_auth_token')
+        res = self.client.get(
+            url_for('api.get_cart'),
+        )
+        self.assertEqual(res.status_code, 403)
+
+    def test_token_cache(self):
+        token_cache.clear()
+        stats = token_cache.stats()
+        for _ in range(3):
+            res = self.client.get(url_for('api.get_metrics', name='auth'))
+            self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json['misses'], stats['misses'] + 1)
+        self.assertEqual(res.json['hits'], stats['hits'] + 2)
+        # Token of another user resolves to that user
+        other = User(email='other@user.com', password='other_user', admin=True)
+        token = other.get_token()
+        self.db.session.commit()
+        self.assertEqual(user_id_for_token(token), other.id)
+        # Revoked tokens are rejected even when cached
+        self.assertTrue(revoke_token(self.token))
+        self.db.session.commit()
+        res = self.client.get(url_for('api.get_metrics', name='auth'))
+        self.assertEqual(res.status_code, 403)
+        self.assertIsNone(user_id_for_token(self.token))
+        self.assertFalse(revoke_token(self.token))
+        self.client.environ_base['HTTP_AUTHORIZATION'] = 'Token %s' % token
+        res = self.client.get(url_for('api.get_metrics', name='unknown'))
+        self.assertEqual(res.status_code, 404)
+
+    def test_metrics_admin_only(self):
+        other = User(email='other@user.com', password='other_user')
+        token = other.get_token()
+        self.db.session.commit()
+        self.client.environ_base['HTTP_AUTHORIZATION'] = 'Token %s' % token
+        res = self.client.get(url_for('api.get_metrics', name='sql'))
+        self.assertEqual(res.status_code, 403)
 
     def test_add_to_cart(self):
         # Ensure 400 error is handled with non-existing product id
@@ -37,14 +103,14 @@ class TestApiBlueprint(BaseTestCase):
         )
         json = res.json
         self.assertEqual(res.status_code, 400)
-        self.assertIsNone(Cart.query.first())
+        self.assertIsNone(self.load_cart())
         self.assertEqual(json, {'product': 'Please specify a valid product id'})
         # Test adding product
         product = Product.query.first()
         res = self.add_product_to_cart(product)
         data = res.json['data']
         self.assertEqual(res.status_code, 201)
-        self.assertIsNotNone(Cart.query.first())
+        self.assertIsNotNone(self.load_cart())
         self.assertIsNotNone(data['id'])
         self.assertIsNotNone(data['quantity'], 1)
         self.assertIsNotNone(data['price'], product.price)
@@ -54,6 +120,7 @@ class TestApiBlueprint(BaseTestCase):
         data = res.json['data']
         self.assertEqual(res.status_code, 201)
         self.assertIsNotNone(data['quantity'], 2)
+        self.assertCartConsistent(self.load_cart())
 
     def test_get_cart(self):
         # Test 404 handled properly
@@ -72,13 +139,50 @@ class TestApiBlueprint(BaseTestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(len(json['cart_items']), 1)
         self.assertEqual(json['user'], self.user.id)
-        self.assertEqual(json['total'], str(product.price))
+        self.assertEqual(json['total'], format_cents(product.price))
+
+    def test_get_cart_etag(self):
+        apple, cat, butter = Product.query.order_by(Product.id).all()
+        self.add_product_to_cart(apple)
+        res = self.client.get(url_for('api.get_cart'))
+        etag = res.headers['ETag']
+        self.assertEqual(res.status_code, 200)
+        self.assertFalse(etag.startswith('W/'))
+        res = self.client.get(url_for('api.get_cart'),
+                              headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+        self.assertEqual(res.headers['ETag'], etag)
+        item_id = self.add_product_to_cart(cat).json['data']['id']
+        mutations = (
+            lambda: self.add_product_to_cart(cat),
+            lambda: self.client.patch(
+                url_for('api.update_cart_item', pk=item_id),
+                json={'quantity': 1}),
+            lambda: self.client.patch(
+                url_for('api.toggle_loyalty_card', pk=self.user.id)),
+            lambda: self.client.delete(
+                url_for('api.remove_cart_item', pk=item_id)),
+        )
+        for mutate in mutations:
+            self.assertEqual(mutate().status_code // 100, 2)
+            res = self.client.get(url_for('api.get_cart'),
+                                  headers={'If-None-Match': etag})
+            self.assertEqual(res.status_code, 200)
+            self.assertNotEqual(res.headers['ETag'], etag)
+            etag = res.headers['ETag']
+        # Product changes invalidate the ETag too
+        Product.query.get(butter.id).title = 'Margarine'
+        self.db.session.commit()
+        res = self.client.get(url_for('api.get_cart'),
+                              headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
 
     def test_remove_cart_item(self):
         for product in Product.query.all():
             self.add_product_to_cart(product)
 
-        cart = Cart.query.first()
+        cart = self.load_cart()
         total = self.db.session.query(func.sum(CartItem.price).label('total')).first().total
         self.assertEqual(len(cart.cart_items), 3)
         self.assertEqual(cart.total, total)
@@ -87,10 +191,12 @@ class TestApiBlueprint(BaseTestCase):
             url_for('api.remove_cart_item', pk=cart_item_for_removal.id),
         )
         self.assertEqual(res.status_code, 200)
+        cart = self.load_cart()
         self.assertEqual(len(cart.cart_items), 2)
         self.assertLess(cart.total, total)
         total = self.db.session.query(func.sum(CartItem.price).label('total')).first().total
         self.assertEqual(cart.total, total)
+        self.assertCartConsistent(cart)
 
     def test_update_cart_item(self):
         product = Product.query.first()
@@ -99,7 +205,7 @@ class TestApiBlueprint(BaseTestCase):
         cart_item_data = res.json['data']
         # Test increment quantity
         cart_item_data['quantity'] += 1
-        self.assertEqual(cart_item_data['price'], str(product.price))
+        self.assertEqual(cart_item_data['price'], format_cents(product.price))
         res = self.client.put(
             url_for('api.update_cart_item', pk=cart_item_data['id']),
             data=json.dumps(cart_item_data),
@@ -107,7 +213,9 @@ class TestApiBlueprint(BaseTestCase):
         )
         self.assertEqual(res.status_code, 200)
         cart_item_data = res.json
-        self.assertEqual(cart_item_data['price'], str(product.price * 2))
+        self.assertEqual(cart_item_data['price'],
+                         format_cents(product.price * 2))
+        self.assertCartConsistent(self.load_cart())
         # Test auto removal if quantity = 0
         cart_item_data['quantity'] = 0
         res = self.client.put(
@@ -118,6 +226,923 @@ class TestApiBlueprint(BaseTestCase):
         data = res.json
         self.assertEqual(data, {})
         self.assertEqual(CartItem.query.count(), 0)
+        self.assertCartConsistent(self.load_cart())
+
+    def test_other_users_cart_item(self):
+        res = self.add_product_to_cart(Product.query.first())
+        item_id = res.json['data']['id']
+        other = User(email='other@user.com', password='other_user')
+        token = other.get_token()
+        self.db.session.commit()
+        self.client.environ_base['HTTP_AUTHORIZATION'] = 'Token %s' % token
+        # Lines of another user's cart are unknown to this one
+        res = self.client.patch(url_for('api.update_cart_item', pk=item_id),
+                                json={'quantity': 5})
+        self.assertEqual(res.status_code, 404)
+        res = self.client.delete(url_for('api.remove_cart_item', pk=item_id))
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(CartItem.query.get(item_id).quantity, 1)
+
+    def test_deleted_product(self):
+        apple, cat, butter = Product.query.order_by(Product.id).all()
+        price = cat.price
+        self.add_product_to_cart(cat)
+        item_id = self.add_product_to_cart(apple).json['data']['id']
+        self.db.session.delete(Product.query.get(apple.id))
+        self.db.session.commit()
+        # The line can't be priced any more, updating it removes it
+        res = self.client.patch(url_for('api.update_cart_item', pk=item_id),
+                                json={'quantity': 3})
+        self.assertEqual((res.status_code, res.json), (200, {}))
+        self.assertIsNone(CartItem.query.get(item_id))
+        cart = self.load_cart()
+        self.assertEqual(cart.total, price)
+        self.assertCartConsistent(cart)
+
+    def test_update_cart_item_validation(self):
+        res = self.add_product_to_cart(Product.query.first())
+        url = url_for('api.update_cart_item', pk=res.json['data']['id'])
+        for method, data in (('put', {}), ('put', {'quantity': 'a'}),
+                             ('patch', {'quantity': True})):
+            res = getattr(self.client, method)(
+                url, data=json.dumps(data), content_type='application/json')
+            self.assertEqual(res.status_code, 400)
+            self.assertIn('quantity', res.json)
+        # Partial update without quantity changes nothing, other fields are
+        # ignored
+        res = self.client.patch(url, data=json.dumps({'price': '0.01'}),
+                                content_type='application/json')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json['quantity'], 1)
+        self.assertEqual(res.json['price'], '2.00')
+        res = self.client.patch(url_for('api.update_cart_item', pk=123),
+                                data=json.dumps({'quantity': 1}),
+                                content_type='application/json')
+        self.assertEqual(res.status_code, 404)
+
+    def test_fast_serializers(self):
+        self.assertEqual(
+            self.client.get(url_for('api.get_cart')).status_code, 404)
+        for product in Product.query.all() * 3:
+            res = self.add_product_to_cart(product)
+            cart = self.load_cart()
+            item = CartItem.query.options(*CART_ITEM).get(
+                res.json['data']['id'])
+            self.assertEqual(json.dumps(dump_cart_item(item)),
+                             json.dumps(CartItemSchema().dump(item).data))
+            self.assertEqual(json.dumps(dump_cart(cart)),
+                             json.dumps(CartSchema().dump(cart).data))
+            res = self.client.get(url_for('api.get_cart'))
+            self.assertEqual(res.data.decode(), json.dumps(
+                CartSchema().dump(self.load_cart()).data))
+
+    def test_cart_operations(self):
+        apple, cat, butter = Product.query.order_by(Product.id).all()
+        self.add_product_to_cart(butter)
+        res = self.client.post(url_for('api.cart_operations'), json={
+            'operations': [
+                {'action': 'add', 'product': apple.id, 'quantity': 3},
+                {'action': 'add', 'product': cat.id, 'quantity': 4},
+                {'action': 'subtract', 'product': apple.id},
+                {'action': 'remove', 'product': butter.id},
+                {'action': 'add', 'product': butter.id, 'quantity': 2},
+                {'action': 'subtract', 'product': butter.id, 'quantity': 5},
+            ]})
+        self.assertEqual(res.status_code, 200)
+        items = {item['product']['id']: item
+                 for item in res.json['cart_items']}
+        self.assertEqual(sorted(items), [apple.id, cat.id])
+        self.assertEqual(items[apple.id]['quantity'], 2)
+        self.assertEqual(items[cat.id]['price'], '20.00')  # 4 cats, 2 paid
+        self.assertEqual(res.json['total'], '21.60')  # 24 * 0.9
+        cart = self.load_cart()
+        self.assertCartConsistent(cart)
+        version = cart.version
+        # Invalid operations apply nothing and name the failing operation
+        for index, operation in enumerate((
+                {'action': 'explode', 'product': apple.id},
+                {'action': 'add', 'product': 123},
+                {'action': 'add', 'product': apple.id, 'quantity': 0},
+                {'action': 'remove', 'product': butter.id})):
+            adds = [{'action': 'add', 'product': apple.id}] * index
+            res = self.client.post(url_for('api.cart_operations'), json={
+                'operations': adds + [operation]})
+            self.assertEqual(res.status_code, 400)
+            self.assertEqual(res.json['index'], index)
+            self.assertIn('operations', res.json)
+        res = self.client.post(url_for('api.cart_operations'),
+                               json={'operations': []})
+        self.assertEqual(res.status_code, 400)
+        self.db.session.expire_all()
+        self.assertEqual(cart.version, version)
+        self.assertEqual(
+            CartItem.query.filter_by(product=apple).one().quantity, 2)
+
+    def test_incremental_totals(self):
+        apple, cat, butter = Product.query.order_by(Product.id).all()
+        for product in (cat, cat, cat, butter, apple, cat, butter):
+            self.add_product_to_cart(product)
+        cart = self.load_cart()
+        self.assertCartConsistent(cart)
+        # 4 cats, 2 paid
+        self.assertEqual(cart.subtotal,
+                         2 * cat.price + 2 * butter.price + apple.price)
+        self.assertEqual(cart.total, 2700)  # -10% over 20
+        res = self.client.patch(
+            url_for('api.toggle_loyalty_card', pk=self.user.id))
+        self.assertEqual(res.status_code, 200)
+        self.assertCartConsistent(cart)
+        self.assertEqual(cart.total, 2646)  # 30 * 0.9 * 0.98
+        item = CartItem.query.filter_by(product=cat).first()
+        res = self.client.patch(
+            url_for('api.update_cart_item', pk=item.id),
+            data=json.dumps({'quantity': 1}),
+            content_type='application/json'
+        )
+        self.assertEqual(res.status_code, 200)
+        self.assertCartConsistent(cart)
+        self.assertEqual(cart.subtotal,
+                         cat.price + 2 * butter.price + apple.price)
+        self.assertEqual(cart.total, 1960)  # no -10% at exactly 20
+        self.client.delete(url_for('api.remove_cart_item', pk=item.id))
+        self.assertCartConsistent(cart)
+        self.assertEqual(cart.subtotal, 2 * butter.price + apple.price)
+
+    def test_check_cart(self):
+        for product in Product.query.all():
+            self.add_product_to_cart(product)
+        cart = self.load_cart()
+        self.assertEqual(check_cart(cart), {})
+        cart.subtotal += 1
+        cart.cart_items[0].price += 1
+        problems = check_cart(cart)
+        self.assertEqual(set(problems),
+                         {'subtotal', 'item %s' % cart.cart_items[0].id})
+        update_cart(cart)
+        self.assertEqual(check_cart(cart), {})
+
+    def test_money(self):
+        self.assertEqual(cart_total(2000, False), 2000)
+        # 1804.5 rounded half up
+        self.assertEqual(cart_total(2005, False), 1805)
+        # 1764.882, combined before rounding
+        self.assertEqual(cart_total(2001, True), 1765)
+        self.assertEqual(cart_total(25, True), 25)  # 24.5
+        self.assertEqual(format_cents(1234), '12.34')
+        self.assertEqual(format_cents(-5), '-0.05')
+        self.assertEqual(to_cents('12.3'), 1230)
+        self.assertRaises(ValueError, to_cents, '0.001')
+        self.assertRaises(ValueError, to_cents, 'NaN')
+        product = Product.query.first()
+        product.price = Decimal('2.00')
+        self.assertRaises(StatementError, self.db.session.flush)
+        self.db.session.rollback()
+
+    def test_quote_matches_update_cart(self):
+        products = Product.query.all()
+        rnd = random.Random(42)
+        baskets = [
+            [(p.id, rnd.randint(0, 7))
+             for p in rnd.sample(products, rnd.randint(0, len(products)))]
+            for _ in range(50)
+        ]
+        for loyalty_card in (False, True):
+            self.user.loyalty_card = loyalty_card
+            quotes = quote_baskets(baskets, loyalty_card)
+            with self.db.session.no_autoflush:
+                for basket, quote in zip(baskets, quotes):
+                    cart = Cart(user=self.user)
+                    for product_id, quantity in basket:
+                        CartItem(cart=cart,
+                                 product=Product.query.get(product_id),
+                                 quantity=quantity)
+                    update_cart(cart)
+                    self.assertEqual(quote['total'], cart.total)
+                    self.assertEqual(quote['subtotal'], sum(
+                        item.price for item in cart.cart_items))
+            self.db.session.rollback()
+
+    def test_quote(self):
+        apple, cat, butter = Product.query.order_by(Product.id).all()
+        res = self.client.post(
+            url_for('api.quote'),
+            json={'baskets': [[[apple.id, 1]],
+                              [[cat.id, 3], [butter.id, 4]],
+                              []],
+                  'loyalty_card': [False, True, True]},
+        )
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json['data'], [
+            {'subtotal': '2.00', 'total': '2.00'},
+            # 36 * 0.9 * 0.98 = 31.752
+            {'subtotal': '36.00', 'total': '31.75'},
+            {'subtotal': '0.00', 'total': '0.00'},
+        ])
+        self.assertIsNone(self.load_cart())
+        # Ensure validation errors
+        for baskets in ([[[123, 1]]], [[[apple.id, -1]]], [[[apple.id, 1.5]]],
+                        [[apple.id]], 'x', [[[apple.id, MAX_QUANTITY + 1]]],
+                        [[[apple.id, 2 ** 63]]]):
+            res = self.client.post(url_for('api.quote'),
+                                   json={'baskets': baskets})
+            self.assertEqual(res.status_code, 400)
+            self.assertIn('baskets', res.json)
+        # Amounts that would overflow int64 are refused, not wrapped around
+        gold = Product(title='Gold', price=10 ** 13)
+        self.db.session.add(gold)
+        self.db.session.commit()
+        res = self.client.post(url_for('api.quote'), json={
+            'baskets': [[[gold.id, MAX_QUANTITY]]]})
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(res.json['baskets'],
+                         'Baskets are too expensive to quote')
+
+    def test_list_products(self):
+        apple, cat, butter = Product.query.order_by(Product.id).all()
+        self.client.environ_base['HTTP_AUTHORIZATION'] = None
+        res = self.client.get(url_for('api.list_products', limit=2))
+        self.assert200(res)
+        self.assertEqual(res.json['data'], [
+            {'id': apple.id, 'title': 'Apple', 'price': '2.00',
+             'bogof': False},
+            {'id': cat.id, 'title': 'Cat', 'price': '10.00', 'bogof': True},
+        ])
+        self.assertEqual(res.json['next'], cat.id)
+        res = self.client.get(url_for('api.list_products', limit=2,
+                                      after=res.json['next']))
+        self.assertEqual([p['title'] for p in res.json['data']], ['Butter'])
+        self.assertIsNone(res.json['next'])
+
+        # Filters
+        def titles(**args):
+            res = self.client.get(url_for('api.list_products', **args))
+            return [p['title'] for p in res.json['data']]
+        self.assertEqual(titles(min_price='3'), ['Cat', 'Butter'])
+        self.assertEqual(titles(max_price='4.00', min_price='2.5'), ['Butter'])
+        self.assertEqual(titles(bogof='true'), ['Cat'])
+        self.assertEqual(titles(bogof='0', after=apple.id), ['Butter'])
+
+        for args in ({'limit': 0}, {'limit': 501}, {'limit': 'x'},
+                     {'after': -1}, {'min_price': 'cheap'},
+                     {'max_price': 'NaN'}, {'bogof': 'maybe'}):
+            res = self.client.get(url_for('api.list_products', **args))
+            self.assertEqual(res.status_code, 400)
+            self.assertIn(list(args)[0], res.json)
+
+    def test_stream_products(self):
+        apple, cat, butter = Product.query.order_by(Product.id).all()
+        res = self.client.get(url_for('api.list_products', format='ndjson'))
+        self.assert200(res)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        lines = [json.loads(line)
+                 for line in res.data.decode('utf-8').splitlines()]
+        self.assertEqual(lines, [{'id': p.id, 'title': p.title,
+                                  'price': format_cents(p.price),
+                                  'bogof': p.bogof}
+                                 for p in (apple, cat, butter)])
+        res = self.client.get(url_for('api.list_products', after=apple.id,
+                                      limit=1),
+                              headers={'Accept': 'application/x-ndjson'})
+        self.assertEqual([json.loads(line)['title']
+                          for line in res.data.decode('utf-8').splitlines()],
+                         ['Cat'])
+        # Streaming is kept out of the unit of work, its queries are counted
+        transaction_stats.reset()
+        sql_stats.reset()
+        res = self.client.get(url_for('api.list_products', format='ndjson'))
+        self.assertEqual(len(res.data.decode('utf-8').splitlines()), 3)
+        self.assertEqual(transaction_stats.stats()['requests'], 0)
+        self.assertEqual(sql_stats.stats()['queries'], 1)
+
+    def test_search_products(self):
+        self.client.environ_base['HTTP_AUTHORIZATION'] = None
+        self.db.session.add_all([
+            Product(title='Apple Juice', price=300),
+            Product(title='Red apple', price=100),
+            Product(title='Pineapple', price=500),
+            Product(title='Caterpillar toy', price=700)])
+        self.db.session.commit()
+        res = self.client.get(url_for('api.search_products'))
+        self.assertEqual(res.status_code, 400)
+        res = self.client.get(url_for('api.search_products', q='  !'))
+        self.assertEqual(res.status_code, 400)
+        for backend in ('fts5', 'memory'):
+            self.app.config['PRODUCT_SEARCH_BACKEND'] = backend
+            try:
+                def titles(q, **args):
+                    res = self.client.get(
+                        url_for('api.search_products', q=q, **args))
+                    self.assert200(res)
+                    return [p['title'] for p in res.json['data']]
+                self.assertEqual(titles('apple')[0], 'Apple')
+                self.assertEqual(set(titles('APP')),
+                                 {'Apple', 'Red apple', 'Apple Juice'})
+                self.assertEqual(titles('ap', limit=1), [titles('ap')[0]])
+                self.assertEqual(titles('jui app'), ['Apple Juice'])
+                self.assertEqual(titles('cat'), ['Cat', 'Caterpillar toy'])
+                self.assertEqual(titles('dog'), [])
+                # Product changes are searchable right away
+                product = Product.query.filter_by(
+                    title='Caterpillar toy').one()
+                product.title = 'Dog toy'
+                self.db.session.commit()
+                self.assertEqual(titles('dog'), ['Dog toy'])
+                self.assertEqual(titles('cat'), ['Cat'])
+                res = self.client.get(url_for('api.search_products', q='dog'))
+                self.assertEqual(res.json['data'][0],
+                                 {'id': product.id, 'title': 'Dog toy',
+                                  'price': '7.00', 'bogof': False})
+                self.db.session.delete(product)
+                self.db.session.commit()
+                self.assertEqual(titles('toy'), [])
+                self.db.session.add(
+                    Product(title='Caterpillar toy', price=700))
+                self.db.session.commit()
+            finally:
+                self.app.config['PRODUCT_SEARCH_BACKEND'] = 'auto'
+        # Titles starting with the query first, then by exact word matches
+        # and length
+        self.app.config['PRODUCT_SEARCH_BACKEND'] = 'memory'
+        try:
+            res = self.client.get(url_for('api.search_products', q='apple'))
+            self.assertEqual([p['title'] for p in res.json['data']],
+                             ['Apple', 'Apple Juice', 'Red apple'])
+        finally:
+            self.app.config['PRODUCT_SEARCH_BACKEND'] = 'auto'
+
+    def test_query_budgets(self):
+        # Ids up front, reloading expired test objects would be counted too
+        products = Product.query.order_by(Product.id)
+        apple, cat, butter = [product.id for product in products]
+        user_id = self.user.id
+        # Token lookup and catalog load happen once per process, the user
+        # is loaded by every request
+        with self.assertMaxQueries(10):
+            self.client.post(url_for('api.add_to_cart'),
+                             json={'product': apple})
+        with self.assertMaxQueries(4):
+            self.client.post(url_for('api.add_to_cart'), json={'product': cat})
+        with self.assertMaxQueries(3):
+            res = self.client.get(url_for('api.get_cart'))
+        with self.assertMaxQueries(1):
+            self.client.get(url_for('api.get_cart'),
+                            headers={'If-None-Match': res.headers['ETag']})
+        item_id = CartItem.query.filter_by(product_id=apple).one().id
+        with self.assertMaxQueries(3):
+            self.client.put(url_for('api.update_cart_item', pk=item_id),
+                            json={'quantity': 3})
+        with self.assertMaxQueries(3):
+            self.client.patch(url_for('api.update_cart_item', pk=item_id),
+                              json={'quantity': 2})
+        with self.assertMaxQueries(8):
+            self.client.post(url_for('api.cart_operations'), json={
+                'operations': [
+                    {'action': 'add', 'product': butter, 'quantity': 2},
+                    {'action': 'subtract', 'product': apple}]})
+        with self.assertMaxQueries(3):
+            self.client.delete(url_for('api.remove_cart_item', pk=item_id))
+        with self.assertMaxQueries(3):
+            self.client.patch(url_for('api.toggle_loyalty_card', pk=user_id))
+        with self.assertMaxQueries(1):
+            self.client.get(url_for('api.list_products', min_price=1))
+        with self.assertMaxQueries(0):
+            self.client.post(url_for('api.quote'),
+                             json={'baskets': [[[apple, 2]]]})
+        # Admin check, the identity is cached afterwards
+        with self.assertMaxQueries(1):
+            self.client.get(url_for('api.get_metrics', name='sql'))
+
+    def test_sql_metrics(self):
+        sql_stats.reset()
+        self.client.get(url_for('api.get_cart'))
+        self.assertNotIn('Server-Timing',
+                         self.client.get(url_for('api.get_cart')).headers)
+        self.app.config['SQL_SERVER_TIMING'] = True
+        try:
+            res = self.client.get(url_for('api.get_cart'))
+        finally:
+            self.app.config['SQL_SERVER_TIMING'] = False
+        self.assertRegex(res.headers['Server-Timing'],
+                         r'^sql;dur=[\d.]+;desc="1 queries"$')
+        data = self.client.get(url_for('api.get_metrics', name='sql')).json
+        self.assertEqual(data['requests'], 3)
+        statements = {entry['statement']: entry['count']
+                      for entry in data['statements']}
+        self.assertEqual(statements[
+            'SELECT carts.id AS carts_id, carts.version AS carts_version '
+            'FROM carts JOIN users ON carts.id = users.cart_id '
+            'WHERE users.id = ? LIMIT ? OFFSET ?'], 3)
+        self.assertEqual(normalize('SELECT *\n  FROM t WHERE id IN (?, ?,?)'),
+                         'SELECT * FROM t WHERE id IN (?)')
+
+    def test_unit_of_work(self):
+        apple = Product.query.first()
+        transaction_stats.reset()
+        self.add_product_to_cart(apple)
+        cart_item = CartItem.query.first()
+        self.client.delete(url_for('api.remove_cart_item', pk=cart_item.id))
+        stats = transaction_stats.stats()
+        self.assertEqual(
+            (stats['requests'], stats['commits'], stats['rollbacks']),
+            (2, 2, 0))
+        # Failed requests are rolled back
+        self.client.post(url_for('api.cart_operations'), json={'operations': [
+            {'action': 'add', 'product': apple.id},
+            {'action': 'add', 'product': 123}]})
+        self.assertEqual(transaction_stats.stats()['rollbacks'], 1)
+        self.assertEqual(CartItem.query.count(), 0)
+
+    def test_unit_of_work_retries(self):
+        class SerializationFailure(Exception):
+            pgcode = '40001'
+
+        calls = []
+
+        @unit_of_work
+        def view(failures, error=SerializationFailure()):
+            calls.append(1)
+            if len(calls) <= failures:
+                raise OperationalError('UPDATE carts', {}, error)
+            return 'ok'
+
+        transaction_stats.reset()
+        self.addCleanup(self.app.config.__setitem__,
+                        'API_TRANSACTION_RETRY_BACKOFF',
+                        self.app.config['API_TRANSACTION_RETRY_BACKOFF'])
+        self.app.config['API_TRANSACTION_RETRY_BACKOFF'] = 0
+        with self.app.test_request_context():
+            self.assertEqual(view(2), 'ok')
+            self.assertEqual(len(calls), 3)
+            self.assertEqual(transaction_stats.stats()['retries'], 2)
+            # Retries are bounded
+            del calls[:]
+            self.assertRaises(OperationalError, view, 10)
+            self.assertEqual(len(calls),
+                             self.app.config['API_TRANSACTION_RETRIES'] + 1)
+            self.assertEqual(transaction_stats.stats()['retries_exhausted'], 1)
+            # Other errors are not retried
+            del calls[:]
+            self.assertRaises(OperationalError, view, 1,
+                              Exception('no such table'))
+            self.assertEqual(len(calls), 1)
+            del calls[:]
+            self.assertEqual(view(1, Exception('database is locked')), 'ok')
+            self.assertEqual(len(calls), 2)
+
+
+class TestConcurrentAddToCart(BaseTestCase):
+    """
+    Parallel requests need a database shared by several connections,
+    in-memory SQLite runs everything through a single one.
+    """
+    workers = 8
+    requests = 40
+
+    def create_app(self):
+        app = super().create_app()
+        uri = app.config['SQLALCHEMY_DATABASE_URI']
+        if uri in ('sqlite:///', 'sqlite://'):
+            self.tmpdir = tempfile.mkdtemp()
+            app.config['SQLALCHEMY_DATABASE_URI'] = (
+                'sqlite:///' + os.path.join(self.tmpdir, 'test.db'))
+        return app
+
+    def tearDown(self):
+        super().tearDown()
+        if getattr(self, 'tmpdir', None):
+            shutil.rmtree(self.tmpdir)
+
+    def test_parallel_add_to_cart(self):
+        apple, cat = Product.query.order_by(Product.id).limit(2).all()
+        product_ids = [apple.id, cat.id] * (self.requests // 2)
+        url = url_for('api.add_to_cart')
+        headers = {'Authorization': 'Token %s' % self.user.get_token()}
+        self.db.session.commit()
+
+        def post(product_id):
+            with self.app.test_client() as client:
+                return client.post(url, json={'product': product_id},
+                                   headers=headers).status_code
+
+        with ThreadPoolExecutor(self.workers) as pool:
+            codes = list(pool.map(post, product_ids))
+        self.assertEqual(codes, [201] * self.requests)
+        self.db.session.expire_all()
+        self.assertEqual(Cart.query.count(), 1)
+        items = CartItem.query.order_by(CartItem.product_id).all()
+        self.assertEqual([(item.product_id, item.quantity) for item in items],
+                         [(apple.id, self.requests // 2),
+                          (cat.id, self.requests // 2)])
+        self.assertCartConsistent(self.load_cart())
+
+
+class TestCoalescedUpdates(TestConcurrentAddToCart):
+    """
+    Cart item updates with CART_UPDATE_COALESCE_WINDOW set.
+    """
+
+    def create_app(self):
+        app = super().create_app()
+        app.config['CART_UPDATE_COALESCE_WINDOW'] = 0.3
+        return app
+
+    def setUp(self):
+        super().setUp()
+        coalescer.reset()
+
+    test_parallel_add_to_cart = unittest.skip('Adding is not coalesced')(
+        TestConcurrentAddToCart.test_parallel_add_to_cart)
+
+    def test_coalesced_updates(self):
+        apple = Product.query.order_by(Product.id).first()
+        headers = {'Authorization': 'Token %s' % self.user.get_token()}
+        self.db.session.commit()
+        with self.app.test_client() as client:
+            response = client.post(url_for('api.add_to_cart'),
+                                   json={'product': apple.id}, headers=headers)
+        url = url_for('api.update_cart_item', pk=response.json['data']['id'])
+
+        def put(quantity):
+            with self.app.test_client() as client:
+                response = client.put(url, json={'quantity': quantity},
+                                      headers=headers)
+                return response.status_code, response.json['quantity']
+
+        quantities = list(range(1, self.workers + 1))
+        with ThreadPoolExecutor(self.workers) as pool:
+            responses = list(pool.map(put, quantities))
+        self.assertEqual([code for code, _ in responses], [200] * self.workers)
+        stats = coalescer.stats()
+        self.assertEqual(stats['updates'], self.workers)
+        self.assertGreater(stats['coalesced'], 0)
+        self.assertEqual(stats['batches'] + stats['coalesced'], self.workers)
+        self.assertEqual(stats['failed'], 0)
+        # Requests of one batch answer with the same final state
+        quantities = [quantity for _, quantity in responses]
+        self.assertLessEqual(len(set(quantities)), stats['batches'])
+        self.db.session.expire_all()
+        cart = self.load_cart()
+        self.assertIn(cart.cart_items[0].quantity, quantities)
+        self.assertCartConsistent(cart)
+
+        with self.app.test_client() as client:
+            response = client.patch(url, json={'quantity': 0}, headers=headers)
+            self.assertEqual((response.status_code, response.json), (200, {}))
+            response = client.patch(url, json={'quantity': 1}, headers=headers)
+            self.assertEqual(response.status_code, 404)
+        self.assertEqual(CartItem.query.count(), 0)
+
+    def test_connection_released_while_waiting(self):
+        # The isolation level checks a connection out before the view runs
+        self.app.config['API_ISOLATION_LEVEL'] = 'SERIALIZABLE'
+        apple = Product.query.order_by(Product.id).first()
+        headers = {'Authorization': 'Token %s' % self.user.get_token()}
+        self.db.session.commit()
+        with self.app.test_client() as client:
+            response = client.post(url_for('api.add_to_cart'),
+                                   json={'product': apple.id}, headers=headers)
+        url = url_for('api.update_cart_item', pk=response.json['data']['id'])
+        checked_out = {}
+
+        def checkout(*args):
+            ident = threading.get_ident()
+            checked_out[ident] = checked_out.get(ident, 0) + 1
+
+        def checkin(*args):
+            checked_out[threading.get_ident()] -= 1
+
+        def put():
+            with self.app.test_client() as client:
+                response = client.put(url, json={'quantity': 3},
+                                      headers=headers)
+                return response.status_code
+
+        event.listen(self.db.engine, 'checkout', checkout)
+        event.listen(self.db.engine, 'checkin', checkin)
+        try:
+            with ThreadPoolExecutor(1) as pool:
+                future = pool.submit(put)
+                time.sleep(self.app.config['CART_UPDATE_COALESCE_WINDOW'] / 2)
+                waiting = sum(checked_out.values())
+                self.assertEqual(future.result(), 200)
+        finally:
+            event.remove(self.db.engine, 'checkout', checkout)
+            event.remove(self.db.engine, 'checkin', checkin)
+        self.assertEqual(waiting, 0)
+        self.db.session.expire_all()
+        self.assertEqual(CartItem.query.one().quantity, 3)
+
+
+class TestRepricing(BaseTestCase):
+    """
+    Set-based repricing of stored carts after product changes.
+    """
+
+    def setUp(self):
+        super().setUp()
+        other = User(email='other@user.com', password='other_user')
+        other.loyalty_card = True
+        self.db.session.add(other)
+        tokens = [user.get_token() for user in (self.user, other)]
+        self.db.session.commit()
+        for token in tokens:
+            for product in Product.query.order_by(Product.id).all() * 3:
+                response = self.client.post(
+                    url_for('api.add_to_cart'), json={'product': product.id},
+                    headers={'Authorization': 'Token %s' % token})
+                self.assertEqual(response.status_code, 201)
+
+    def assertRepriced(self, cart_ids):
+        self.assertEqual(verify_carts(cart_ids, len(cart_ids)), {})
+        for cart_id in cart_ids:
+            self.assertCartConsistent(self.load_cart(cart_id))
+
+    def test_reprice_on_product_update(self):
+        self.addCleanup(self.app.config.__setitem__,
+                        'CART_REPRICE_ON_PRODUCT_UPDATE',
+                        self.app.config['CART_REPRICE_ON_PRODUCT_UPDATE'])
+        self.app.config['CART_REPRICE_ON_PRODUCT_UPDATE'] = True
+        # The job runs here rather than in a thread sharing the connection of
+        # the test database
+        started = []
+        repricer.start = lambda app, product_ids=None: started.append(
+            product_ids)
+        self.addCleanup(delattr, repricer, 'start')
+        versions = dict(self.db.session.query(Cart.id, Cart.version))
+        apple = Product.query.order_by(Product.id).first()
+        apple.price = 3
+        apple.bogof = True
+        self.db.session.commit()
+        self.assertEqual(started, [[apple.id]])
+        repricer.run(started[0])
+        self.assertEqual(sorted(versions), [
+            cart_id for cart_id, in
+            self.db.session.query(Cart.id).order_by(Cart.id)])
+        self.assertRepriced(sorted(versions))
+        for cart_id, version in self.db.session.query(Cart.id, Cart.version):
+            self.assertEqual(version, versions[cart_id] + 1)
+        item = CartItem.query.filter_by(cart_id=self.load_cart().id,
+                                        product_id=apple.id).one()
+        self.assertEqual(item.price, 6)
+
+    def test_reprice_all_carts(self):
+        Product.query.update({Product.price: Product.price * 2},
+                             synchronize_session=False)
+        self.db.session.commit()
+        cart_ids, _ = repricer.run(chunk_size=1)
+        self.assertEqual(len(cart_ids), 2)
+        self.assertRepriced(cart_ids)
+        self.assertGreater(repricer.stats()['carts'], 0)
+
+
+class TestAsyncApi(TestApiBlueprint):
+    """
+    The cart scenarios of TestApiBlueprint against the aiohttp app of
+    project.server.asyncapi, sharing a database file with the Flask app
+    the tests use for setup and assertions.
+    """
+    flask_only = 'Not served by the async API'
+
+    def create_app(self):
+        app = super().create_app()
+        self.tmpdir = tempfile.mkdtemp()
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(
+            self.tmpdir, 'test.db')
+        return app
+
+    def setUp(self):
+        config = dict(self.app.config, CATALOG_VERSION_CHECK_INTERVAL=0)
+        self.client = AsyncAppClient(create_async_app(config))
+        super().setUp()
+
+    def test_cart_store_refused(self):
+        with self.assertRaises(RuntimeError):
+            create_async_app(dict(self.app.config, CART_STORE='memory'))
+
+    def tearDown(self):
+        self.client.close()
+        super().tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    test_token_cache = unittest.skip(flask_only)(
+        TestApiBlueprint.test_token_cache)
+    test_cart_operations = unittest.skip(flask_only)(
+        TestApiBlueprint.test_cart_operations)
+    test_quote = unittest.skip(flask_only)(TestApiBlueprint.test_quote)
+    test_list_products = unittest.skip(flask_only)(
+        TestApiBlueprint.test_list_products)
+    test_stream_products = unittest.skip(flask_only)(
+        TestApiBlueprint.test_stream_products)
+    test_search_products = unittest.skip(flask_only)(
+        TestApiBlueprint.test_search_products)
+    test_query_budgets = unittest.skip(flask_only)(
+        TestApiBlueprint.test_query_budgets)
+    test_sql_metrics = unittest.skip(flask_only)(
+        TestApiBlueprint.test_sql_metrics)
+    test_unit_of_work = unittest.skip(flask_only)(
+        TestApiBlueprint.test_unit_of_work)
+    test_metrics_admin_only = unittest.skip(flask_only)(
+        TestApiBlueprint.test_metrics_admin_only)
+    # No requests, already covered by TestApiBlueprint
+    test_check_cart = unittest.skip(flask_only)(
+        TestApiBlueprint.test_check_cart)
+    test_quote_matches_update_cart = unittest.skip(flask_only)(
+        TestApiBlueprint.test_quote_matches_update_cart)
+    test_unit_of_work_retries = unittest.skip(flask_only)(
+        TestApiBlueprint.test_unit_of_work_retries)
+
+
+class TestCartStoreApi(TestApiBlueprint):
+    """
+    The cart scenarios of TestApiBlueprint with carts served by the memory
+    cart store, written through so that the database assertions hold.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.app.config.update(CART_STORE='memory',
+                               CART_STORE_FLUSH_INTERVAL=0)
+        cartstore.init_app(self.app)
+
+    def tearDown(self):
+        self.app.extensions['cart_store'] = None
+        super().tearDown()
+
+    # The store runs other statements
+    test_query_budgets = unittest.skip('Not served by the cart store')(
+        TestApiBlueprint.test_query_budgets)
+    test_sql_metrics = unittest.skip('Not served by the cart store')(
+        TestApiBlueprint.test_sql_metrics)
+
+
+class TestCartStoreWriteBehind(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.app.config.update(
+            CART_STORE_FLUSH_INTERVAL=3600, CART_STORE_FLUSH_BATCH=1,
+            CART_STORE_PATH=os.path.join(self.tmpdir, 'carts.kv'))
+        self.client.environ_base['HTTP_AUTHORIZATION'] = (
+            'Token %s' % self.user.get_token())
+        self.db.session.commit()
+
+    def tearDown(self):
+        store = self.app.extensions.pop('cart_store', None)
+        if store is not None:
+            store.close()
+        super().tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def use_store(self, backend):
+        previous = self.app.extensions.get('cart_store')
+        if previous is not None:
+            previous.close()
+        self.app.config['CART_STORE'] = backend
+        return cartstore.init_app(self.app)
+
+    def add_product_to_cart(self, product):
+        return self.client.post(
+            url_for('api.add_to_cart'),
+            json={'product': product.id},
+        )
+
+    def test_write_behind(self):
+        apple, cat, butter = Product.query.order_by(Product.id).all()
+        for backend in ('memory', 'kv'):
+            store = self.use_store(backend)
+            # New lines are created in the database right away, other
+            # changes wait for a flush
+            res = self.add_product_to_cart(apple)
+            item_id = res.json['data']['id']
+            self.add_product_to_cart(cat)
+            res = self.add_product_to_cart(apple)
+            self.assertEqual(
+                (res.json['data']['id'], res.json['data']['quantity']),
+                (item_id, 2))
+            self.client.patch(
+                url_for('api.toggle_loyalty_card', pk=self.user.id))
+            res = self.client.put(url_for('api.update_cart_item', pk=123),
+                                  json={'quantity': 1})
+            self.assertEqual(res.status_code, 404)
+            cart = self.client.get(url_for('api.get_cart')).json
+            self.assertEqual(cart['total'], '13.72')  # 14 * 0.98
+            self.assertEqual(CartItem.query.get(item_id).quantity, 1)
+            self.assertCartConsistent(self.load_cart())
+            self.assertEqual(store.stats()['dirty'], 1)
+
+            self.assertEqual(store.flush(), 1)
+            self.assertEqual(store.stats()['dirty'], 0)
+            self.db.session.expire_all()
+            self.assertEqual(CartItem.query.get(item_id).quantity, 2)
+            self.assertEqual(format_cents(self.load_cart().total),
+                             cart['total'])
+            self.assertTrue(self.user.loyalty_card)
+            self.assertCartConsistent(self.load_cart())
+            res = self.client.get(url_for('api.get_metrics', name='cartstore'))
+            self.assertEqual((res.json['backend'], res.json['flushes'],
+                              res.json['flushed_carts']), (backend, 1, 1))
+
+            # Cart operations run in SQL, on the cart as stored
+            # Removed and added again before a flush, the line is kept
+            self.client.delete(url_for('api.remove_cart_item', pk=item_id))
+            self.add_product_to_cart(apple)
+            store.flush()
+            self.assertEqual(CartItem.query.get(item_id).quantity, 1)
+            self.assertCartConsistent(self.load_cart())
+            self.client.delete(url_for('api.remove_cart_item', pk=item_id))
+            res = self.client.post(url_for('api.cart_operations'), json={
+                'operations': [{'action': 'add', 'product': butter.id}]})
+            self.assertEqual(sorted(item['product']['id']
+                                    for item in res.json['cart_items']),
+                             [cat.id, butter.id])
+            self.assertCartConsistent(self.load_cart())
+            self.assertEqual(len(store), 0)
+            for item in res.json['cart_items']:
+                self.client.delete(
+                    url_for('api.remove_cart_item', pk=item['id']))
+            self.client.patch(
+                url_for('api.toggle_loyalty_card', pk=self.user.id))
+            store.flush()
+            self.assertEqual(CartItem.query.count(), 0)
+
+    def test_flush_quarantine(self):
+        apple, cat, butter = Product.query.order_by(Product.id).all()
+        store = self.use_store('memory')
+        store.batch_size = 10
+        for _ in range(2):
+            self.add_product_to_cart(apple)
+        # A cart the database refuses doesn't keep the others from being
+        # written
+        other = User(email='other@user.com', password='other_user')
+        self.db.session.add(other)
+        self.db.session.commit()
+        store._put(cartstore.StoredCart(other.id, None, False,
+                                        items={999: [apple.id, 1, None]},
+                                        dirty=True))
+        self.assertEqual(store.flush(), 1)
+        self.assertEqual(store.stats()['quarantined_carts'], 1)
+        self.assertEqual((len(store), store.stats()['dirty']), (1, 0))
+        self.assertEqual(CartItem.query.one().quantity, 2)
+        self.assertCartConsistent(self.load_cart())
+
+    def test_deleted_product(self):
+        apple, cat, butter = Product.query.order_by(Product.id).all()
+        store = self.use_store('memory')
+        self.add_product_to_cart(apple)
+        item_id = self.add_product_to_cart(cat).json['data']['id']
+        self.db.session.delete(cat)
+        self.db.session.commit()
+        catalog.invalidate()
+        res = self.client.patch(url_for('api.update_cart_item', pk=item_id),
+                                json={'quantity': 3})
+        self.assertEqual((res.status_code, res.json), (200, {}))
+        store.flush()
+        self.assertIsNone(CartItem.query.get(item_id))
+        self.assertCartConsistent(self.load_cart())
+
+    def test_new_line_rolled_back(self):
+        apple = Product.query.first()
+        store = self.use_store('memory')
+        item = store.add(self.user.id, apple)
+        self.db.session.rollback()
+        # The store forgets the line of the rolled back transaction
+        self.assertEqual(len(store), 0)
+        self.assertIsNone(CartItem.query.get(item.id))
+        self.assertEqual(store.flush(), 0)
+
+    def test_rolled_back_add_keeps_unflushed_changes(self):
+        apple, cat, butter = Product.query.order_by(Product.id).all()
+        for backend in ('memory', 'kv'):
+            store = self.use_store(backend)
+            for _ in range(2):
+                self.add_product_to_cart(apple)
+            store.add(self.user.id, cat)
+            self.db.session.rollback()
+            # Only the rolled back line goes, the second apple isn't flushed
+            # yet
+            res = self.client.get(url_for('api.get_cart'))
+            self.assertEqual([(item['product']['id'], item['quantity'])
+                              for item in res.json['cart_items']],
+                             [(apple.id, 2)])
+            self.assertEqual(store.flush(), 1)
+            self.assertEqual(CartItem.query.one().quantity, 2)
+            self.assertCartConsistent(self.load_cart())
+            item_id = res.json['cart_items'][0]['id']
+            self.client.delete(url_for('api.remove_cart_item', pk=item_id))
+            store.flush()
+
+    def test_kv_recovery(self):
+        apple = Product.query.first()
+        self.use_store('kv')
+        for _ in range(3):
+            self.add_product_to_cart(apple)
+        # A process starting after a crash writes what the previous one didn't
+        store = cartstore.KeyValueCartStore(self.app.config)
+        self.assertEqual(len(store), 1)
+        self.assertEqual(store.flush(), 1)
+        self.assertEqual(CartItem.query.one().quantity, 3)
+        self.assertCartConsistent(self.load_cart())
 
 
 if __name__ == '__main__':
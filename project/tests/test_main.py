@@ -3,6 +3,9 @@
 
 import unittest
 
+from project.server.catalog import catalog, current_version
+from project.server.search import PrefixIndex
+from project.server.models import Product
 from project.tests.base import BaseTestCase
 
 
@@ -19,6 +22,80 @@ class TestMainBlueprint(BaseTestCase):
         self.assert404(response)
         self.assertTemplateUsed('errors/404.html')
 
+    def test_index_uses_catalog(self):
+        response = self.client.get('/')
+        self.assertIn(b'Butter', response.data)
+        self.db.session.add(Product(title='Milk', price=100))
+        self.db.session.commit()
+        response = self.client.get('/')
+        self.assertIn(b'Milk', response.data)
+
+    def test_index_first_page(self):
+        self.app.config['PRODUCTS_PAGE_SIZE'] = 2
+        try:
+            response = self.client.get('/')
+        finally:
+            self.app.config['PRODUCTS_PAGE_SIZE'] = 50
+        self.assertIn(b'Apple', response.data)
+        self.assertNotIn(b'Butter', response.data)
+        self.assertEqual(self.get_context_variable('next'),
+                         Product.query.filter_by(title='Cat').one().id)
+        self.assertIn(b'data-after=', response.data)
+        self.assertNotIn(b'data-after=', self.client.get('/').data)
+
+    def test_catalog_version(self):
+        snapshot = catalog.snapshot()
+        self.assertEqual(len(snapshot), 3)
+        self.assertIs(catalog.snapshot(), snapshot)
+        version = snapshot.version
+        product = Product.query.filter_by(title='Apple').first()
+        product.price = 300
+        self.db.session.commit()
+        self.assertEqual(current_version(), version + 1)
+        self.assertEqual(catalog.get(product.id).price, 300)
+        # No net change, no new version
+        product.price = 300
+        self.db.session.commit()
+        self.assertEqual(current_version(), version + 1)
+        Product.query.filter_by(title='Cat').update({'bogof': False})
+        self.db.session.commit()
+        self.assertFalse(any(p.bogof for p in catalog.snapshot()))
+        self.db.session.delete(product)
+        self.db.session.commit()
+        self.assertIsNone(catalog.get(product.id))
+        self.assertEqual(current_version(), version + 3)
+        self.assertEqual(catalog.get('x'), None)
+
+    def test_catalog_detects_other_process(self):
+        self.addCleanup(setattr, catalog, 'check_interval',
+                        catalog.check_interval)
+        catalog.check_interval = 0
+        snapshot = catalog.snapshot()
+        # Changes made elsewhere are only visible through the version row
+        self.db.session.execute(
+            "UPDATE products SET title = 'Pear' WHERE title = 'Apple'")
+        self.db.session.execute(
+            'UPDATE catalog_version SET version = version + 1')
+        self.db.session.commit()
+        self.assertIsNot(catalog.snapshot(), snapshot)
+        self.assertIn('Pear', [p.title for p in catalog.snapshot()])
+
+    def test_search_index_updates(self):
+        old = catalog.snapshot()
+        old_index = old.search_index
+        self.db.session.add(Product(title='Blue butter', price=100))
+        Product.query.filter_by(title='Cat').one().title = 'Blue cat'
+        self.db.session.commit()
+        new = catalog.snapshot()
+        self.assertIsNot(new, old)
+        # Derived from the previous index, which is left unchanged
+        self.assertEqual(new.search_index.postings,
+                         PrefixIndex.from_products(new).postings)
+        self.assertEqual(new.search_index.words,
+                         ['apple', 'blue', 'butter', 'cat'])
+        self.assertEqual(old_index.words, ['apple', 'butter', 'cat'])
+        self.assertEqual(len(old_index.postings['butter']), 1)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -10,6 +10,8 @@ from project.tests.base import BaseTestCase
 from project.server import bcrypt
 from project.server.models import User
 from project.server.user.forms import LoginForm
+from project.server.user.hashing import password_hasher, hash_rounds, calibrate
+from project.server.user.identity import identity_cache, SessionUser
 
 
 class TestUserBlueprint(BaseTestCase):
@@ -106,6 +108,60 @@ class TestUserBlueprint(BaseTestCase):
             self.assertTrue(current_user.is_active())
             self.assertEqual(response.status_code, 200)
 
+    def test_rehash_on_login(self):
+        # Ensure a hash of another cost is upgraded on login.
+        self.app.config['BCRYPT_LOG_ROUNDS'] = 5
+        with self.client:
+            self.client.post('/login', data=dict(
+                email='ad@min.com', password='admin_user'
+            ), follow_redirects=True)
+            self.assertTrue(current_user.is_active())
+        user = User.query.filter_by(email='ad@min.com').first()
+        self.assertEqual(hash_rounds(user.password), 5)
+        self.assertTrue(
+            bcrypt.check_password_hash(user.password, 'admin_user'))
+        self.assertEqual(password_hasher.stats()['rehashed'], 1)
+
+    def test_hashing_pool(self):
+        # Ensure hashes are computed by the pool and saturation answers 503.
+        password_hasher.configure(workers=1, queue_limit=4, timeout=30)
+        try:
+            pw_hash = password_hasher.hash('secret', 4)
+            self.assertTrue(password_hasher.check(pw_hash, 'secret'))
+            self.assertFalse(password_hasher.check(pw_hash, 'other'))
+            password_hasher.queue_limit = 0
+            response = self.client.post('/login', data=dict(
+                email='ad@min.com', password='admin_user'
+            ))
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.headers['Retry-After'], '1')
+            self.assertEqual(password_hasher.stats()['rejected'], 1)
+        finally:
+            password_hasher.configure()
+
+    def test_identity_cache(self):
+        # Ensure page views reuse the cached identity until the user changes.
+        with self.client:
+            self.client.post('/login', data=dict(
+                email='ad@min.com', password='admin_user'
+            ), follow_redirects=True)
+            hits = identity_cache.hits
+            response = self.client.get('/')
+            self.assertIn(b'<span class="crd">False</span>', response.data)
+            self.assertIsInstance(current_user._get_current_object(),
+                                  SessionUser)
+            self.assertEqual(identity_cache.hits, hits + 1)
+            response = self.client.patch('/api/user/%s/' % current_user.id)
+            self.assertEqual(response.json, {'card': True})
+            self.assertEqual(identity_cache.stats()['invalidations'], 1)
+            response = self.client.get('/')
+            self.assertIn(b'<span class="crd">True</span>', response.data)
+
+    def test_calibrate(self):
+        # Ensure calibration stays within its bounds.
+        self.assertEqual(calibrate(1, 4, 16), 4)
+        self.assertEqual(calibrate(10 ** 9, 4, 16), 16)
+
 
 if __name__ == '__main__':
     unittest.main()